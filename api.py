@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 #
+import logging
+import sys
+from array import array
 from collections import OrderedDict
-from sanic.response import json, text, HTTPResponse
+from json import dumps
+from sanic.response import json, text, stream, HTTPResponse
 from sanic.request import Request
-from sanic.exceptions import ServiceUnavailable
+from sanic.exceptions import ServiceUnavailable, InvalidUsage, SanicException
 from sanic_restplus import Api, Resource, fields
 
-from functions import get_linksets, get_datasets, get_locations, get_location_is_within, get_location_contains, get_resource, get_location_overlaps_crosswalk, get_location_overlaps, get_at_location, search_location_by_label
+from functions import get_linksets, get_datasets, get_locations, get_location_is_within, get_location_contains, get_resource, get_location_overlaps_crosswalk, get_location_overlaps, get_location_overlaps_batch, get_at_location, get_at_locations, search_location_by_label, suggest_location_by_label
+from functions import iter_locations, iter_location_is_within, iter_location_contains, iter_location_overlaps
+import explain
 
 
 url_prefix = '/v1'
@@ -19,6 +25,80 @@ api_v1 = Api(title="LOCI Integration API",
 ns = api_v1.default_namespace
 
 TRUTHS = ("t", "T", "1")
+NDJSON = "application/x-ndjson"
+
+
+EXPLAIN_PARAM = ("explain", {"description": "Include every query made for the request, with its parameters, rows, bytes, time and cache status, in the response meta",
+                             "required": False, "type": "boolean", "default": False})
+
+
+def start_explain(request):
+    """
+    :return: the trace of the request's queries if it asked for ?explain=true, otherwise None
+    :rtype: explain.Trace
+    """
+    explain_arg = str(next(iter(request.args.getlist('explain', ['false']))))
+    if explain_arg[:1] in TRUTHS:
+        return explain.start_trace()
+    return None
+
+
+def wants_ndjson(request):
+    """
+    Whether the client asked for a newline-delimited JSON stream instead of a single JSON document
+    """
+    return NDJSON in request.headers.get('Accept', '')
+
+
+def ndjson_error_message(error):
+    """
+    :return: the message to report an error streaming a response with, only API errors give their own message
+    :rtype: str
+    """
+    if isinstance(error, SanicException):
+        return str(error)
+    return "An error occurred while streaming the response"
+
+
+async def ndjson_response(features):
+    """
+    Stream features to the client as newline-delimited JSON, one feature per line, as they are produced.
+    The first feature is awaited before the response is started, so an invalid argument or a failed query
+    is returned with its own status instead of a 200. An error after that is reported in a last
+    {"error": message} line, as the status has already been sent.
+    :param features: iterable or async iterable of JSON serialisable features
+    :rtype: StreamingHTTPResponse
+    """
+    if not hasattr(features, '__aiter__'):
+        async def streaming_fn(response):
+            for feature in features:
+                await response.write(dumps(feature) + "\n")
+        return stream(streaming_fn, content_type=NDJSON)
+
+    try:
+        first = [await features.__anext__()]
+    except StopAsyncIteration:
+        first = []
+
+    async def streaming_fn(response):
+        try:
+            for feature in first:
+                await response.write(dumps(feature) + "\n")
+            while first:
+                try:
+                    feature = await features.__anext__()
+                except StopAsyncIteration:
+                    break
+                except Exception as e:
+                    logging.exception("Error streaming an NDJSON response")
+                    await response.write(dumps({'error': ndjson_error_message(e)}) + "\n")
+                    break
+                await response.write(dumps(feature) + "\n")
+        finally:
+            aclose = getattr(features, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+    return stream(streaming_fn, content_type=NDJSON)
 
 @ns.route('/linksets')
 class Linkset(Resource):
@@ -29,12 +109,15 @@ class Linkset(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of linksets before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Gets all LOCI Linksets"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
-        meta, linksets = await get_linksets(count, offset)
+        cursor = next(iter(request.args.getlist('cursor', [None])))
+        meta, linksets = await get_linksets(count, offset, cursor)
         response = {
             "meta": meta,
             "linksets": linksets,
@@ -51,12 +134,15 @@ class Dataset(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of datasets before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Gets all LOCI Datasets"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
-        meta, datasets = await get_datasets(count, offset)
+        cursor = next(iter(request.args.getlist('cursor', [None])))
+        meta, datasets = await get_datasets(count, offset, cursor)
         response = {
             "meta": meta,
             "datasets": datasets,
@@ -73,12 +159,18 @@ class Location(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
     ]), security=None)
     async def get(self, request, *args, **kwargs):
-        """Gets all LOCI Locations"""
+        """Gets all LOCI Locations\n
+        Send "Accept: application/x-ndjson" to stream the locations one per line, this is not available with cursor"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
-        meta, locations = await get_locations(count, offset)
+        cursor = next(iter(request.args.getlist('cursor', [None])))
+        if wants_ndjson(request) and cursor is None:
+            return await ndjson_response(iter_locations(count, offset))
+        meta, locations = await get_locations(count, offset, cursor)
         response = {
             "meta": meta,
             "locations": locations,
@@ -124,13 +216,23 @@ class Within(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
+        EXPLAIN_PARAM,
     ]), security=None)
     async def get(self, request, *args, **kwargs):
-        """Gets all LOCI Locations that this target LOCI URI is within"""
+        """Gets all LOCI Locations that this target LOCI URI is within\n
+        Send "Accept: application/x-ndjson" to stream the locations one per line, this is not available with cursor"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
+        cursor = next(iter(request.args.getlist('cursor', [None])))
         target_uri = str(next(iter(request.args.getlist('uri'))))
-        meta, locations = await get_location_is_within(target_uri, count, offset)
+        if wants_ndjson(request) and cursor is None:
+            return await ndjson_response(iter_location_is_within(target_uri, count, offset))
+        trace = start_explain(request)
+        meta, locations = await get_location_is_within(target_uri, count, offset, cursor)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
         response = {
             "meta": meta,
             "locations": locations,
@@ -148,13 +250,23 @@ class Contains(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
+        EXPLAIN_PARAM,
     ]), security=None)
     async def get(self, request, *args, **kwargs):
-        """Gets all LOCI Locations that this target LOCI URI contains"""
+        """Gets all LOCI Locations that this target LOCI URI contains\n
+        Send "Accept: application/x-ndjson" to stream the locations one per line, this is not available with cursor"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
+        cursor = next(iter(request.args.getlist('cursor', [None])))
         target_uri = str(next(iter(request.args.getlist('uri'))))
-        meta, locations = await get_location_contains(target_uri, count, offset)
+        if wants_ndjson(request) and cursor is None:
+            return await ndjson_response(iter_location_contains(target_uri, count, offset))
+        trace = start_explain(request)
+        meta, locations = await get_location_contains(target_uri, count, offset, cursor)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
         response = {
             "meta": meta,
             "locations": locations,
@@ -184,12 +296,19 @@ class Overlaps(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
+        ("debug", {"description": "Include a per-query timing breakdown in the response meta",
+                   "required": False, "type": "boolean", "default": False}),
+        EXPLAIN_PARAM,
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Gets all LOCI Locations that this target LOCI URI overlaps with\n
-        Note: count and offset do not currently work properly on /overlaps """
+        Note: count and offset do not currently work properly on /overlaps, use cursor to page through the overlaps
+        Send "Accept: application/x-ndjson" to stream the overlaps one per line, this is not available with cursor"""
         count = int(next(iter(request.args.getlist('count', [1000]))))
         offset = int(next(iter(request.args.getlist('offset', [0]))))
+        cursor = next(iter(request.args.getlist('cursor', [None])))
         target_uri = str(next(iter(request.args.getlist('uri'))))
         if 'output_type'  in request.args:
             output_featuretype_uri = str(next(iter(request.args.getlist('output_type'))))
@@ -205,13 +324,23 @@ class Overlaps(Resource):
         include_contains = include_contains[0] in TRUTHS
         include_within = include_within[0] in TRUTHS
         crosswalk = crosswalk[0] in TRUTHS
+        debug = str(next(iter(request.args.getlist('debug', ['false']))))
+        debug = debug[0] in TRUTHS
+        trace = start_explain(request)
         if crosswalk:
             include_within = False
             meta, overlaps = await get_location_overlaps_crosswalk(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within,
                                                         include_contains, count, offset)
+            if wants_ndjson(request):
+                return await ndjson_response(overlaps)
+        elif wants_ndjson(request) and cursor is None:
+            return await ndjson_response(iter_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within,
+                                                          include_contains, None, count, offset))
         else:
             meta, overlaps = await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within,
-                                                        include_contains, None, count, offset)
+                                                        include_contains, None, count, offset, debug=debug, cursor=cursor)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
 
         response = {
             "meta": meta,
@@ -220,6 +349,57 @@ class Overlaps(Resource):
         return json(response, status=200)
 
 
+@ns_loc_func.route('/overlaps/batch')
+class OverlapsBatch(Resource):
+    """Function for location Overlaps of many locations"""
+
+    @ns.doc('get_location_overlaps_batch', params=OrderedDict([
+        ("areas", {"description": "Include areas of overlapping features in m2",
+                   "required": False, "type": "boolean", "default": False}),
+        ("proportion", {"description": "Include proportion of overlap in percent",
+                         "required": False, "type": "boolean", "default": False}),
+        ("contains", {"description": "Include locations wholly contained in each feature",
+                        "required": False, "type": "boolean", "default": False}),
+        ("within", {"description": "Include features each location is wholly within",
+                    "required": False, "type": "boolean", "default": False}),
+        ("output_type", {"description": "Restrict output uris to specified fully qualified uri",
+                    "required": False, "type": "string", "default": ''}),
+        EXPLAIN_PARAM,
+    ]), security=None)
+    async def post(self, request, *args, **kwargs):
+        """Gets the LOCI Locations that each of many target LOCI URIs overlaps with\n
+        The body is JSON, either a list of target URIs or an object with a "uris" list.
+        Results are grouped per target URI. Paging is not applied, all overlaps of every target are returned."""
+        body = request.json
+        if isinstance(body, dict):
+            body = body.get('uris')
+        if not isinstance(body, list):
+            raise InvalidUsage("JSON body must be a list of uris, or an object with a \"uris\" list")
+        target_uris = [str(uri) for uri in body]
+        if 'output_type' in request.args:
+            output_featuretype_uri = str(next(iter(request.args.getlist('output_type'))))
+        else:
+            output_featuretype_uri = None
+        include_areas = str(next(iter(request.args.getlist('areas', ['false']))))
+        include_proportion = str(next(iter(request.args.getlist('proportion', ['false']))))
+        include_contains = str(next(iter(request.args.getlist('contains', ['false']))))
+        include_within = str(next(iter(request.args.getlist('within', ['false']))))
+        include_areas = include_areas[0] in TRUTHS
+        include_proportion = include_proportion[0] in TRUTHS
+        include_contains = include_contains[0] in TRUTHS
+        include_within = include_within[0] in TRUTHS
+        trace = start_explain(request)
+        meta, results = await get_location_overlaps_batch(target_uris, output_featuretype_uri, include_areas, include_proportion,
+                                                          include_within, include_contains)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
+        response = {
+            "meta": meta,
+            "results": results,
+        }
+        return json(response, status=200)
+
+
 @ns_loc_func.route('/find_at_location')
 class find_at_location(Resource):
     """Function for location find by point"""
@@ -235,6 +415,7 @@ class find_at_location(Resource):
                    "required": False, "type": "number", "format": "integer", "default": 1000}),
         ("offset", {"description": "Skip number of locations before returning count.",
                     "required": False, "type": "number", "format": "integer", "default": 0}),
+        EXPLAIN_PARAM,
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Gets all LOCI Locations that this target LOCI URI overlaps with\n
@@ -244,7 +425,10 @@ class find_at_location(Resource):
         lon = float(next(iter(request.args.getlist('lon', None))))
         lat = float(next(iter(request.args.getlist('lat', None))))
         loci_type = str(next(iter(request.args.getlist('loci_type', 'mb'))))
+        trace = start_explain(request)
         meta, locations = await get_at_location(lat, lon, loci_type, count, offset)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
         response = {
             "meta": meta,
             "locations": locations,
@@ -252,17 +436,108 @@ class find_at_location(Resource):
 
         return json(response, status=200)
 
+@ns_loc_func.route('/find_at_location/batch')
+class find_at_location_batch(Resource):
+    """Function for location find by many points"""
+
+    @ns.doc('find_at_location_batch', params=OrderedDict([
+        ("loci_type", {"description": "Loci location type to query, can be 'any', 'mb' for meshblocks or 'cc' for contracted catchments",
+                       "required": False, "type": "string", "default": "any"}),
+        EXPLAIN_PARAM,
+    ]), security=None)
+    async def post(self, request, *args, **kwargs):
+        """Gets the LOCI Locations at each of a batch of points\n
+        The body is either JSON with columnar "lat" and "lon" arrays (and optionally "loci_type"),
+        or application/octet-stream of little-endian float64 lat, lon pairs."""
+        loci_type = str(next(iter(request.args.getlist('loci_type', ['any']))))
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/octet-stream'):
+            if len(request.body) % 16 != 0:
+                raise InvalidUsage("Binary body must be a whole number of float64 lat, lon pairs")
+            coords = array('d')
+            coords.frombytes(request.body)
+            if sys.byteorder != 'little':
+                coords.byteswap()
+            lats = coords[0::2].tolist()
+            lons = coords[1::2].tolist()
+        else:
+            body = request.json
+            if not isinstance(body, dict) or 'lat' not in body or 'lon' not in body:
+                raise InvalidUsage("JSON body must have \"lat\" and \"lon\" arrays")
+            try:
+                lats = [float(lat) for lat in body['lat']]
+                lons = [float(lon) for lon in body['lon']]
+            except (TypeError, ValueError):
+                raise InvalidUsage("\"lat\" and \"lon\" must be arrays of numbers")
+            if len(lats) != len(lons):
+                raise InvalidUsage("\"lat\" and \"lon\" arrays must be the same length")
+            loci_type = str(body.get('loci_type', loci_type))
+        trace = start_explain(request)
+        meta, locations = await get_at_locations(lats, lons, loci_type)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
+        response = {
+            "meta": meta,
+            "locations": locations,
+        }
+        return json(response, status=200)
+
 @ns_loc_func.route('/find-by-label')
 class Search(Resource):
     """Function for finding a LOCI location by label"""
 
     @ns.doc('find_location_by_label', params=OrderedDict([
-        ("query", {"description": "Search query for label",
+        ("query", {"description": "Search query for label, the last word may be the start of a word",
                     "required": True, "type": "string"}),
+        ("dataset", {"description": "Only find locations of the dataset with this uri",
+                     "required": False, "type": "string"}),
+        ("count", {"description": "Number of locations to return, at most 100.",
+                   "required": False, "type": "number", "format": "integer", "default": 10}),
+        ("offset", {"description": "Skip number of locations before returning count.",
+                    "required": False, "type": "number", "format": "integer", "default": 0}),
+        ("cursor", {"description": "Page with a cursor instead of offset. Pass \"first\" for the first page, then meta.next_cursor for each page after.",
+                    "required": False, "type": "string"}),
+        EXPLAIN_PARAM,
     ]), security=None)
     async def get(self, request, *args, **kwargs):
         """Calls search engine to query LOCI Locations by label"""
         query = str(next(iter(request.args.getlist('query'))))
-        result = await search_location_by_label(query)
-        response = result
+        dataset = next(iter(request.args.getlist('dataset', [None])))
+        count = int(next(iter(request.args.getlist('count', [10]))))
+        offset = int(next(iter(request.args.getlist('offset', [0]))))
+        cursor = next(iter(request.args.getlist('cursor', [None])))
+        trace = start_explain(request)
+        meta, locations = await search_location_by_label(query, count, offset, cursor, dataset)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
+        response = {
+            "meta": meta,
+            "locations": locations,
+        }
+        return json(response, status=200)
+
+
+@ns_loc_func.route('/suggest')
+class Suggest(Resource):
+    """Function for suggesting LOCI locations as a label is typed"""
+
+    @ns.doc('suggest_location_by_label', params=OrderedDict([
+        ("query", {"description": "Start of the label, or of one of its first words",
+                    "required": True, "type": "string"}),
+        ("count", {"description": "Number of locations to return, at most 100.",
+                   "required": False, "type": "number", "format": "integer", "default": 10}),
+        EXPLAIN_PARAM,
+    ]), security=None)
+    async def get(self, request, *args, **kwargs):
+        """Suggests LOCI Locations whose label starts with the query, from the local label index if it is loaded"""
+        query = str(next(iter(request.args.getlist('query'))))
+        count = int(next(iter(request.args.getlist('count', [10]))))
+        trace = start_explain(request)
+        meta, locations = await suggest_location_by_label(query, count)
+        if trace is not None:
+            meta['explain'] = trace.as_dict()
+        response = {
+            "meta": meta,
+            "locations": locations,
+        }
         return json(response, status=200)
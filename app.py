@@ -17,16 +17,51 @@ __version__ = "0.0.1"
 import os
 from sanic import Sanic
 from sanic.request import Request
-from sanic.response import HTTPResponse
+from sanic.response import HTTPResponse, json
 from spf import SanicPluginsFramework
 from sanic_restplus.restplus import restplus
 from sanic_cors.extension import cors
 from api import api_v1
+from config import LOCAL_GEOMETRY_PATHS, HIERARCHY_INDEX_PATH, LINKSET_STORE_PATH, LABEL_INDEX_PATH, LINKSET_VERSION
+from config import LISTEN_HOST, LISTEN_PORT, API_WORKERS, API_DEBUG, API_ACCESS_LOG, GIT_LABEL, METRICS_DIR
+from spatial_index import load_spatial_indexes
+from hierarchy_index import load_hierarchy_index
+from linkset_store import load_linkset_store
+from label_index import load_label_index
+from functions import type_cache, label_search_cache
+import upstream
+from response_cache import install_response_cache
+import metrics
 
 HERE_DIR = os.path.dirname(__file__)
 
 import subprocess
-gitlabel = subprocess.check_output(["git", "describe", "--always"]).strip().decode("utf-8")
+
+
+def get_git_label():
+    """
+    The git commit of the running code, from GIT_LABEL or the GIT_LABEL file written when the image was built.
+    Only asks git itself when running from a checkout without either.
+    :return:
+    :rtype: str
+    """
+    if GIT_LABEL:
+        return GIT_LABEL
+    try:
+        with open(os.path.join(HERE_DIR, "GIT_LABEL")) as label_file:
+            label = label_file.read().strip()
+        if label:
+            return label
+    except OSError:
+        pass
+    try:
+        return subprocess.check_output(["git", "describe", "--always"], cwd=HERE_DIR or None,
+                                       stderr=subprocess.DEVNULL).strip().decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+gitlabel = get_git_label()
 
 def create_app():
     app = Sanic(__name__)
@@ -59,6 +94,82 @@ def create_app():
     dir_loc = os.path.abspath(os.path.join(HERE_DIR, "static"))
     app.static(uri="/static/", file_or_directory=dir_loc, name="material_swagger")
 
+    # Time every request, installed first so cached responses are timed too
+    metrics.install_metrics(app)
+
+    # Cache the API's GET responses, and answer conditional requests for them with 304 Not Modified
+    response_cache = install_response_cache(app)
+
+    @app.listener('before_server_start')
+    def load_local_indexes(app, loop):
+        """
+        Load the local geometry files (if configured) used by find_at_location,
+        the hierarchy index (if configured) used by within and contains,
+        the linkset snapshot (if configured) used by overlaps,
+        and the label index (if configured) used by suggest
+        """
+        load_spatial_indexes(LOCAL_GEOMETRY_PATHS)
+        load_hierarchy_index(HIERARCHY_INDEX_PATH, LINKSET_VERSION)
+        load_linkset_store(LINKSET_STORE_PATH, LINKSET_VERSION)
+        load_label_index(LABEL_INDEX_PATH, LINKSET_VERSION)
+
+    @app.listener('before_server_start')
+    def open_upstream_sessions(app, loop):
+        """
+        Open the pooled sessions used to reach GraphDB, the geometry data service and Elasticsearch
+        """
+        upstream.open_sessions(loop)
+
+    @app.listener('after_server_stop')
+    async def close_upstream_sessions(app, loop):
+        """
+        Close the upstream sessions so their pooled connections are shut down cleanly
+        """
+        await upstream.close_sessions(loop)
+
+    @app.route("/stats")
+    def stats(request):
+        """
+        Route function for the stats route.
+        Reports the upstream connection pool use and the type, label search and response cache use of this worker.
+        :param request:
+        :type request: Request
+        :return:
+        :rtype: HTTPResponse
+        """
+        return json({
+            'upstreams': upstream.pool_stats(),
+            'type_cache': type_cache.stats(),
+            'label_search_cache': label_search_cache.stats(),
+            'response_cache': response_cache.stats() if response_cache is not None else None,
+        }, status=200)
+
+    def collect_stats():
+        """
+        :return: the /stats counters of this worker as gauges for /metrics
+        :rtype: list
+        """
+        samples = metrics.stats_samples("loci_upstream", "Upstream connection pool",
+                                        [([('upstream', name)], stats) for name, stats in upstream.pool_stats().items()])
+        samples.extend(metrics.stats_samples("loci_type_cache", "Type cache", [([], type_cache.stats())]))
+        samples.extend(metrics.stats_samples("loci_label_search_cache", "Label search cache", [([], label_search_cache.stats())]))
+        if response_cache is not None:
+            samples.extend(metrics.stats_samples("loci_response_cache", "Response cache", [([], response_cache.stats())]))
+        return samples
+
+    metrics.stats_collectors[:] = [collect_stats]
+
+    @app.route("/metrics")
+    def metrics_route(request):
+        """
+        Route function for the metrics route.
+        Exports the request and upstream timings of all workers, and the /stats counters of each worker, for Prometheus.
+        :param request:
+        :type request: Request
+        :return:
+        :rtype: HTTPResponse
+        """
+        return HTTPResponse(metrics.render(), status=200, content_type=metrics.CONTENT_TYPE)
 
     @app.route("/")
     def index(request):
@@ -83,7 +194,12 @@ def create_app():
 if __name__ == "__main__":
     # Has run from the command line.
     # This section will not be called if run via Gunicorn or mod_wsgi
-    LISTEN_HOST = "0.0.0.0"
-    LISTEN_PORT = 8080
+    # Each worker is a separate process with its own event loop, the before_server_start and
+    # after_server_stop listeners open and close its local indexes and upstream sessions.
+    workers = API_WORKERS or os.cpu_count() or 1
+    if workers > 1 or METRICS_DIR:
+        # Each worker's metrics are written to this directory so /metrics reports those of every worker
+        metrics.share_between_workers(METRICS_DIR)
     app = create_app()
-    app.run(LISTEN_HOST, LISTEN_PORT, debug=True, auto_reload=False)
+    app.run(LISTEN_HOST, LISTEN_PORT, debug=API_DEBUG, access_log=API_ACCESS_LOG,
+            workers=workers, auto_reload=False)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Benchmark of the API against a local stand-in for GraphDB, the geometry data service and Elasticsearch,
+answering from a generated fixture of ASGS and Geofabric features and the linkset between them.
+See run.py.
+"""
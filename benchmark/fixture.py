@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Generates a fixture in the shape of the LOCI cache: an ASGS hierarchy (SA2 > SA1 > meshblock) and a
+Geofabric hierarchy (river region > contracted catchment), each with areas, and the mb16cc linkset of
+reified sfOverlaps/sfWithin/sfContains statements between meshblocks and contracted catchments, with
+the intersection features of each overlap.
+
+The fixture is written as N-Triples, a location_labels.jsonl in the form search/process.sh loads into
+Elasticsearch, and a manifest.json listing the features the benchmark requests are made for.
+The same scale and seed always give the same fixture.
+"""
+import json
+import os
+import random
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+GEO = "http://www.opengis.net/ont/geosparql#"
+GEOX = "http://linked.data.gov.au/def/geox#"
+DT = "http://linked.data.gov.au/def/datatype/"
+DCAT = "http://www.w3.org/ns/dcat#"
+LOCI = "http://linked.data.gov.au/def/loci#"
+IS_PART_OF = "http://purl.org/dc/terms/isPartOf"
+EPSG_3577 = "http://www.opengis.net/def/crs/EPSG/0/3577"
+
+ASGS = "http://linked.data.gov.au/dataset/asgs2016"
+GEOFABRIC = "http://linked.data.gov.au/dataset/geofabric"
+MB16CC = "http://linked.data.gov.au/dataset/mb16cc"
+ASGS_DEF = "http://linked.data.gov.au/def/asgs#"
+GEOFABRIC_DEF = "http://linked.data.gov.au/def/geofabric#"
+
+MESHBLOCK_TYPE = ASGS_DEF + "MeshBlock"
+SA1_TYPE = ASGS_DEF + "StatisticalAreaLevel1"
+SA2_TYPE = ASGS_DEF + "StatisticalAreaLevel2"
+CATCHMENT_TYPE = GEOFABRIC_DEF + "ContractedCatchment"
+RIVER_REGION_TYPE = GEOFABRIC_DEF + "RiverRegion"
+
+
+class NTriplesWriter(object):
+    def __init__(self, ntriples_file):
+        self.ntriples_file = ntriples_file
+        self.blank_nodes = 0
+
+    def blank_node(self):
+        self.blank_nodes += 1
+        return "_:b{}".format(self.blank_nodes)
+
+    def triple(self, s, p, o):
+        """
+        Write one triple, uris are given bare, blank nodes as _:label and literals already quoted
+        """
+        terms = [term if term.startswith(("_:", '"')) else "<{}>".format(term) for term in (s, p, o)]
+        self.ntriples_file.write("{} {} {} .\n".format(*terms))
+
+    def area(self, feature, area):
+        node = self.blank_node()
+        self.triple(feature, GEOX + "hasAreaM2", node)
+        self.triple(node, GEOX + "inCRS", EPSG_3577)
+        self.triple(node, DT + "value", '"{!r}"^^<{}double>'.format(float(area), XSD))
+
+    def statement(self, s, p, o, linkset):
+        node = self.blank_node()
+        self.triple(node, RDF + "subject", s)
+        self.triple(node, RDF + "predicate", p)
+        self.triple(node, RDF + "object", o)
+        self.triple(node, IS_PART_OF, linkset)
+
+    def feature(self, uri, feature_type, label, area=None):
+        self.triple(uri, RDF + "type", feature_type)
+        self.triple(uri, RDFS + "label", '"{}"'.format(label))
+        if area is not None:
+            self.area(uri, area)
+
+    def within(self, child, parent):
+        self.triple(child, GEO + "sfWithin", parent)
+        self.triple(parent, GEO + "sfContains", child)
+
+
+def build_fixture(directory, scale=1, seed=1):
+    """
+    Write the fixture into directory
+    :param scale: number of SA2s, each has 5 SA1s of 8 meshblocks, with a contracted catchment for every
+     4 meshblocks
+    :return: the manifest
+    :rtype: dict
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    ntriples_path = os.path.join(directory, "fixture.nt")
+    labels_path = os.path.join(directory, "location_labels.jsonl")
+    labels = []
+    sa2s, sa1s, meshblocks, catchments, river_regions = [], [], [], [], []
+    with open(ntriples_path, 'w', encoding='utf-8') as ntriples_file:
+        writer = NTriplesWriter(ntriples_file)
+        for feature_type in (MESHBLOCK_TYPE, SA1_TYPE, SA2_TYPE, CATCHMENT_TYPE, RIVER_REGION_TYPE):
+            writer.triple(feature_type, RDFS + "subClassOf", GEO + "Feature")
+        for dataset in (ASGS, GEOFABRIC):
+            writer.triple(dataset, RDF + "type", DCAT + "Dataset")
+        writer.triple(MB16CC, RDF + "type", LOCI + "Linkset")
+
+        for i in range(scale):
+            sa2 = "{}/statisticalarealevel2/{}".format(ASGS, 10000 + i)
+            sa2s.append(sa2)
+            labels.append((sa2, "Statistical Area {}".format(10000 + i)))
+            sa2_area = 0.0
+            for j in range(5):
+                sa1 = "{}/statisticalarealevel1/{}{}".format(ASGS, 10000 + i, j)
+                sa1s.append(sa1)
+                labels.append((sa1, "Statistical Area {}{}".format(10000 + i, j)))
+                writer.within(sa1, sa2)
+                sa1_area = 0.0
+                for k in range(8):
+                    meshblock = "{}/meshblock/{}{}{}".format(ASGS, 10000 + i, j, k)
+                    meshblocks.append(meshblock)
+                    labels.append((meshblock, "Meshblock {}{}{}".format(10000 + i, j, k)))
+                    area = rng.uniform(1e4, 1e5)
+                    sa1_area += area
+                    writer.feature(meshblock, MESHBLOCK_TYPE, "Meshblock {}{}{}".format(10000 + i, j, k), area)
+                    writer.within(meshblock, sa1)
+                writer.feature(sa1, SA1_TYPE, "Statistical Area {}{}".format(10000 + i, j), sa1_area)
+                sa2_area += sa1_area
+            writer.feature(sa2, SA2_TYPE, "Statistical Area {}".format(10000 + i), sa2_area)
+
+        for i in range(max(1, scale // 2)):
+            river_region = "{}/riverregion/{}".format(GEOFABRIC, 100 + i)
+            river_regions.append(river_region)
+            labels.append((river_region, "River Region {}".format(100 + i)))
+            writer.feature(river_region, RIVER_REGION_TYPE, "River Region {}".format(100 + i), 1e9)
+        for i in range(max(1, len(meshblocks) // 4)):
+            catchment = "{}/contractedcatchment/{}".format(GEOFABRIC, 12100000 + i)
+            catchments.append(catchment)
+            labels.append((catchment, "Catchment {}".format(12100000 + i)))
+            writer.feature(catchment, CATCHMENT_TYPE, "Catchment {}".format(12100000 + i), rng.uniform(1e5, 1e6))
+            writer.within(catchment, river_regions[i % len(river_regions)])
+
+        intersections = 0
+        for meshblock in meshblocks:
+            for catchment in rng.sample(catchments, min(len(catchments), rng.randint(1, 3))):
+                if rng.random() < 0.2:
+                    writer.statement(meshblock, GEO + "sfWithin", catchment, MB16CC)
+                    writer.statement(catchment, GEO + "sfContains", meshblock, MB16CC)
+                    continue
+                writer.statement(meshblock, GEO + "sfOverlaps", catchment, MB16CC)
+                writer.statement(catchment, GEO + "sfOverlaps", meshblock, MB16CC)
+                intersection = "{}/i/{}".format(MB16CC, intersections)
+                intersections += 1
+                writer.area(intersection, rng.uniform(1e2, 1e4))
+                writer.statement(meshblock, GEO + "sfContains", intersection, MB16CC)
+                writer.statement(catchment, GEO + "sfContains", intersection, MB16CC)
+
+    with open(labels_path, 'w', encoding='utf-8') as labels_file:
+        for uri, label in labels:
+            labels_file.write(json.dumps({"location_uri": uri, "label": label}) + "\n")
+    manifest = {
+        'scale': scale,
+        'seed': seed,
+        'ntriples': ntriples_path,
+        'labels': labels_path,
+        'sa2s': sa2s,
+        'sa1s': sa1s,
+        'meshblocks': meshblocks,
+        'catchments': catchments,
+        'river_regions': river_regions,
+    }
+    with open(os.path.join(directory, "manifest.json"), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return manifest
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Benchmark every API route against the local stand-in upstreams.
+
+Generates the fixture and, if numpy is installed, a label index of its labels, starts standin.py and app.py
+(with TRIPLESTORE_CACHE_URL, GEOM_DATA_SVC_ENDPOINT and ES_URL pointed at the stand-in), then makes each scenario's requests at the given concurrency and reports
+p50/p95/p99 latency and throughput for each scenario, and the peak RSS of the API's processes.
+
+Results are compared with a saved baseline, and a scenario is a regression if its p95 latency is higher, or
+its throughput lower, than the baseline's by more than the tolerance.
+
+    python -m benchmark.run --save-baseline
+    python -m benchmark.run --compare
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from aiohttp import ClientSession, ClientTimeout
+
+from benchmark.fixture import build_fixture, ASGS, CATCHMENT_TYPE
+from config import LINKSET_VERSION
+import label_index
+
+HERE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(HERE_DIR)
+BASELINE_PATH = os.path.join(HERE_DIR, "baseline.json")
+API_PREFIX = "/api/v1"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """
+    :return: the nearest-rank percentile of sorted values
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, int(math.ceil(fraction * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+def process_tree(pid):
+    """
+    :return: pid and the pids of all its descendants (Linux only)
+    :rtype: list
+    """
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open("/proc/{}/task/{}/children".format(parent, parent)) as children_file:
+                pids.extend(int(child) for child in children_file.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_mb(pid):
+    """
+    :return: sum of the peak resident set size of pid and its descendants, in MB, or None if not known
+    """
+    total = 0
+    found = False
+    for process_id in process_tree(pid):
+        try:
+            with open("/proc/{}/status".format(process_id)) as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+                        found = True
+        except OSError:
+            pass
+    return total / 1024.0 if found else None
+
+
+def scenarios(manifest, batch_size):
+    """
+    :return: (name, method, path, params, json body) of each request to benchmark, a scenario's requests are
+     spread over the features of the fixture
+    :rtype: dict
+    """
+    sa1s, meshblocks, catchments = manifest['sa1s'], manifest['meshblocks'], manifest['catchments']
+    all_areas = {'areas': 'true', 'proportion': 'true', 'contains': 'true', 'within': 'true'}
+    batch = meshblocks[:batch_size]
+    return {
+        'linksets': [('GET', '/linksets', {}, None)],
+        'datasets': [('GET', '/datasets', {}, None)],
+        'locations': [('GET', '/locations', {'count': 100}, None)],
+        'resource': [('GET', '/resource', {'uri': uri}, None) for uri in meshblocks],
+        'within': [('GET', '/location/within', {'uri': uri}, None) for uri in meshblocks],
+        'contains': [('GET', '/location/contains', {'uri': uri}, None) for uri in sa1s],
+        'overlaps': [('GET', '/location/overlaps', dict(all_areas, uri=uri), None) for uri in meshblocks + catchments],
+        'overlaps_cursor': [('GET', '/location/overlaps', dict(all_areas, uri=uri, cursor='first'), None) for uri in catchments],
+        'overlaps_output_type': [('GET', '/location/overlaps', dict(all_areas, uri=uri, output_type=CATCHMENT_TYPE), None) for uri in meshblocks],
+        'overlaps_crosswalk': [('GET', '/location/overlaps', {'uri': uri, 'crosswalk': 'true', 'areas': 'true', 'proportion': 'true',
+                                                               'contains': 'true', 'output_type': CATCHMENT_TYPE}, None) for uri in sa1s],
+        'overlaps_batch': [('POST', '/location/overlaps/batch', all_areas, batch)],
+        'find_at_location': [('GET', '/location/find_at_location', {'lat': -35.0 + i / 1000.0, 'lon': 149.0, 'loci_type': 'any'}, None)
+                             for i in range(100)],
+        'find_at_location_batch': [('POST', '/location/find_at_location/batch', {'loci_type': 'mb'},
+                                    {'lat': [-35.0 + i / 1000.0 for i in range(batch_size)], 'lon': [149.0] * batch_size})],
+        'find_by_label': [('GET', '/location/find-by-label', {'query': "Meshblock " + uri.rsplit('/', 1)[1]}, None) for uri in meshblocks],
+        'suggest': [('GET', '/location/suggest', {'query': label[:length]}, None)
+                    for label in ("Meshblock 1000", "Statistical Area 1000", "Catchment 121") for length in range(1, len(label) + 1)],
+        'find_by_label_prefix': [('GET', '/location/find-by-label', {'query': "Statistical Area {}".format(10000 + i), 'count': 20, 'dataset': ASGS}, None)
+                                 for i in range(len(manifest['sa2s']))],
+    }
+
+
+async def run_scenario(session, base_url, requests, count, concurrency):
+    """
+    Make count requests, cycling through requests, with at most concurrency in flight
+    :return: latencies in seconds, number of failed requests, and wall time
+    :rtype: tuple
+    """
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < count:
+            method, path, params, body = requests[next_request % len(requests)]
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                async with session.request(method, base_url + API_PREFIX + path, params=params, json=body) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+async def run_benchmark(base_url, manifest, args):
+    results = {}
+    timeout = ClientTimeout(total=None, sock_read=600)
+    async with ClientSession(timeout=timeout) as session:
+        for name, requests in scenarios(manifest, args.batch_size).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            # once through every request, so the stand-in has answered each query and connections are open
+            await run_scenario(session, base_url, requests, len(requests), min(args.concurrency, len(requests)))
+            count = args.batch_requests if name.endswith("_batch") else args.requests
+            latencies, errors, wall_time = await run_scenario(session, base_url, requests, count, args.concurrency)
+            latencies.sort()
+            results[name] = {
+                'requests': count,
+                'errors': errors,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'throughput_rps': count / wall_time,
+            }
+            print("{:<24} p50 {p50_ms:9.2f} ms  p95 {p95_ms:9.2f} ms  p99 {p99_ms:9.2f} ms  {throughput_rps:9.1f} req/s  {errors} errors".format(
+                name, **results[name]), flush=True)
+    return results
+
+
+def wait_for(url, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("{} exited with {}".format(process.args, process.returncode))
+        try:
+            with urllib.request.urlopen(url, timeout=5):
+                return
+        except Exception:
+            time.sleep(0.25)
+    raise RuntimeError("{} did not start in time".format(url))
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: a description of each scenario that regressed against the baseline
+    :rtype: list
+    """
+    regressions = []
+    for name, result in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append("{}: p95 {:.2f} ms, baseline {:.2f} ms".format(name, result['p95_ms'], base['p95_ms']))
+        if result['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} req/s, baseline {:.1f} req/s".format(name, result['throughput_rps'], base['throughput_rps']))
+        if result['errors'] > base['errors']:
+            regressions.append("{}: {} errors, baseline {}".format(name, result['errors'], base['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API against local stand-in upstreams")
+    parser.add_argument("--scale", type=int, default=4, help="Fixture size, in SA2s of 40 meshblocks (default 4)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once (default 16)")
+    parser.add_argument("--requests", type=int, default=500, help="Requests made for each scenario (default 500)")
+    parser.add_argument("--batch-requests", type=int, default=20, help="Requests made for each batch scenario (default 20)")
+    parser.add_argument("--batch-size", type=int, default=50, help="Uris or points in each batch request (default 50)")
+    parser.add_argument("--workers", type=int, default=1, help="API_WORKERS of the API (default 1)")
+    parser.add_argument("--scenarios", nargs="+", help="Only run these scenarios")
+    parser.add_argument("--response-cache", action="store_true", help="Leave the response cache on")
+    parser.add_argument("--no-label-index", action="store_true", help="Don't build a label index, so suggest uses the label search")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline results (default benchmark/baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare with the baseline, exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed change from the baseline (default 0.2)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="loci-benchmark-")
+    manifest = build_fixture(work_dir, args.scale, args.seed)
+    label_index_path = ""
+    if not args.no_label_index and label_index.np is not None:
+        label_index_path = os.path.join(work_dir, "labels")
+        label_index.LabelIndex.build(label_index_path, label_index.read_location_labels(manifest['labels']),
+                                     linkset_version=LINKSET_VERSION)
+    standin_port = free_port()
+    api_port = free_port()
+    standin_url = "http://127.0.0.1:{}".format(standin_port)
+    env = dict(os.environ, TRIPLESTORE_CACHE_URL="http://127.0.0.1", TRIPLESTORE_CACHE_PORT=str(standin_port),
+               GEOM_DATA_SVC_ENDPOINT=standin_url, ES_URL="http://127.0.0.1", ES_PORT=str(standin_port),
+               LISTEN_HOST="127.0.0.1", LISTEN_PORT=str(api_port), API_WORKERS=str(args.workers),
+               API_ACCESS_LOG="false", API_DEBUG="false", CROSSWALK_STORE_PATH="", LABEL_INDEX_PATH=label_index_path,
+               LINKSET_VERSION=LINKSET_VERSION)
+    if not args.response_cache:
+        env['RESPONSE_CACHE_SIZE'] = "0"
+    standin = subprocess.Popen([sys.executable, "-m", "benchmark.standin", "--ntriples", manifest['ntriples'],
+                                "--labels", manifest['labels'], "--port", str(standin_port)], cwd=REPO_DIR)
+    api = None
+    try:
+        wait_for(standin_url + "/_search?q=", standin)
+        api = subprocess.Popen([sys.executable, "app.py"], cwd=REPO_DIR, env=env)
+        base_url = "http://127.0.0.1:{}".format(api_port)
+        wait_for(base_url + "/", api)
+        loop = asyncio.get_event_loop()
+        scenario_results = loop.run_until_complete(run_benchmark(base_url, manifest, args))
+        rss = peak_rss_mb(api.pid)
+    finally:
+        for process in (api, standin):
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+    results = {
+        'meta': {
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'scale': args.scale,
+            'seed': args.seed,
+            'concurrency': args.concurrency,
+            'workers': args.workers,
+            'response_cache': args.response_cache,
+            'label_index': bool(label_index_path),
+        },
+        'peak_rss_mb': rss,
+        'scenarios': scenario_results,
+    }
+    if rss is not None:
+        print("peak RSS {:.1f} MB".format(rss))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1)
+        print("baseline saved to {}".format(args.baseline))
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A local stand-in for the API's upstream services, serving a fixture written by fixture.py:
+
+ * the GraphDB repository at /repositories/loci-cache, answering SPARQL from an rdflib graph in
+   text/tab-separated-values or application/sparql-results+json, with GraphDB's limit and offset parameters
+ * the geometry data service's /search/latlng/{lon},{lat}, which returns a meshblock of the fixture picked
+   from the point
+ * Elasticsearch's /_search?q=, and the query DSL label_search.py sends to /{index}/{type}/_search, matching
+   the fixture's labels
+
+The fixture doesn't change, so query results are kept after the first time a query is answered and the
+benchmark measures the API rather than rdflib.
+
+Needs rdflib (see requirements.txt).
+"""
+import argparse
+import json
+from collections import OrderedDict
+from aiohttp import web
+from rdflib import Graph, URIRef, BNode
+
+TSV_MEDIA_TYPE = "text/tab-separated-values"
+JSON_MEDIA_TYPE = "application/sparql-results+json"
+#Number of distinct query results kept
+RESULT_CACHE_SIZE = 10000
+
+
+def tsv_term(term):
+    if term is None:
+        return ""
+    if isinstance(term, URIRef):
+        return "<{}>".format(term)
+    if isinstance(term, BNode):
+        return "_:{}".format(term)
+    value = str(term).replace('\\', '\\\\').replace('"', '\\"').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    if term.language:
+        return '"{}"@{}'.format(value, term.language)
+    if term.datatype:
+        return '"{}"^^<{}>'.format(value, term.datatype)
+    return '"{}"'.format(value)
+
+
+def json_term(term):
+    if isinstance(term, URIRef):
+        return {'type': 'uri', 'value': str(term)}
+    if isinstance(term, BNode):
+        return {'type': 'bnode', 'value': str(term)}
+    json_literal = {'type': 'literal', 'value': str(term)}
+    if term.language:
+        json_literal['xml:lang'] = term.language
+    elif term.datatype:
+        json_literal['datatype'] = str(term.datatype)
+    return json_literal
+
+
+class StandIn(object):
+    def __init__(self, ntriples_path, labels_path):
+        self.graph = Graph()
+        self.graph.parse(ntriples_path, format='nt')
+        self.labels = []
+        with open(labels_path, encoding='utf-8') as labels_file:
+            for line in labels_file:
+                if line.strip():
+                    location = json.loads(line)
+                    self.labels.append((location['location_uri'], location['label']))
+        self.meshblocks = sorted(uri for uri, label in self.labels if "/meshblock/" in uri)
+        self.catchments = sorted(uri for uri, label in self.labels if "/contractedcatchment/" in uri)
+        self._results = OrderedDict()
+        self.queries = 0
+
+    def query(self, sparql):
+        """
+        :return: the variables and rows of a query
+        :rtype: tuple
+        """
+        self.queries += 1
+        try:
+            self._results.move_to_end(sparql)
+            return self._results[sparql]
+        except KeyError:
+            pass
+        result = self.graph.query(sparql)
+        variables = [str(var) for var in result.vars]
+        rows = [tuple(row) for row in result]
+        self._results[sparql] = (variables, rows)
+        while len(self._results) > RESULT_CACHE_SIZE:
+            self._results.popitem(last=False)
+        return variables, rows
+
+    async def sparql(self, request):
+        form = await request.post()
+        query = form.get('query') or request.query.get('query')
+        if not query:
+            return web.Response(status=400, text="No query")
+        try:
+            variables, rows = self.query(query)
+        except Exception as e:
+            return web.Response(status=400, text="Query failed: {}".format(e))
+        offset = int(form.get('offset', request.query.get('offset', 0)))
+        limit = form.get('limit', request.query.get('limit'))
+        rows = rows[offset:] if limit is None else rows[offset:offset + int(limit)]
+        if request.headers.get('Accept', '').startswith(TSV_MEDIA_TYPE):
+            lines = ["\t".join("?" + var for var in variables)]
+            lines.extend("\t".join(tsv_term(term) for term in row) for row in rows)
+            return web.Response(text="\n".join(lines) + "\n", content_type=TSV_MEDIA_TYPE)
+        bindings = [{var: json_term(term) for var, term in zip(variables, row) if term is not None} for row in rows]
+        body = {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+        return web.Response(text=json.dumps(body), content_type=JSON_MEDIA_TYPE)
+
+    async def search_latlng(self, request):
+        lon, lat = (float(value) for value in request.match_info['lonlat'].split(','))
+        dataset = request.match_info.get('dataset', 'any')
+        res = []
+        if dataset in ('any', 'mb') and self.meshblocks:
+            res.append({'dataset': 'mb', 'feature': self.meshblocks[hash((lon, lat)) % len(self.meshblocks)]})
+        if dataset in ('any', 'cc') and self.catchments:
+            res.append({'dataset': 'cc', 'feature': self.catchments[hash((lat, lon)) % len(self.catchments)]})
+        return web.json_response({'count': len(res), 'res': res})
+
+    async def search_labels(self, request):
+        q = request.query.get('q', '').lower()
+        size = int(request.query.get('size', 10))
+        offset = int(request.query.get('from', 0))
+        matches = [(uri, label) for uri, label in self.labels if q in label.lower()]
+        hits = [{'_index': "default_index", '_type': "location", '_id': uri, '_score': 1.0,
+                 '_source': {'uri': uri, 'label': label}} for uri, label in matches[offset:offset + size]]
+        return web.json_response({
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': len(matches), 'max_score': 1.0 if hits else None, 'hits': hits},
+        })
+
+    def match_labels(self, query, dataset_prefix=None):
+        """
+        Match labels the way label_search.py's query does with the standard analyzer: every word of the query
+        is a word of the label, the last one may be the start of a word
+        :return: (uri, label) of each match, sorted by uri
+        :rtype: list
+        """
+        words = query.lower().split()
+        if not words:
+            return []
+        matches = []
+        for uri, label in self.labels:
+            if dataset_prefix and not uri.startswith(dataset_prefix):
+                continue
+            label_words = label.lower().split()
+            if all(word in label_words for word in words[:-1]) and any(label_word.startswith(words[-1]) for label_word in label_words):
+                matches.append((uri, label))
+        matches.sort()
+        return matches
+
+    async def search_label_dsl(self, request):
+        body = await request.json()
+        bool_query = body['query']['bool']
+        query = bool_query['should'][0]['match']['label']['query']
+        dataset_prefix = None
+        for query_filter in bool_query.get('filter', []):
+            dataset_prefix = query_filter['prefix']['uri.keyword']
+        matches = self.match_labels(query, dataset_prefix)
+        size = int(body.get('size', 10))
+        if 'search_after' in body:
+            after = body['search_after'][-1]
+            matches_after = [match for match in matches if match[0] > after]
+            page = matches_after[:size]
+        else:
+            offset = int(body.get('from', 0))
+            page = matches[offset:offset + size]
+        hits = [{'_index': request.match_info['index'], '_type': "location", '_id': uri, '_score': 1.0,
+                 '_source': {'uri': uri, 'label': label}, 'sort': [1.0, uri]} for uri, label in page]
+        return web.json_response({
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+            'hits': {'total': len(matches), 'max_score': None, 'hits': hits},
+        })
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/repositories/loci-cache', self.sparql)
+        app.router.add_get('/repositories/loci-cache', self.sparql)
+        app.router.add_get('/search/latlng/{lonlat}', self.search_latlng)
+        app.router.add_get('/search/latlng/{lonlat}/dataset/{dataset}', self.search_latlng)
+        app.router.add_get('/_search', self.search_labels)
+        app.router.add_post('/{index}/_search', self.search_label_dsl)
+        app.router.add_post('/{index}/{type}/_search', self.search_label_dsl)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a benchmark fixture as GraphDB, the geometry data service and Elasticsearch")
+    parser.add_argument("--ntriples", required=True, help="N-Triples file of the fixture")
+    parser.add_argument("--labels", required=True, help="location_labels.jsonl of the fixture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7200)
+    args = parser.parse_args()
+    stand_in = StandIn(args.ntriples, args.labels)
+    print("{} triples and {} labels loaded".format(len(stand_in.graph), len(stand_in.labels)), flush=True)
+    web.run_app(stand_in.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
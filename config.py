@@ -8,14 +8,110 @@ TRIPLESTORE_CACHE_URL = os.environ.get('TRIPLESTORE_CACHE_URL')
 if TRIPLESTORE_CACHE_URL is None or TRIPLESTORE_CACHE_URL == '':
     TRIPLESTORE_CACHE_URL = CONFIG["TRIPLESTORE_CACHE_URL"] = "http://db.loci.cat"
 #TRIPLESTORE_CACHE_URL = CONFIG["TRIPLESTORE_CACHE_URL"] = "http://db.loci.cat"
-TRIPLESTORE_CACHE_PORT = CONFIG["TRIPLESTORE_CACHE_PORT"] = "80"
+TRIPLESTORE_CACHE_PORT = CONFIG["TRIPLESTORE_CACHE_PORT"] = os.environ.get('TRIPLESTORE_CACHE_PORT', "80")
 TRIPLESTORE_CACHE_SPARQL_ENDPOINT = CONFIG["TRIPLESTORE_CACHE_SPARQL_ENDPOINT"] = \
     "{}:{}/repositories/loci-cache".format(TRIPLESTORE_CACHE_URL, TRIPLESTORE_CACHE_PORT)
 
-ES_URL = CONFIG["ES_URL"] = "http://elasticsearch"
-ES_PORT = CONFIG["ES_ENDPOINT"] = "9200"
+ES_URL = CONFIG["ES_URL"] = os.environ.get('ES_URL', "http://elasticsearch")
+ES_PORT = CONFIG["ES_ENDPOINT"] = os.environ.get('ES_PORT', "9200")
 ES_ENDPOINT = CONFIG["ES_ENDPOINT"] = \
     "{}:{}/_search".format(ES_URL, ES_PORT)
+# Index, and mapping type, search/process.sh loads the location labels into. Leave the type empty for Elasticsearch 7 and later
+ES_INDEX = CONFIG["ES_INDEX"] = os.environ.get('ES_INDEX', "default_index")
+ES_DOC_TYPE = CONFIG["ES_DOC_TYPE"] = os.environ.get('ES_DOC_TYPE', "location")
+ES_LABEL_SEARCH_ENDPOINT = CONFIG["ES_LABEL_SEARCH_ENDPOINT"] = \
+    "/".join(part for part in ("{}:{}".format(ES_URL, ES_PORT), ES_INDEX, ES_DOC_TYPE, "_search") if part)
+# Most locations one label search returns, and the longest query text it accepts
+LABEL_SEARCH_MAX_COUNT = CONFIG["LABEL_SEARCH_MAX_COUNT"] = int(os.environ.get('LABEL_SEARCH_MAX_COUNT', 100))
+LABEL_SEARCH_MAX_QUERY_LENGTH = CONFIG["LABEL_SEARCH_MAX_QUERY_LENGTH"] = int(os.environ.get('LABEL_SEARCH_MAX_QUERY_LENGTH', 200))
+# In-process cache of label search results, keyed on query and page, 0 turns it off
+LABEL_SEARCH_CACHE_SIZE = CONFIG["LABEL_SEARCH_CACHE_SIZE"] = int(os.environ.get('LABEL_SEARCH_CACHE_SIZE', 10000))
+# Seconds before a cached label search result is considered stale
+LABEL_SEARCH_CACHE_TTL = CONFIG["LABEL_SEARCH_CACHE_TTL"] = float(os.environ.get('LABEL_SEARCH_CACHE_TTL', 3600))
 
 
-GEOM_DATA_SVC_ENDPOINT = CONFIG["GEOM_DATA_SVC_ENDPOINT"] = "https://gds.loci.cat"
+GEOM_DATA_SVC_ENDPOINT = CONFIG["GEOM_DATA_SVC_ENDPOINT"] = os.environ.get('GEOM_DATA_SVC_ENDPOINT', "https://gds.loci.cat")
+# Local geometry files for find_at_location, keyed on loci_type. Datasets without a file use the geometry data service
+LOCAL_GEOMETRY_PATHS = CONFIG["LOCAL_GEOMETRY_PATHS"] = {
+    'mb': os.environ.get('LOCAL_GEOMETRY_MB_PATH', ''),
+    'cc': os.environ.get('LOCAL_GEOMETRY_CC_PATH', ''),
+}
+# Maximum number of geometry data service requests a batch find_at_location has in flight at once
+GEOM_DATA_SVC_CONCURRENCY = CONFIG["GEOM_DATA_SVC_CONCURRENCY"] = int(os.environ.get('GEOM_DATA_SVC_CONCURRENCY', 32))
+
+# In-process cache of rdf:type lookups, keyed on resource uri
+TYPE_CACHE_SIZE = CONFIG["TYPE_CACHE_SIZE"] = int(os.environ.get('TYPE_CACHE_SIZE', 200000))
+# Seconds before a cached rdf:type lookup is considered stale
+TYPE_CACHE_TTL = CONFIG["TYPE_CACHE_TTL"] = float(os.environ.get('TYPE_CACHE_TTL', 86400))
+
+# Maximum number of SPARQL requests a single crosswalk has in flight at once
+CROSSWALK_CONCURRENCY = CONFIG["CROSSWALK_CONCURRENCY"] = int(os.environ.get('CROSSWALK_CONCURRENCY', 8))
+
+# Version of the loaded linkset release, stored crosswalk results from any other version are discarded
+LINKSET_VERSION = CONFIG["LINKSET_VERSION"] = os.environ.get('LINKSET_VERSION', '1')
+# Path of the SQLite crosswalk result store, crosswalk results are not persisted if this is empty
+CROSSWALK_STORE_PATH = CONFIG["CROSSWALK_STORE_PATH"] = os.environ.get('CROSSWALK_STORE_PATH', '')
+
+# Connection pool of each upstream service: total connections, connections per host,
+# and seconds to wait for the next read of a response before giving up on it
+UPSTREAM_POOLS = CONFIG["UPSTREAM_POOLS"] = {
+    'graphdb': {
+        'limit': int(os.environ.get('GRAPHDB_POOL_LIMIT', 64)),
+        'limit_per_host': int(os.environ.get('GRAPHDB_POOL_LIMIT_PER_HOST', 64)),
+        'read_timeout': float(os.environ.get('GRAPHDB_READ_TIMEOUT', 1200)),
+    },
+    'gds': {
+        'limit': int(os.environ.get('GEOM_DATA_SVC_POOL_LIMIT', 64)),
+        'limit_per_host': int(os.environ.get('GEOM_DATA_SVC_POOL_LIMIT_PER_HOST', 32)),
+        'read_timeout': float(os.environ.get('GEOM_DATA_SVC_READ_TIMEOUT', 60)),
+    },
+    'es': {
+        'limit': int(os.environ.get('ES_POOL_LIMIT', 32)),
+        'limit_per_host': int(os.environ.get('ES_POOL_LIMIT_PER_HOST', 32)),
+        'read_timeout': float(os.environ.get('ES_READ_TIMEOUT', 30)),
+    },
+}
+# Seconds to wait for a connection to an upstream service to open
+UPSTREAM_CONNECT_TIMEOUT = CONFIG["UPSTREAM_CONNECT_TIMEOUT"] = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10))
+# Seconds an idle upstream connection is kept open for reuse
+UPSTREAM_KEEPALIVE_TIMEOUT = CONFIG["UPSTREAM_KEEPALIVE_TIMEOUT"] = float(os.environ.get('UPSTREAM_KEEPALIVE_TIMEOUT', 30))
+# Seconds upstream host name lookups are cached for
+UPSTREAM_DNS_CACHE_TTL = CONFIG["UPSTREAM_DNS_CACHE_TTL"] = int(os.environ.get('UPSTREAM_DNS_CACHE_TTL', 300))
+
+# Number of API responses kept by the response cache, 0 turns response caching off
+RESPONSE_CACHE_SIZE = CONFIG["RESPONSE_CACHE_SIZE"] = int(os.environ.get('RESPONSE_CACHE_SIZE', 2000))
+# Path of a SQLite file to keep cached responses in, shared by all workers. Responses are kept in memory if this is empty
+RESPONSE_CACHE_PATH = CONFIG["RESPONSE_CACHE_PATH"] = os.environ.get('RESPONSE_CACHE_PATH', '')
+# Largest response body, in bytes, the response cache will keep
+RESPONSE_CACHE_MAX_BODY = CONFIG["RESPONSE_CACHE_MAX_BODY"] = int(os.environ.get('RESPONSE_CACHE_MAX_BODY', 4 * 1024 * 1024))
+# Cache-Control header sent with API responses, keyed on route path prefix, the longest matching prefix is used
+RESPONSE_CACHE_CONTROL = CONFIG["RESPONSE_CACHE_CONTROL"] = {
+    'default': os.environ.get('RESPONSE_CACHE_CONTROL', "public, max-age=86400"),
+    '/api/v1/location/find-by-label': "public, max-age=3600",
+    '/api/v1/location/suggest': "public, max-age=3600",
+}
+
+# Path of the within/contains closure index built by hierarchy_index.py, /location/within and /location/contains
+# are answered by the triplestore if this is empty
+HIERARCHY_INDEX_PATH = CONFIG["HIERARCHY_INDEX_PATH"] = os.environ.get('HIERARCHY_INDEX_PATH', '')
+
+# Directory of the linkset snapshot exported by linkset_store.py, overlaps are answered by the triplestore if this is empty
+LINKSET_STORE_PATH = CONFIG["LINKSET_STORE_PATH"] = os.environ.get('LINKSET_STORE_PATH', '')
+
+# Directory of the label prefix index built by label_index.py, /location/suggest uses the label search if this is empty
+LABEL_INDEX_PATH = CONFIG["LABEL_INDEX_PATH"] = os.environ.get('LABEL_INDEX_PATH', '')
+
+# Host and port the API listens on
+LISTEN_HOST = CONFIG["LISTEN_HOST"] = os.environ.get('LISTEN_HOST', "0.0.0.0")
+LISTEN_PORT = CONFIG["LISTEN_PORT"] = int(os.environ.get('LISTEN_PORT', 8080))
+# Number of API worker processes, each running its own event loop. 0 starts one for each CPU core
+API_WORKERS = CONFIG["API_WORKERS"] = int(os.environ.get('API_WORKERS', 1))
+# Run Sanic in debug mode, for development only
+API_DEBUG = CONFIG["API_DEBUG"] = os.environ.get('API_DEBUG', 'false').lower() in ('1', 'true', 'yes')
+# Log every request served
+API_ACCESS_LOG = CONFIG["API_ACCESS_LOG"] = os.environ.get('API_ACCESS_LOG', 'true').lower() in ('1', 'true', 'yes')
+# Directory the API workers share their metrics in, so /metrics reports those of every worker.
+# A temporary directory is used if this is empty and there is more than one worker
+METRICS_DIR = CONFIG["METRICS_DIR"] = os.environ.get('METRICS_DIR', '')
+# Git commit of the running code, if empty it is read from the GIT_LABEL file written when the image was built
+GIT_LABEL = CONFIG["GIT_LABEL"] = os.environ.get('GIT_LABEL', '')
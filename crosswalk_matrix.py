@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Vectorised aggregation of crosswalk results.
+
+A crosswalk walks from the base units of the from feature (with the area of the from feature in each) to the
+base units they overlap in the other ("to") hierarchy, and on to the parents of those base units. Over
+interned uri ids that is a pair of sparse products,
+
+    to base unit sums = incoming areas x (from base unit -> to base unit percentages)
+    parent sums       = to base unit sums x (to base unit -> parent)
+
+The matrices are held as COO edge arrays and each product is a single numpy.bincount, so the walk is one
+vectorised pass however many base units and parents it passes through. Only the edges themselves, one per
+distinct overlap and one per distinct parent, are gathered in Python.
+
+A recorded step replaces whatever the walk has reached of its feature so far, and what the walk reaches of
+it afterwards is added to the record, unless the walk finds it with only its uri known.
+
+The results come out in the order a sequential walk would first reach each feature, with the feature area
+it would have recorded for it. Sums are added in a different order so may differ in the last few bits.
+"""
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from uri_table import CrosswalkParent, NAN
+
+
+def aggregate_crosswalk(uri_table, steps, to_base_units, found_parents, type_matches):
+    """
+    :param steps: the walk of the from feature in order, each step is either a (base uri id, incoming area) pair
+     or a CrosswalkParent to record as it is
+    :type steps: list
+    :param to_base_units: dict of from base uri id to its list of (OverlapRecord, resource type prefix) of the
+     "to" base units it overlaps
+    :param found_parents: dict of "to" base uri id to (area, OverlapRecords of its parents)
+    :param type_matches: dict of "to" base uri id to whether it is already of the output type
+    :return: dict of uri id to CrosswalkParent, in the order the walk first reaches them
+    :rtype: dict
+    """
+    # one pair for each distinct (from base unit, to base unit) overlap, and one for each recorded step
+    pairs = []
+    # for each from base unit, its (first pair, number of pairs)
+    from_pairs = {}
+    recorded = {}
+    # the last step recording each recorded feature, the walk adds only what it reaches after it to the record
+    record_steps = {}
+    step_start = []
+    step_len = []
+    step_area = []
+    step_walked = []
+    for step in steps:
+        if isinstance(step, CrosswalkParent):
+            recorded[step.uri_id] = step
+            record_steps[step.uri_id] = len(step_start)
+            step_start.append(len(pairs))
+            step_len.append(1)
+            step_area.append(NAN)
+            step_walked.append(False)
+            pairs.append((step, None))
+            continue
+        from_base_id, area_incoming = step
+        try:
+            start, count = from_pairs[from_base_id]
+        except KeyError:
+            units = to_base_units[from_base_id]
+            start, count = from_pairs[from_base_id] = (len(pairs), len(units))
+            pairs.extend(units)
+        step_start.append(start)
+        step_len.append(count)
+        step_area.append(area_incoming)
+        step_walked.append(True)
+    size = len(uri_table)
+    pair_to = np.fromiter((record.uri_id for record, prefix in pairs), dtype=np.int64, count=len(pairs))
+    pair_percentage = np.fromiter((record.forward_percentage for record, prefix in pairs), dtype=np.float64, count=len(pairs))
+    pair_area = np.fromiter((record.feature_area for record, prefix in pairs), dtype=np.float64, count=len(pairs))
+    prefixes = {None: 0}
+    pair_prefix = np.fromiter((prefixes.setdefault(prefix, len(prefixes)) for record, prefix in pairs), dtype=np.int64, count=len(pairs))
+    prefixes = {code: prefix for prefix, code in prefixes.items()}
+
+    # parents CSR, one group for each distinct ("to" base unit, resource type prefix) walked through to its parents,
+    # to base units that are already of the output type are the "parent"
+    matched = np.array([uri_id for uri_id, is_match in type_matches.items() if is_match], dtype=np.int64)
+    has_parents = (pair_prefix > 0) & ~np.isin(pair_to, matched)
+    pair_group = np.full(len(pairs), -1, dtype=np.int64)
+    group_keys, pair_group[has_parents] = np.unique(pair_to[has_parents] * len(prefixes) + pair_prefix[has_parents], return_inverse=True)
+    parent_ptr = [0]
+    parent_ids = []
+    parent_areas = []
+    parent_detailed = []
+    for group_key in group_keys.tolist():
+        to_base_id, prefix_code = divmod(group_key, len(prefixes))
+        resource_type_prefix = prefixes[prefix_code]
+        for an_within in found_parents[to_base_id][1]:
+            # exclude things that contain this base unit but aren't in the same spatial hierarchy
+            if not uri_table.uri_contains(an_within.uri_id, resource_type_prefix):
+                continue
+            parent_ids.append(an_within.uri_id)
+            parent_areas.append(an_within.feature_area)
+            parent_detailed.append(an_within.detailed)
+        parent_ptr.append(len(parent_ids))
+    groups = len(group_keys)
+    parent_ptr = np.array(parent_ptr, dtype=np.int64)
+    parent_ids = np.array(parent_ids, dtype=np.int64)
+    parent_areas = np.array(parent_areas, dtype=np.float64)
+    parent_detailed = np.array(parent_detailed, dtype=bool)
+    step_start = np.array(step_start, dtype=np.int64)
+    step_len = np.array(step_len, dtype=np.int64)
+    step_area = np.array(step_area, dtype=np.float64)
+    step_walked = np.array(step_walked, dtype=bool)
+    # number of parents of each group, and none for pairs without a group (-1)
+    group_parent_counts = np.append(np.diff(parent_ptr), 0)
+
+    # expand the steps into the walk's visits of pairs, in order
+    visit_pair = np.repeat(step_start - (np.cumsum(step_len) - step_len), step_len) + np.arange(step_len.sum())
+    visit_area = np.repeat(step_area, step_len)
+    visit_group = pair_group[visit_pair]
+    is_walked = np.repeat(step_walked, step_len)
+    contribution = pair_percentage[visit_pair] / 100 * visit_area
+
+    # to base unit sums, then parent sums through each group's parents
+    sums = np.bincount(pair_to[visit_pair[is_walked]], weights=contribution[is_walked], minlength=size)
+    has_group = visit_group >= 0
+    group_sums = np.bincount(visit_group[has_group], weights=contribution[has_group], minlength=groups)
+    parent_group = np.repeat(np.arange(groups), group_parent_counts[:-1])
+    sums += np.bincount(parent_ids, weights=group_sums[parent_group], minlength=size)
+
+    # every feature reached by the walk, in visit order: each pair's to base unit, then its parents
+    parent_counts = group_parent_counts[visit_group]
+    reached_counts = 1 + parent_counts
+    reached_start = np.cumsum(reached_counts) - reached_counts
+    reached_ids = np.empty(reached_counts.sum(), dtype=np.int64)
+    reached_areas = np.empty(len(reached_ids), dtype=np.float64)
+    reached_ids[reached_start] = pair_to[visit_pair]
+    reached_areas[reached_start] = pair_area[visit_pair]
+    parent_visit = np.repeat(np.arange(len(visit_pair)), parent_counts)
+    parent_index = np.arange(len(parent_visit)) - np.repeat(np.cumsum(parent_counts) - parent_counts, parent_counts)
+    parent_source = parent_ptr[visit_group[parent_visit]] + parent_index
+    reached_ids[reached_start[parent_visit] + 1 + parent_index] = parent_ids[parent_source]
+    reached_areas[reached_start[parent_visit] + 1 + parent_index] = parent_areas[parent_source]
+    # parents which were found with only their uris known have every value unknown, from the last step they were
+    # reached in
+    visit_step = np.repeat(np.arange(len(step_len)), step_len)
+    unknown_source = ~parent_detailed[parent_source]
+    unknown_step = np.full(size, -1, dtype=np.int64)
+    np.maximum.at(unknown_step, parent_ids[parent_source[unknown_source]], visit_step[parent_visit[unknown_source]])
+
+    # what the walk adds to each record after its last record step
+    recorded_sums = None
+    if record_steps:
+        last_record = np.full(size, len(step_len), dtype=np.int64)
+        last_record[np.fromiter(record_steps.keys(), dtype=np.int64, count=len(record_steps))] = list(record_steps.values())
+        reached_step = np.repeat(visit_step, reached_counts)
+        reached_contribution = np.repeat(np.where(is_walked, contribution, 0.0), reached_counts)
+        after_record = reached_step > last_record[reached_ids]
+        recorded_sums = np.bincount(reached_ids[after_record], weights=reached_contribution[after_record], minlength=size)
+
+    reached, first = np.unique(reached_ids, return_index=True)
+    order = np.argsort(first, kind='stable')
+    parent_amount = {}
+    for uri_id, feature_area in zip(reached[order].tolist(), reached_areas[first[order]].tolist()):
+        if uri_id in recorded and unknown_step[uri_id] < record_steps[uri_id]:
+            record = recorded[uri_id]
+            parent_amount[uri_id] = CrosswalkParent(uri_id, record.intersection_area + float(recorded_sums[uri_id]),
+                                                    record.feature_area, record.forward_percentage,
+                                                    record.reverse_percentage, from_overlap=record.from_overlap)
+        elif unknown_step[uri_id] >= 0:
+            parent_amount[uri_id] = CrosswalkParent(uri_id, NAN, NAN, NAN, NAN)
+        else:
+            parent_amount[uri_id] = CrosswalkParent(uri_id, float(sums[uri_id]), feature_area)
+    return parent_amount
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Persistent on-disk store of crosswalk results.
+
+The linksets a crosswalk is computed over (mb16cc, addr1605mb16, addrcatch) are static releases, so a
+crosswalk result only changes when they are reloaded. Results are kept in SQLite, keyed on the from uri,
+output type and include flags, and the whole store is emptied when it is opened against a different
+LINKSET_VERSION.
+
+Run this module to precompute crosswalks for every ASGS and Geofabric parent feature:
+
+    python3 crosswalk_store.py --proportion --areas
+"""
+import argparse
+import asyncio
+import sqlite3
+from json import dumps, loads
+
+ASGS_PARENT_TYPES = [
+    "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel1",
+    "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel2",
+    "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel3",
+    "http://linked.data.gov.au/def/asgs#StatisticalAreaLevel4",
+    "http://linked.data.gov.au/def/asgs#StateOrTerritory",
+]
+GEOFABRIC_PARENT_TYPES = [
+    "http://linked.data.gov.au/def/geofabric#RiverRegion",
+    "http://linked.data.gov.au/def/geofabric#DrainageDivision",
+]
+# A crosswalk from a parent feature in one hierarchy goes to feature types in the other hierarchy
+CROSSWALK_OUTPUT_TYPES = {
+    "http://linked.data.gov.au/def/asgs": [
+        "http://linked.data.gov.au/def/geofabric#ContractedCatchment",
+    ] + GEOFABRIC_PARENT_TYPES,
+    "http://linked.data.gov.au/def/geofabric": [
+        "http://linked.data.gov.au/def/asgs#MeshBlock",
+    ] + ASGS_PARENT_TYPES,
+}
+
+
+class CrosswalkStore(object):
+    """
+    SQLite backed store of (meta, overlaps) crosswalk results
+    """
+    def __init__(self, path, linkset_version):
+        self.path = path
+        self.linkset_version = str(linkset_version)
+        # sqlite calls are short primary key lookups, so they are made directly from the event loop
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL lets every API worker process read while the precompute job writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS crosswalk ("
+            "from_uri TEXT, output_type TEXT, include_areas INTEGER, include_proportion INTEGER, "
+            "include_contains INTEGER, include_within INTEGER, result TEXT, "
+            "PRIMARY KEY (from_uri, output_type, include_areas, include_proportion, include_contains, include_within)"
+            ") WITHOUT ROWID")
+        self._check_version()
+
+    def _check_version(self):
+        row = self._conn.execute("SELECT value FROM store_meta WHERE key = 'linkset_version'").fetchone()
+        if row is not None and row[0] == self.linkset_version:
+            return
+        # the linksets have been reloaded since these results were computed
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("DELETE FROM crosswalk")
+            self._conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('linkset_version', ?)",
+                               (self.linkset_version,))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _key(from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains, include_within):
+        return (str(from_uri), output_featuretype_uri or "", int(bool(include_areas)), int(bool(include_proportion)),
+                int(bool(include_contains)), int(bool(include_within)))
+
+    def get(self, from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains, include_within):
+        """
+        :return: the stored (meta, overlaps), or None if this crosswalk has not been stored
+        :rtype: tuple
+        """
+        key = self._key(from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains,
+                        include_within)
+        row = self._conn.execute(
+            "SELECT result FROM crosswalk WHERE from_uri = ? AND output_type = ? AND include_areas = ? AND "
+            "include_proportion = ? AND include_contains = ? AND include_within = ?", key).fetchone()
+        if row is None:
+            return None
+        result = loads(row[0])
+        return result['meta'], result['overlaps']
+
+    def put(self, from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains,
+            include_within, meta, overlaps):
+        key = self._key(from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains,
+                        include_within)
+        result = dumps({'meta': meta, 'overlaps': overlaps}, default=str)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO crosswalk (from_uri, output_type, include_areas, include_proportion, "
+            "include_contains, include_within, result) VALUES (?, ?, ?, ?, ?, ?, ?)", key + (result,))
+
+    def __contains__(self, key):
+        row = self._conn.execute(
+            "SELECT 1 FROM crosswalk WHERE from_uri = ? AND output_type = ? AND include_areas = ? AND "
+            "include_proportion = ? AND include_contains = ? AND include_within = ?", self._key(*key)).fetchone()
+        return row is not None
+
+    def close(self):
+        self._conn.close()
+
+
+async def get_features_of_type(featuretype_uri, page_size=10000):
+    """
+    :return: uris of all features of the given type
+    :rtype: list
+    """
+    from functions import iter_graphdb_bindings, fill_cursor
+    sparql = """\
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+SELECT DISTINCT ?f WHERE { ?f rdf:type <TYPE> <CURSOR_FILTER> }
+<ORDER_BY>
+""".replace("<TYPE>", "<{}>".format(featuretype_uri))
+    features = []
+    after = ""
+    while True:
+        page_length = 0
+        async for b in iter_graphdb_bindings(fill_cursor(sparql, "f", after), limit=page_size, offset=0):
+            features.append(b['f']['value'])
+            page_length += 1
+        if page_length < page_size:
+            return features
+        after = features[-1]
+
+
+async def precompute(store, from_types, include_areas, include_proportion, include_contains, concurrency,
+                     force=False):
+    from functions import compute_location_overlaps_crosswalk, gather_bounded
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async def _precompute_one(from_uri, output_featuretype_uri):
+        nonlocal done
+        key = (from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains, False)
+        if force or key not in store:
+            meta, overlaps = await compute_location_overlaps_crosswalk(
+                from_uri, output_featuretype_uri, include_areas, include_proportion, False, include_contains)
+            store.put(*key, meta, overlaps)
+        done += 1
+        if done % 100 == 0:
+            print("{} crosswalks precomputed".format(done))
+
+    for from_type in from_types:
+        output_types = []
+        for type_prefix, types in CROSSWALK_OUTPUT_TYPES.items():
+            if from_type.startswith(type_prefix):
+                output_types = types
+        features = await get_features_of_type(from_type)
+        print("{}: {} features, {} output types".format(from_type, len(features), len(output_types)))
+        await gather_bounded(semaphore, [_precompute_one(from_uri, output_type)
+                                         for from_uri in features for output_type in output_types])
+    print("{} crosswalks precomputed".format(done))
+
+
+def main():
+    from config import CROSSWALK_STORE_PATH, LINKSET_VERSION
+    parser = argparse.ArgumentParser(description="Precompute crosswalks for ASGS and Geofabric parent features")
+    parser.add_argument("--store", default=CROSSWALK_STORE_PATH,
+                        help="Path of the crosswalk store (default CROSSWALK_STORE_PATH)")
+    parser.add_argument("--from-type", action="append", dest="from_types",
+                        help="Feature type to precompute crosswalks from, may be repeated "
+                             "(default all ASGS and Geofabric parent types)")
+    parser.add_argument("--areas", action="store_true", help="Precompute with areas=true")
+    parser.add_argument("--proportion", action="store_true", help="Precompute with proportion=true")
+    parser.add_argument("--contains", action="store_true", help="Precompute with contains=true")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of crosswalks computed at once")
+    parser.add_argument("--force", action="store_true", help="Recompute crosswalks that are already stored")
+    args = parser.parse_args()
+    if not args.store:
+        parser.error("No crosswalk store path given, set CROSSWALK_STORE_PATH or pass --store")
+    from_types = args.from_types or (ASGS_PARENT_TYPES + GEOFABRIC_PARENT_TYPES)
+    store = CrosswalkStore(args.store, LINKSET_VERSION)
+    try:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(precompute(store, from_types, args.areas, args.proportion, args.contains,
+                                           args.concurrency, force=args.force))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
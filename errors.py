@@ -4,3 +4,9 @@ from sanic import exceptions
 class ReportableAPIError(exceptions.ServerError):
     def __init__(self, message):
         super(ReportableAPIError, self).__init__(message)
+class InvalidCursorError(exceptions.InvalidUsage):
+    def __init__(self, message):
+        super(InvalidCursorError, self).__init__(message)
+class InvalidSearchError(exceptions.InvalidUsage):
+    def __init__(self, message):
+        super(InvalidSearchError, self).__init__(message)
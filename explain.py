@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Trace of the queries made to answer one request, returned in meta["explain"] when a location function is
+called with ?explain=true.
+
+Each upstream query is recorded with its SPARQL (or URL), parameters, row count, response size, time and
+whether it was sent upstream ("miss"), shared with an identical query already in flight ("shared"), or
+answered from a local index ("local"). Cache lookups are counted by cache, and the crosswalk records how far
+it fanned out.
+
+The trace is held in a ContextVar, so it follows the request into the tasks started for it without being
+passed through every function, and nothing is recorded for requests which didn't ask for it.
+"""
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+_current_trace = ContextVar('explain_trace', default=None)
+
+
+class Trace(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []
+        # cache name to [hits, misses]
+        self.caches = OrderedDict()
+        self.crosswalk = OrderedDict()
+
+    def as_dict(self):
+        return {
+            'seconds': time.perf_counter() - self.start,
+            'queries': self.queries,
+            'caches': OrderedDict((name, {'hits': hits, 'misses': misses}) for name, (hits, misses) in self.caches.items()),
+            'crosswalk': self.crosswalk or None,
+        }
+
+
+def start_trace():
+    """
+    Start recording the queries of the current request
+    :rtype: Trace
+    """
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    """
+    :return: the trace of the current request, or None if it isn't being traced
+    :rtype: Trace
+    """
+    return _current_trace.get()
+
+
+def record_query(source, template, query, parameters, rows, response_bytes, seconds, cache):
+    """
+    Record one query in the current trace, if there is one
+    :param source: the upstream, or local index, which answered the query
+    :param cache: "miss" if it was sent upstream, "shared" if it joined an identical query in flight,
+     "local" if it was answered from a local index
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.queries.append(OrderedDict([
+        ('source', source),
+        ('template', template),
+        ('query', query),
+        ('parameters', parameters),
+        ('rows', rows),
+        ('bytes', response_bytes),
+        ('seconds', seconds),
+        ('cache', cache),
+    ]))
+
+
+def record_cache(name, hits=0, misses=0):
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    counts = trace.caches.setdefault(name, [0, 0])
+    counts[0] += hits
+    counts[1] += misses
+
+
+def record_crosswalk(name, value):
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    trace.crosswalk[name] = value
+
+
+async def traced_rows(rows, source, template, query, parameters, cache):
+    """
+    Pass on the rows of an async iterator, recording them as one query in the current trace once they are read
+    """
+    start = time.perf_counter()
+    count = 0
+    try:
+        async for row in rows:
+            count += 1
+            yield row
+    finally:
+        record_query(source, template, query, parameters, count, None, time.perf_counter() - start, cache)
+        aclose = getattr(rows, 'aclose', None)
+        if aclose is not None:
+            await aclose()
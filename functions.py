@@ -1,16 +1,142 @@
 import asyncio
 import asyncpg
+import base64
+import binascii
 import math
+import time
+from collections import OrderedDict
 from decimal import Decimal
-from aiohttp import ClientSession
 from aiohttp.client_exceptions import ClientConnectorError
 from config import TRIPLESTORE_CACHE_SPARQL_ENDPOINT
-from config import ES_ENDPOINT
-from config import GEOM_DATA_SVC_ENDPOINT
+from config import ES_LABEL_SEARCH_ENDPOINT, LABEL_SEARCH_MAX_COUNT, LABEL_SEARCH_MAX_QUERY_LENGTH
+from config import LABEL_SEARCH_CACHE_SIZE, LABEL_SEARCH_CACHE_TTL
+from config import GEOM_DATA_SVC_ENDPOINT, GEOM_DATA_SVC_CONCURRENCY
+from config import TYPE_CACHE_SIZE, TYPE_CACHE_TTL
+from config import CROSSWALK_CONCURRENCY
+from config import CROSSWALK_STORE_PATH, LINKSET_VERSION
 
-from json import loads
+from json import loads, dumps
 
-from errors import ReportableAPIError
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from errors import ReportableAPIError, InvalidCursorError, InvalidSearchError
+from crosswalk_store import CrosswalkStore
+from sparql_results import TSV_MEDIA_TYPE, parse_tsv_header, parse_tsv_row
+import spatial_index
+import hierarchy_index
+import linkset_store
+import upstream
+import metrics
+import explain
+import label_search
+import label_index
+from single_flight import SharedStream, coalesce
+from uri_table import UriTable, OverlapRecord, CrosswalkParent, format_decimal, NAN
+from crosswalk_matrix import aggregate_crosswalk
+
+#Number of uris sent in each VALUES block when checking types in bulk
+TYPE_CHECK_CHUNK_SIZE = 500
+#Number of target uris sent in each VALUES block by get_location_overlaps_batch
+OVERLAPS_BATCH_CHUNK_SIZE = 50
+#Bytes read from a streamed SPARQL TSV response at a time
+TSV_READ_CHUNK_SIZE = 65536
+#Row limit for batch queries, which aren't paged
+BATCH_QUERY_LIMIT = 2147483647
+#Page size get_all_overlaps reads the overlaps of a feature with
+ALL_OVERLAPS_PAGE_SIZE = 100000
+#Cursor value which starts keyset paging from the first result
+CURSOR_START = "first"
+#Areas and percentages of overlaps are written with 8 decimal places
+DECIMAL_FORMAT = "%.8f"
+
+class LRUCache(object):
+    """
+    A bounded mapping which evicts the least recently used entry once maxsize is reached.
+    Entries also expire ttl seconds after they were set, if ttl is given.
+    Hits and misses are counted so the cache can be sized for the working set.
+    """
+    def __init__(self, maxsize, ttl=None, timer=time.monotonic):
+        self.maxsize = int(maxsize)
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def _lookup(self, key):
+        """
+        Return the live value for key without touching the hit/miss counters.
+        Raises KeyError if key is missing or has expired.
+        """
+        expires, value = self._entries[key]
+        if expires is not None and expires <= self.timer():
+            del self._entries[key]
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            value = self._lookup(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else self.timer() + self.ttl
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class TypeCache(LRUCache):
+    """
+    Cache of rdf:type membership keyed on resource uri.
+    Each entry maps the feature type uris that have been checked for that resource to a bool.
+    """
+    def get_type_match(self, target_uri, featuretype_uri):
+        """
+        :return: True or False if the membership is known, otherwise None
+        """
+        try:
+            match = self._lookup(target_uri)[featuretype_uri]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return match
+
+    def set_type_match(self, target_uri, featuretype_uri, match):
+        try:
+            types = self._lookup(target_uri)
+        except KeyError:
+            types = {}
+            self.set(target_uri, types)
+        types[featuretype_uri] = bool(match)
+
+type_cache = TypeCache(TYPE_CACHE_SIZE, TYPE_CACHE_TTL)
+label_search_cache = LRUCache(LABEL_SEARCH_CACHE_SIZE, LABEL_SEARCH_CACHE_TTL)
 
 #Until we have a better way of understanding fundamental units in spatial hierarchies
 prefix_base_unit_lookup = {
@@ -31,6 +157,90 @@ resource_type_linkset_lookup = {
 "http://linked.data.gov.au/def/gnaf" : [ "http://linked.data.gov.au/dataset/addr1605mb16", "http://linked.data.gov.au/dataset/addrcatch"]
 }
 
+def encode_cursor(last_value):
+    """
+    :return: the opaque cursor token for the page which follows last_value
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(str(last_value).encode('utf-8')).decode('ascii').rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: a token from encode_cursor, or CURSOR_START
+    :type cursor: str
+    :return: the value the page starts after, "" for the first page
+    :rtype: str
+    """
+    if cursor == CURSOR_START or cursor == "":
+        return ""
+    try:
+        return base64.b64decode(cursor + "=" * (-len(cursor) % 4), altchars=b"-_", validate=True).decode('utf-8')
+    except (binascii.Error, ValueError):
+        raise InvalidCursorError("Invalid cursor \"{}\"".format(cursor))
+
+
+def fill_cursor(sparql, var, after=None):
+    """
+    Fill the <CURSOR_FILTER> and <ORDER_BY> placeholders of a query.
+    For keyset paging the results are ordered by var and start after the value after, instead of
+    GraphDB evaluating and skipping every row before a deep OFFSET.
+    :param var: the variable results are ordered by, without the "?"
+    :type var: str
+    :param after: the value of var the page starts after, "" for the first page, or None to not keyset page
+    :type after: str
+    :rtype: str
+    """
+    if after is None:
+        return sparql.replace("<CURSOR_FILTER>", "").replace("<ORDER_BY>", "")
+    if after:
+        escaped = str(after).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n").replace("\r", "\\r")
+        cursor_filter = "FILTER(STR(?{}) > \"{}\")".format(var, escaped)
+    else:
+        cursor_filter = ""
+    sparql = sparql.replace("<CURSOR_FILTER>", cursor_filter)
+    return sparql.replace("<ORDER_BY>", "ORDER BY STR(?{})".format(var))
+
+
+def get_next_cursor(values, count):
+    """
+    :param values: the values of one keyset page, in order
+    :type values: list
+    :return: the cursor for the page after, or None if this was the last page
+    :rtype: str
+    """
+    if len(values) < count or len(values) < 1:
+        return None
+    return encode_cursor(values[-1])
+
+
+def merge_keyset_pages(pages, count, key):
+    """
+    Merge the keyset pages of several queries, each ordered by key, into one page ordered by key.
+    The merged page stops at the first place any of the queries might have more results, extended to
+    include every row sharing the last key, so the next page can start after that key.
+    :param pages: a list of pages, each a list of rows
+    :type pages: list
+    :return: the merged rows, and the key the next page starts after or None if there are no more results
+    :rtype: tuple
+    """
+    merged = []
+    for page in pages:
+        merged.extend(page)
+    merged.sort(key=key)
+    more = any(len(page) >= count for page in pages)
+    if len(merged) > count:
+        last = key(merged[count - 1])
+        end = count
+        while end < len(merged) and key(merged[end]) == last:
+            end += 1
+        del merged[end:]
+        more = True
+    if not more or len(merged) < 1:
+        return merged, None
+    return merged, key(merged[-1])
+
+
 async def get_linkset_uri(from_uri, output_featuretype_uri):
     '''
     Get the linkset connecting an input uri and an output_featuretype_uri
@@ -67,25 +277,50 @@ def get_to_base_unit_and_type_prefix(from_uri, query_uri):
                 return base_unit_prefix, resource_type_prefix
     return base_unit_prefix, resource_type_prefix
 
-async def get_all_overlaps(target_uri, output_featuretype_uri, linksets_filter, include_areas=True, include_proportion=True, include_contains=True, include_within=True):
-    offset = 0
+async def iter_overlaps_pages(target_uri, output_featuretype_uri, linksets_filter, include_areas=True, include_proportion=True, include_contains=True, include_within=True, page_size=ALL_OVERLAPS_PAGE_SIZE):
+    """
+    Yield every page of the overlaps of target_uri, keyset paged so no page re-reads the ones before it
+    :return: async iterator of (meta, overlaps) pages
+    """
+    cursor = CURSOR_START
+    while cursor is not None:
+        meta, overlaps = await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count=page_size, cursor=cursor)
+        yield meta, overlaps
+        cursor = meta['next_cursor']
+
+async def get_all_overlaps(target_uri, output_featuretype_uri, linksets_filter, include_areas=True, include_proportion=True, include_contains=True, include_within=True, uri_table=None):
+    """
+    :param uri_table: if given, each page of overlaps is turned into OverlapRecords with their uris interned
+     in this table as it is read, so only the compact records of every page are kept
+    :type uri_table: UriTable
+    """
+    my_area = 0
     all_overlaps = []
-    while True:
-        results = list(await get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count=100000, offset=offset))
-        length = results[0]['count']
-        if "featureArea" in results[0].keys():
-            my_area = results[0]['featureArea']
-        else:
-            my_area = 0
-        all_overlaps = all_overlaps + results[1]
-        if length < 100000:
-            break
-        offset += 100000
+    async for meta, overlaps in iter_overlaps_pages(target_uri, output_featuretype_uri, linksets_filter, include_areas, include_proportion, include_contains, include_within):
+        if "featureArea" in meta.keys():
+            my_area = meta['featureArea']
+        if uri_table is not None:
+            overlaps = [OverlapRecord.from_overlap(uri_table, an_overlap) for an_overlap in overlaps]
+        all_overlaps.extend(overlaps)
     return my_area, all_overlaps
 
-async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, offset=0):
+def graphdb_parameters(infer, same_as, limit, offset):
     """
-    Pass the SPARQL query to the endpoint. The endpoint is specified in the config file.
+    :return: the request parameters, other than the query, sent to the GraphDB endpoint with a query
+    :rtype: dict
+    """
+    return {
+        'infer': 'true' if bool(infer) else 'false',
+        'sameAs': 'true' if bool(same_as) else 'false',
+        'limit': int(limit),
+        'offset': int(offset),
+    }
+
+def iter_graphdb_bindings(sparql, infer=True, same_as=True, limit=1000, offset=0, template=metrics.OTHER_TEMPLATE):
+    """
+    Pass the SPARQL query to the endpoint and iterate over the result bindings as they arrive.
+    An identical query that is still waiting for its first rows is joined rather than sent again,
+    the bindings are then shared between the callers and must not be modified.
 
     :param sparql: the valid SPARQL text
     :type sparql: str
@@ -97,30 +332,108 @@ async def query_graphdb_endpoint(sparql, infer=True, same_as=True, limit=1000, o
     :type limit: int
     :param offset:
     :type offset: int
-    :return:
-    :rtype: dict
+    :param template: name of the query, the query is timed under it in metrics
+    :type template: str
+    :return: async iterator of bindings
     """
-    loop = asyncio.get_event_loop()
-    try:
-        session = query_graphdb_endpoint.session_cache[loop]
-    except KeyError:
-        session = ClientSession(loop=loop)
-        query_graphdb_endpoint.session_cache[loop] = session
-    args = {
-        'query': sparql,
-        'infer': 'true' if bool(infer) else 'false',
-        'sameAs': 'true' if bool(same_as) else 'false',
-        'limit': int(limit),
-        'offset': int(offset),
-    }
+    key = (sparql, bool(infer), bool(same_as), int(limit), int(offset))
+    stream = iter_graphdb_bindings.in_flight.get(key)
+    shared = stream is not None and stream.joinable
+    rows = SharedStream.reader_for(iter_graphdb_bindings.in_flight, key,
+                                   lambda: fetch_graphdb_bindings(sparql, infer, same_as, limit, offset, template))
+    if shared and explain.current_trace() is not None:
+        return explain.traced_rows(rows, upstream.GRAPHDB, template, sparql, graphdb_parameters(infer, same_as, limit, offset), "shared")
+    return rows
+iter_graphdb_bindings.in_flight = {}
+
+async def iter_response_lines(content, chunk_size=TSV_READ_CHUNK_SIZE):
+    """
+    Yield the lines of a response body as they arrive, each with its line ending.
+    Unlike iterating over the StreamReader itself, lines may be any length, e.g. rows with large WKT literals.
+
+    :param content: the response's StreamReader
+    :param chunk_size: bytes to read at a time
+    :type chunk_size: int
+    :return: async iterator of bytes
+    """
+    parts = []
+    async for chunk in content.iter_chunked(chunk_size):
+        start = 0
+        end = chunk.find(b"\n")
+        while end != -1:
+            parts.append(chunk[start:end + 1])
+            yield b"".join(parts)
+            parts = []
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if start < len(chunk):
+            parts.append(chunk[start:])
+    if parts:
+        yield b"".join(parts)
+
+async def fetch_graphdb_bindings(sparql, infer=True, same_as=True, limit=1000, offset=0, template=metrics.OTHER_TEMPLATE):
+    """
+    Send the SPARQL query to the endpoint and yield the result bindings one at a time as they arrive.
+    Results are requested as tab-separated-values and parsed a row at a time, so the whole result set is
+    never held in memory. Bindings are dicts in the same form as sparql-results+json bindings.
+    The time the caller spends on each binding is not counted in the query's time in metrics.
+
+    :param sparql: the valid SPARQL text
+    :type sparql: str
+    :param infer:
+    :type infer: bool
+    :param same_as:
+    :type same_as: bool
+    :param limit:
+    :type limit: int
+    :param offset:
+    :type offset: int
+    :param template: name of the query, the query is timed under it in metrics
+    :type template: str
+    :return: async iterator of bindings
+    """
+    session = upstream.get_session(upstream.GRAPHDB)
+    args = graphdb_parameters(infer, same_as, limit, offset)
+    args['query'] = sparql
     headers = {
-        'Accept': "application/sparql-results+json,*/*;q=0.9",
+        'Accept': TSV_MEDIA_TYPE,
         'Accept-Encoding': "gzip, deflate",
     }
-    resp = await session.request('POST', TRIPLESTORE_CACHE_SPARQL_ENDPOINT, data=args, headers=headers)
-    resp_content = await resp.text()
-    return loads(resp_content)
-query_graphdb_endpoint.session_cache = {}
+    start = time.perf_counter()
+    # seconds spent parsing rows, and suspended while the caller handles them
+    decoding = 0.0
+    suspended = 0.0
+    response_bytes = 0
+    rows = 0
+    try:
+        async with session.request('POST', TRIPLESTORE_CACHE_SPARQL_ENDPOINT, data=args, headers=headers) as resp:
+            if resp.status != 200:
+                message = await resp.text()
+                raise ReportableAPIError("The triplestore could not answer the query. Error code {}: {}".format(resp.status, message[:200]))
+            variables = None
+            async for line in iter_response_lines(resp.content):
+                decode_start = time.perf_counter()
+                response_bytes += len(line)
+                line = line.decode('utf-8')
+                if variables is None:
+                    variables = parse_tsv_header(line)
+                    decoding += time.perf_counter() - decode_start
+                    continue
+                if line.strip('\r\n') == "":
+                    continue
+                b = parse_tsv_row(variables, line)
+                rows += 1
+                yield_start = time.perf_counter()
+                decoding += yield_start - decode_start
+                yield b
+                suspended += time.perf_counter() - yield_start
+    except asyncio.TimeoutError:
+        raise ReportableAPIError("The triplestore did not answer the query in time.")
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe_upstream(upstream.GRAPHDB, template, elapsed - suspended - decoding, response_bytes, decoding)
+        explain.record_query(upstream.GRAPHDB, template, sparql, graphdb_parameters(infer, same_as, limit, offset),
+                             rows, response_bytes, elapsed - suspended, "miss")
 
 async def check_type(target_uri, output_featuretype_uri):
     """
@@ -133,6 +446,11 @@ async def check_type(target_uri, output_featuretype_uri):
     :return:
     :rtype: bool
     """
+    cached = type_cache.get_type_match(target_uri, output_featuretype_uri)
+    if cached is not None:
+        explain.record_cache("type_cache", hits=1)
+        return cached
+    explain.record_cache("type_cache", misses=1)
     sparql = """\
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
 select * where { 
@@ -141,14 +459,53 @@ select * where {
 """
     sparql = sparql.replace("<TARGETURI>", "<{}>".format(str(target_uri)))
     sparql = sparql.replace("<TARGETTYPE>", "<{}>".format(str(output_featuretype_uri)))
-    resp = await query_graphdb_endpoint(sparql)
     results = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
+    async for b in iter_graphdb_bindings(sparql, template="check_type"):
         results.append(b['a']['value'])
-    return results[0]  == "true"
+    type_match = results[0] == "true"
+    type_cache.set_type_match(target_uri, output_featuretype_uri, type_match)
+    return type_match
+
+async def check_types(target_uris, output_featuretype_uri, chunk_size=TYPE_CHECK_CHUNK_SIZE):
+    """
+    check which of resource_uris are of type output_featuretype_uri
+    the uris are sent in chunks using a VALUES block, so this costs one query per chunk
+    rather than one query per uri
+    :param target_uris:
+    :type target_uris: list
+    :param output_featuretype_uri:
+    :type output_featuretype_uri: str
+    :param chunk_size:
+    :type chunk_size: int
+    :return: dict of uri to bool
+    :rtype: dict
+    """
+    sparql = """\
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+SELECT DISTINCT ?s WHERE {
+    VALUES ?s { <TARGETURIS> }
+    ?s rdf:type <TARGETTYPE> .
+}
+"""
+    sparql = sparql.replace("<TARGETTYPE>", "<{}>".format(str(output_featuretype_uri)))
+    # preserve order, drop duplicates
+    unique_uris = list(dict.fromkeys(str(u) for u in target_uris))
+    type_matches = {}
+    uncached_uris = []
+    for u in unique_uris:
+        cached = type_cache.get_type_match(u, output_featuretype_uri)
+        if cached is None:
+            uncached_uris.append(u)
+        type_matches[u] = bool(cached)
+    explain.record_cache("type_cache", hits=len(unique_uris) - len(uncached_uris), misses=len(uncached_uris))
+    for i in range(0, len(uncached_uris), chunk_size):
+        chunk = uncached_uris[i:i + chunk_size]
+        values = " ".join("<{}>".format(u) for u in chunk)
+        async for b in iter_graphdb_bindings(sparql.replace("<TARGETURIS>", values), limit=len(chunk), template="check_type"):
+            type_matches[b['s']['value']] = True
+        for u in chunk:
+            type_cache.set_type_match(u, output_featuretype_uri, type_matches[u])
+    return type_matches
 
 async def get_resource(resource_uri):
     """
@@ -196,12 +553,8 @@ WHERE {
 }
 """
     sparql = sparql.replace("<URI>", "<{}>".format(str(resource_uri)))
-    resp = await query_graphdb_endpoint(sparql)
     resp_object = {}
-    if 'results' not in resp:
-        return resp_object
-    bindings = resp['results']['bindings']
-    for b in bindings:
+    async for b in iter_graphdb_bindings(sparql, template="get_resource"):
         pred = b['p']['value']
         obj = b['o']
         if obj['type'] == "bnode":
@@ -228,12 +581,14 @@ WHERE {
     return resp_object
 
 
-async def get_linksets(count=1000, offset=0):
+async def get_linksets(count=1000, offset=0, cursor=None):
     """
     :param count:
     :type count: int
     :param offset:
     :type offset: int
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
     :return:
     :rtype: tuple
     """
@@ -250,28 +605,31 @@ WHERE {
         ?c rdfs:subClassOf+ loci:Linkset .
         ?l a ?c .
     }
+    <CURSOR_FILTER>
 }
+<ORDER_BY>
 """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
+    after = None if cursor is None else decode_cursor(cursor)
+    sparql = fill_cursor(sparql, "l", after)
     linksets = []
-    if 'results' not in resp:
-        return linksets
-    bindings = resp['results']['bindings']
-    for b in bindings:
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=0 if cursor is not None else offset, template="linksets"):
         linksets.append(b['l']['value'])
     meta = {
         'count': len(linksets),
         'offset': offset,
     }
-    print(meta)
+    if cursor is not None:
+        meta['next_cursor'] = get_next_cursor(linksets, count)
     return meta, linksets
 
-async def get_datasets(count=1000, offset=0):
+async def get_datasets(count=1000, offset=0, cursor=None):
     """
     :param count:
     :type count: int
     :param offset:
     :type offset: int
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
     :return:
     :rtype: tuple
     """
@@ -293,29 +651,33 @@ WHERE {
         ?c rdfs:subClassOf+ dcat:Dataset .
         ?d a ?c .
     }
+    <CURSOR_FILTER>
 }
+<ORDER_BY>
 """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
+    after = None if cursor is None else decode_cursor(cursor)
+    sparql = fill_cursor(sparql, "d", after)
     datasets = []
-    if 'results' not in resp:
-        return datasets
-    bindings = resp['results']['bindings']
-    for b in bindings:
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=0 if cursor is not None else offset, template="datasets"):
         datasets.append(b['d']['value'])
     meta = {
         'count': len(datasets),
         'offset': offset,
     }
+    if cursor is not None:
+        meta['next_cursor'] = get_next_cursor(datasets, count)
     return meta, datasets
 
-async def get_locations(count=1000, offset=0):
+async def iter_locations(count=1000, offset=0, cursor=None):
     """
+    Yield the LOCI Locations one at a time
     :param count:
     :type count: int
     :param offset:
     :type offset: int
-    :return:
-    :rtype: tuple
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return: async iterator of location uris
     """
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
@@ -349,32 +711,49 @@ WHERE {
             rdf:predicate rdf:type ;
             rdf:object prov:Location .
     } .
+    <CURSOR_FILTER>
 }
+<ORDER_BY>
 """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    after = None if cursor is None else decode_cursor(cursor)
+    sparql = fill_cursor(sparql, "l", after)
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=0 if cursor is not None else offset, template="locations"):
+        yield b['l']['value']
+
+async def get_locations(count=1000, offset=0, cursor=None):
+    """
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return:
+    :rtype: tuple
+    """
+    locations = [l async for l in iter_locations(count, offset, cursor)]
     meta = {
         'count': len(locations),
         'offset': offset,
     }
+    if cursor is not None:
+        meta['next_cursor'] = get_next_cursor(locations, count)
     return meta, locations
 
 
-async def get_location_is_within(target_uri, count=1000, offset=0):
+async def iter_location_is_within(target_uri, count=1000, offset=0, cursor=None):
     """
+    Yield the locations target_uri is within one at a time.
+    Answered from the hierarchy index when it is loaded and covers target_uri.
     :param target_uri:
     :type target_uri: str
     :param count:
     :type count: int
     :param offset:
     :type offset: int
-    :return:
-    :rtype: tuple
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return: async iterator of location uris
     """
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
@@ -388,33 +767,60 @@ WHERE {
     }
     UNION
     { <URI> geo:sfWithin+ ?l }
+    <CURSOR_FILTER>
 }
+<ORDER_BY>
 """
+    after = None if cursor is None else decode_cursor(cursor)
+    start = time.perf_counter()
+    local_locations = hierarchy_index.within_page(str(target_uri), count, offset, after)
+    if local_locations is not None:
+        explain.record_query("hierarchy_index", "within", None, OrderedDict([('uri', target_uri), ('count', count), ('offset', offset), ('cursor', cursor)]),
+                             len(local_locations), None, time.perf_counter() - start, "local")
+        for l in local_locations:
+            yield l
+        return
     sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
+    sparql = fill_cursor(sparql, "l", after)
     #print(sparql)
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=0 if cursor is not None else offset, template="within"):
+        yield b['l']['value']
+
+async def get_location_is_within(target_uri, count=1000, offset=0, cursor=None):
+    """
+    :param target_uri:
+    :type target_uri: str
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return:
+    :rtype: tuple
+    """
+    locations = [l async for l in iter_location_is_within(target_uri, count, offset, cursor)]
     meta = {
         'count': len(locations),
         'offset': offset,
     }
+    if cursor is not None:
+        meta['next_cursor'] = get_next_cursor(locations, count)
     return meta, locations
 
-async def get_location_contains(target_uri, count=1000, offset=0):
+async def iter_location_contains(target_uri, count=1000, offset=0, cursor=None):
     """
+    Yield the locations target_uri contains one at a time.
+    Answered from the hierarchy index when it is loaded and covers target_uri.
     :param target_uri:
     :type target_uri: str
     :param count:
     :type count: int
     :param offset:
     :type offset: int
-    :return:
-    :rtype: tuple
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return: async iterator of location uris
     """
     sparql = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
@@ -428,24 +834,65 @@ WHERE {
     }
     UNION
     { <URI> geo:sfContains+ ?l }
+    <CURSOR_FILTER>
 }
+<ORDER_BY>
 """
+    after = None if cursor is None else decode_cursor(cursor)
+    start = time.perf_counter()
+    local_locations = hierarchy_index.contains_page(str(target_uri), count, offset, after)
+    if local_locations is not None:
+        explain.record_query("hierarchy_index", "contains", None, OrderedDict([('uri', target_uri), ('count', count), ('offset', offset), ('cursor', cursor)]),
+                             len(local_locations), None, time.perf_counter() - start, "local")
+        for l in local_locations:
+            yield l
+        return
     sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
+    sparql = fill_cursor(sparql, "l", after)
     #print(sparql)
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    locations = []
-    if 'results' not in resp:
-        return locations
-    bindings = resp['results']['bindings']
-    for b in bindings:
-        locations.append(b['l']['value'])
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=0 if cursor is not None else offset, template="contains"):
+        yield b['l']['value']
+
+async def get_location_contains(target_uri, count=1000, offset=0, cursor=None):
+    """
+    :param target_uri:
+    :type target_uri: str
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :return:
+    :rtype: tuple
+    """
+    locations = [l async for l in iter_location_contains(target_uri, count, offset, cursor)]
     meta = {
         'count': len(locations),
         'offset': offset,
     }
+    if cursor is not None:
+        meta['next_cursor'] = get_next_cursor(locations, count)
     return meta, locations
 
-async def query_build_response_bindings(sparql, count, offset, bindings):
+async def iter_response_bindings(sparql, count, offset, template=metrics.OTHER_TEMPLATE):
+    """
+    Yield the bindings of a query, skipping the empty row an aggregate query gives when nothing matches
+    :param sparql:
+    :type sparql: str
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param template: name of the query, the query is timed under it in metrics
+    :type template: str
+    :return: async iterator of bindings
+    """
+    async for b in iter_graphdb_bindings(sparql, limit=count, offset=offset, template=template):
+        if len(b.keys()) > 0:
+            yield b
+
+async def query_build_response_bindings(sparql, count, offset, bindings, template=metrics.OTHER_TEMPLATE):
     """
     :param sparql:
     :type sparql: str
@@ -453,15 +900,52 @@ async def query_build_response_bindings(sparql, count, offset, bindings):
     :type count: int
     :param offset:
     :type offset: int
+    :param template: name of the query, the query is timed under it in metrics
+    :type template: str
     :return:
     """
-    resp = await query_graphdb_endpoint(sparql, limit=count, offset=offset)
-    if 'results' in resp and 'bindings' in resp['results']:
-        if len(resp['results']['bindings']) > 0:
-            if len(resp['results']['bindings'][0].keys()) > 0:
-                bindings.extend(resp['results']['bindings'])
+    async for b in iter_response_bindings(sparql, count, offset, template):
+        bindings.append(b)
+
+def get_crosswalk_store():
+    """
+    :return: the crosswalk result store, or None if CROSSWALK_STORE_PATH is not set
+    :rtype: CrosswalkStore
+    """
+    if get_crosswalk_store.store is None and CROSSWALK_STORE_PATH:
+        get_crosswalk_store.store = CrosswalkStore(CROSSWALK_STORE_PATH, LINKSET_VERSION)
+    return get_crosswalk_store.store
+get_crosswalk_store.store = None
 
 async def get_location_overlaps_crosswalk(from_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, include_count=1000, offset=0):
+    """
+    find location overlaps across spatial hierarchies
+    results are served from the crosswalk store if it is enabled, otherwise they are computed and stored
+    :param target_uri:
+    :param target_feature_type:
+    :type target_uri: str
+    :type include_areas: bool
+    :type include_proportion: bool
+    :type include_within: bool
+    :type include_contains: bool
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :return:
+    """
+    store = get_crosswalk_store()
+    if store is not None:
+        stored = store.get(from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains, include_within)
+        explain.record_cache("crosswalk_store", hits=int(stored is not None), misses=int(stored is None))
+        if stored is not None:
+            return stored
+    meta, overlaps = await compute_location_overlaps_crosswalk(from_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, include_count, offset)
+    if store is not None:
+        store.put(from_uri, output_featuretype_uri, include_areas, include_proportion, include_contains, include_within, meta, overlaps)
+    return meta, overlaps
+
+async def compute_location_overlaps_crosswalk(from_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, include_count=1000, offset=0):
     """
     find location overlaps across spatial hierarchies
     :param target_uri:
@@ -487,152 +971,284 @@ async def get_location_overlaps_crosswalk(from_uri, output_featuretype_uri, incl
     # collate and sum all results for target units
     # calcuate final foward and reverse proportions by finding the proportions of passed over area that is in the target block (reversePercentage)
     # and the proportion of final passed over area as as a proportion of the original area (forwardProportion)
+    # the SPARQL requests for independent base units (and for the parents of the base units they overlap)
+    # are issued concurrently, at most CROSSWALK_CONCURRENCY at a time. The aggregation itself is done
+    # afterwards, in one vectorised pass (see crosswalk_matrix) if numpy is installed, otherwise by walking
+    # the results in the original traversal order.
+    # uris are interned in uri_table and overlaps are kept as OverlapRecords,
+    # output dicts and strings are only made for the final results
     linksets_filter = await get_linkset_uri(from_uri, output_featuretype_uri)
     base_unit_prefix, resource_type_prefix = get_to_base_unit_and_type_prefix("", from_uri)
-    # this is a base unit so continue to base unit logic
-    parent_amount = {}
+    semaphore = asyncio.Semaphore(CROSSWALK_CONCURRENCY)
+    uri_table = UriTable()
+    # the walk of the from_uri in order, each step is either a (base uri id, incoming area) pair,
+    # or a CrosswalkParent for a contained feature which is recorded as it is
+    steps = []
     # cache of withins, base units in other hierarchary may overlap multiple times so don't need to find parents everytime
     # just use cache of parents
     found_parents = {}
     if base_unit_prefix not in from_uri:
         # This must be a parent unit so get everything contained and find base units
-        my_area, all_contained = await get_all_overlaps(from_uri, None, None, include_contains=True, include_within=False)
-        collated_uri_dict = {}
+        my_area, all_contained = await get_all_overlaps(from_uri, None, None, include_contains=True, include_within=False, uri_table=uri_table)
+        from_base_ids = []
         for an_contained in all_contained:
-            from_base_uri = an_contained['uri']
+            from_base_id = an_contained.uri_id
             if base_unit_prefix is None:
                 continue
-            if base_unit_prefix not in from_base_uri:
+            if not uri_table.uri_contains(from_base_id, base_unit_prefix):
                 # isn't actually a base uri but record information
-                parent_amount[from_base_uri] = {"uri": from_base_uri, "featureArea": my_area, "forwardPercentage": an_contained["forwardPercentage"], "reversePercentage": an_contained["reversePercentage"], "intersectionArea": an_contained["intersectionArea"]}
+                steps.append(CrosswalkParent(from_base_id, an_contained.intersection_area, float(my_area), an_contained.forward_percentage, an_contained.reverse_percentage, from_overlap=True))
                 continue
             # found a base uri do base uri logic
-            percentage_from_uri_in_from_base_uri = float(an_contained["forwardPercentage"])  # This is the amount this base unit takes up of the parent unit
+            percentage_from_uri_in_from_base_uri = an_contained.forward_percentage  # This is the amount this base unit takes up of the parent unit
             area_parent = float(my_area) * percentage_from_uri_in_from_base_uri / 100
-            await get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, area_parent, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter, output_featuretype_uri)
+            steps.append((from_base_id, area_parent))
+            from_base_ids.append(from_base_id)
+        base_overlaps = await crosswalk_fetch_base_overlaps(uri_table, from_base_ids, linksets_filter, semaphore)
+    else:
+        from_id = uri_table.intern(from_uri)
+        from_base_ids = [from_id]
+        base_overlaps = await crosswalk_fetch_base_overlaps(uri_table, from_base_ids, linksets_filter, semaphore)
+        # this is the U shaped query is a L shaped and starts from a base_uri therefore the area is the area of the base_uri
+        my_area = base_overlaps[from_id][0]
+        steps.append((from_id, float(my_area)))
+    processing_start = time.perf_counter()
+    to_base_units = {from_base_id: list(crosswalk_to_base_units(uri_table, from_base_id, base_overlaps[from_base_id][1]))
+                     for from_base_id in base_overlaps}
+    processing = time.perf_counter() - processing_start
+    type_matches = await crosswalk_fetch_parents(uri_table, found_parents, from_base_ids, to_base_units, output_featuretype_uri, semaphore)
+    if explain.current_trace() is not None:
+        record_crosswalk_fan_out(uri_table, steps, from_base_ids, to_base_units, found_parents)
+    processing_start = time.perf_counter()
+    if np is not None:
+        parent_amount = aggregate_crosswalk(uri_table, steps, to_base_units, found_parents, type_matches)
     else:
-        my_area = await get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, None, 100, from_uri, linksets_filter, output_featuretype_uri)
+        # uri id to CrosswalkParent
+        parent_amount = {}
+        for step in steps:
+            if isinstance(step, CrosswalkParent):
+                parent_amount[step.uri_id] = step
+                continue
+            from_base_id, area_incoming = step
+            get_location_overlaps_crosswalk_base_uri(uri_table, found_parents, parent_amount, area_incoming, to_base_units[from_base_id], type_matches)
 
     parents = parent_amount.values()
     final_parents = []
+    if output_featuretype_uri is not None:
+        processing += time.perf_counter() - processing_start
+        type_matches = await check_types([uri_table.uri(aparent.uri_id) for aparent in parents], output_featuretype_uri)
+        processing_start = time.perf_counter()
     for aparent in parents:
+        parent_uri = uri_table.uri(aparent.uri_id)
         if output_featuretype_uri is not None:
-            type_match = await check_type(aparent['uri'], output_featuretype_uri)
-            if not type_match:
+            if not type_matches[parent_uri]:
                continue
-        final_parents.append(aparent)
-        area_from_uri = float(my_area)
-        area_parent = float(aparent["featureArea"])
-        area_from_uri_in_parent = aparent["intersectionArea"]
-        if include_proportion and "forwardPercentage" not in aparent.keys():
-            proportion_area_of_from_uri = area_from_uri_in_parent / area_from_uri
-            if proportion_area_of_from_uri >= 1:
-                proportion_area_of_from_uri = 1
-            aparent["forwardPercentage"] = str(proportion_area_of_from_uri * 100)
-        if not include_proportion and "forwardPercentage" in aparent.keys():
-           aparent.pop("forwardPercentage", None)
-        if include_proportion and "reversePercentage" not in aparent.keys():
-            proportion_area_of_parent = area_from_uri_in_parent / area_parent
-            if proportion_area_of_parent >= 1:
-                proportion_area_of_parent = 1
-            aparent["reversePercentage"] = str(proportion_area_of_parent * 100)
-        if not include_proportion and "reversePercentage" in aparent.keys():
-            aparent.pop("reversePercentage", None)
-        if include_areas:
-            aparent["intersectionArea"] = str(aparent["intersectionArea"])
-        else:
-            aparent.pop("intersectionArea", None)
-            aparent.pop("featureArea", None)
-        for key in aparent:
-            value = aparent[key]
-            if isinstance(value, float) and math.isnan(value):
-                aparent[key] = "nan"
+        final_parents.append(build_crosswalk_parent(parent_uri, aparent, float(my_area), include_areas, include_proportion))
+    metrics.processing_seconds.observe(processing + time.perf_counter() - processing_start, "crosswalk")
+    explain.record_crosswalk("results", len(final_parents))
     meta = {
         'count': len(final_parents),
         'offset': 0,
     }
     if my_area and include_areas:
         meta['featureArea'] = my_area
-    return meta, list(final_parents)
+    return meta, final_parents
 
 
-async def get_location_overlaps_crosswalk_base_uri(found_parents, parent_amount, area_incoming, percentage_from_uri_in_from_base_uri, from_base_uri, linksets_filter=None, output_featuretype_uri=None):
+def record_crosswalk_fan_out(uri_table, steps, from_base_ids, to_base_units, found_parents, top=5):
     """
-    find location overlaps across to "to" spatial hierarchies given a base uri in a "from" hierarchy
+    Record in the explain trace how many base units and parents the crosswalk visited,
+    and the from base units which overlap the most "to" base units
+    """
+    fan_out = sorted(((len(to_base_units[from_base_id]), from_base_id) for from_base_id in set(from_base_ids)), reverse=True)
+    explain.record_crosswalk("contained_features", sum(1 for step in steps if isinstance(step, CrosswalkParent)))
+    explain.record_crosswalk("from_base_units", len(fan_out))
+    explain.record_crosswalk("to_base_unit_overlaps", sum(count for count, from_base_id in fan_out))
+    explain.record_crosswalk("to_base_units", len(set(an_overlap.uri_id for from_base_id in set(from_base_ids)
+                                                      for an_overlap, resource_type_prefix in to_base_units[from_base_id])))
+    explain.record_crosswalk("to_base_units_parents_queried", len(found_parents))
+    explain.record_crosswalk("parents", sum(len(parents) for area, parents in found_parents.values()))
+    explain.record_crosswalk("largest_fan_out", [OrderedDict([('uri', uri_table.uri(from_base_id)), ('to_base_units', count)])
+                                                 for count, from_base_id in fan_out[:top]])
+
+
+def build_crosswalk_parent(parent_uri, aparent, area_from_uri, include_areas, include_proportion):
+    """
+    Turn the running total of a crosswalk result into its output dict,
+    calculating its proportions if they weren't already known
+    :type aparent: CrosswalkParent
+    :rtype: dict
+    """
+    parent_dict = {"uri": parent_uri}
+    # areas and proportions taken from an overlap are written as the overlaps query wrote them
+    if aparent.from_overlap:
+        intersection_area = format_decimal(aparent.intersection_area)
+    else:
+        intersection_area = str(aparent.intersection_area)
+    if include_areas:
+        parent_dict["intersectionArea"] = intersection_area
+        parent_dict["featureArea"] = format_decimal(aparent.feature_area)
+    if include_proportion:
+        if aparent.forward_percentage is None:
+            proportion_area_of_from_uri = aparent.intersection_area / area_from_uri
+            if proportion_area_of_from_uri >= 1:
+                proportion_area_of_from_uri = 1
+            parent_dict["forwardPercentage"] = str(proportion_area_of_from_uri * 100)
+        else:
+            parent_dict["forwardPercentage"] = format_decimal(aparent.forward_percentage)
+        if aparent.reverse_percentage is None:
+            proportion_area_of_parent = aparent.intersection_area / aparent.feature_area
+            if proportion_area_of_parent >= 1:
+                proportion_area_of_parent = 1
+            parent_dict["reversePercentage"] = str(proportion_area_of_parent * 100)
+        else:
+            parent_dict["reversePercentage"] = format_decimal(aparent.reverse_percentage)
+    return parent_dict
+
+
+async def gather_bounded(semaphore, coros):
+    """
+    Run the awaitables concurrently, but with no more than the semaphore allows in flight at once.
+    Results are returned in the same order as the awaitables were given.
+    :param semaphore:
+    :type semaphore: asyncio.Semaphore
+    :param coros:
+    :type coros: iterable
+    :return:
+    :rtype: list
+    """
+    async def _run(coro):
+        async with semaphore:
+            return await coro
+    return await asyncio.gather(*[_run(coro) for coro in coros])
+
+
+class PrefetchedIterator(object):
+    """
+    Wraps an async iterator and starts fetching its first item straight away,
+    so e.g. its query is already under way by the time it is iterated.
+    """
+    def __init__(self, aiterator):
+        self._aiterator = aiterator
+        self._first = asyncio.ensure_future(aiterator.__anext__())
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            return await first
+        return await self._aiterator.__anext__()
+
+    async def aclose(self):
+        if self._first is not None:
+            self._first.cancel()
+            try:
+                await self._first
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._first = None
+        await self._aiterator.aclose()
+
+
+def crosswalk_to_base_units(uri_table, from_base_id, all_overlaps):
+    """
+    Yield the overlaps of a base unit that are base units in the other ("to") spatial hierarchy,
+    along with the resource type prefix of that hierarchy
+    :param all_overlaps: the OverlapRecords of the base unit
     """
-    my_area, all_overlaps = await get_all_overlaps(from_base_uri, None, include_contains=True, include_within=True, linksets_filter=linksets_filter)
-    # if there is no area incoming from another higher level object then this is the U shaped query is a L shaped and starts
-    # from a base_uri therefore the area is the area of the base_uri
-    if area_incoming is None:
-        area_incoming = float(my_area)
+    from_base_uri = uri_table.uri(from_base_id)
     for an_overlap in all_overlaps:
-        to_base_uri = an_overlap["uri"]
+        to_base_uri = uri_table.uri(an_overlap.uri_id)
         base_unit_prefix, resource_type_prefix = get_to_base_unit_and_type_prefix(from_base_uri, to_base_uri)
         if base_unit_prefix is None:
             continue
         if base_unit_prefix not in to_base_uri:
             continue
-        # found a real overlapping base unit
-        if "featureArea" in an_overlap:
-            to_feature_area = an_overlap["featureArea"]
-        else:
-            to_feature_area = float('nan')
-        if to_base_uri not in parent_amount:
-            parent_amount[to_base_uri] = {"uri": to_base_uri, "intersectionArea": 0, "featureArea": to_feature_area}
+        yield an_overlap, resource_type_prefix
+
+
+async def crosswalk_fetch_base_overlaps(uri_table, from_base_ids, linksets_filter, semaphore):
+    """
+    Concurrently get all overlaps (including contains and within) of each distinct base unit
+    :return: dict of base uri id to (area, OverlapRecords)
+    :rtype: dict
+    """
+    from_base_ids = list(dict.fromkeys(from_base_ids))
+    results = await gather_bounded(semaphore, [
+        get_all_overlaps(uri_table.uri(from_base_id), None, include_contains=True, include_within=True, linksets_filter=linksets_filter, uri_table=uri_table)
+        for from_base_id in from_base_ids])
+    return dict(zip(from_base_ids, results))
+
 
-        if "forwardPercentage" in an_overlap:
-            percentage_from_base_uri_in_to_base_uri = an_overlap["forwardPercentage"]
+async def crosswalk_fetch_parents(uri_table, found_parents, from_base_ids, to_base_units, output_featuretype_uri, semaphore):
+    """
+    Concurrently find the parents of every "to" base unit reached from from_base_ids, filling found_parents.
+    "to" base units which are already of the output type don't need their parents found.
+    :param to_base_units: dict of base uri id to the "to" base units it overlaps, from crosswalk_to_base_units
+    :return: dict of "to" base uri id to whether it is of the output type
+    :rtype: dict
+    """
+    to_base_overlaps = []
+    for from_base_id in from_base_ids:
+        for an_overlap, resource_type_prefix in to_base_units[from_base_id]:
+            to_base_overlaps.append(an_overlap)
+    if output_featuretype_uri is not None:
+        to_base_uris = [uri_table.uri(an_overlap.uri_id) for an_overlap in to_base_overlaps]
+        uri_type_matches = await check_types(to_base_uris, output_featuretype_uri)
+        type_matches = {an_overlap.uri_id: uri_type_matches[to_base_uri] for an_overlap, to_base_uri in zip(to_base_overlaps, to_base_uris)}
+    else:
+        type_matches = {}
+    # the first time a "to" base unit is seen decides how its parents are queried, as in a sequential walk
+    parent_lookups = OrderedDict()
+    for an_overlap in to_base_overlaps:
+        to_base_id = an_overlap.uri_id
+        if type_matches.get(to_base_id, False) or to_base_id in found_parents or to_base_id in parent_lookups:
+            continue
+        to_base_uri = uri_table.uri(to_base_id)
+        if math.isnan(an_overlap.forward_percentage):
+            parent_lookups[to_base_id] = get_all_overlaps(to_base_uri, None, None, include_areas=False, include_proportion=False, include_contains=False, include_within=True, uri_table=uri_table)
         else:
-            percentage_from_base_uri_in_to_base_uri = float('nan')
-        area_from_other_base_uri = (float(percentage_from_base_uri_in_to_base_uri) / 100 * area_incoming)
-        parent_amount[to_base_uri]["intersectionArea"] += area_from_other_base_uri
-        if (output_featuretype_uri is not None) and (await check_type(to_base_uri, output_featuretype_uri)):
+            parent_lookups[to_base_id] = get_all_overlaps(to_base_uri, None, None, include_contains=False, include_within=True, uri_table=uri_table)
+    results = await gather_bounded(semaphore, parent_lookups.values())
+    found_parents.update(zip(parent_lookups.keys(), results))
+    return type_matches
+
+
+def get_location_overlaps_crosswalk_base_uri(uri_table, found_parents, parent_amount, area_incoming, to_base_units, type_matches):
+    """
+    find location overlaps across to "to" spatial hierarchies given a base uri in a "from" hierarchy
+    the "to" base units the base uri overlaps and their parents must already have been fetched
+    """
+    for an_overlap, resource_type_prefix in to_base_units:
+        # found a real overlapping base unit
+        to_base_id = an_overlap.uri_id
+        if to_base_id not in parent_amount:
+            parent_amount[to_base_id] = CrosswalkParent(to_base_id, 0.0, an_overlap.feature_area)
+        area_from_other_base_uri = an_overlap.forward_percentage / 100 * area_incoming
+        parent_amount[to_base_id].intersection_area += area_from_other_base_uri
+        if type_matches.get(to_base_id, False):
             # this is already the target type so it is the "parent"
             continue
         # find all its parents
-        if to_base_uri not in found_parents.keys():
-            if math.isnan(float(percentage_from_base_uri_in_to_base_uri)):
-                found_parents[to_base_uri] = await get_all_overlaps(to_base_uri, None, None, include_areas=False, include_proportion=False, include_contains=False, include_within=True)
-            else:
-                found_parents[to_base_uri] = await get_all_overlaps(to_base_uri, None, None, include_contains=False, include_within=True)
-        parent_area, all_within = found_parents[to_base_uri]
+        parent_area, all_within = found_parents[to_base_id]
         for an_within in all_within:
-            if isinstance(an_within, str):
-                within_uri = an_within
-                if resource_type_prefix in within_uri:
-                    parent_amount[within_uri] = {"uri": within_uri, "intersectionArea": float('nan'), "featureArea": float('nan'), "forwardPercentage": float('nan'), "reversePercentage": float('nan')}
-                continue
-            within_uri = an_within['uri']
+            within_id = an_within.uri_id
             # exclude things that contain this base unit but aren't in the same spatial hierarchy
-            if resource_type_prefix not in within_uri:
+            if not uri_table.uri_contains(within_id, resource_type_prefix):
                 continue
-            feature_area = an_within["featureArea"]
-            # how much of this bigger thing is in the thing in the to hierarchy
-            if resource_type_prefix not in within_uri:
+            if not an_within.detailed:
+                # only the uri of the parent is known
+                parent_amount[within_id] = CrosswalkParent(within_id, NAN, NAN, NAN, NAN)
                 continue
             # this is a parent of the to_base_unit
-            if within_uri not in parent_amount.keys():
-                parent_amount[within_uri] = {"uri": within_uri, "intersectionArea": 0, "featureArea": feature_area}
-            parent_amount[within_uri]["intersectionArea"] += area_from_other_base_uri
-    return my_area
+            if within_id not in parent_amount:
+                parent_amount[within_id] = CrosswalkParent(within_id, 0.0, an_within.feature_area)
+            parent_amount[within_id].intersection_area += area_from_other_base_uri
 
 
-async def get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, count=1000, offset=0):
-    """
-    :param target_uri:
-    :type target_uri: str
-    :type include_areas: bool
-    :type include_proportion: bool
-    :type include_within: bool
-    :type include_contains: bool
-    :type linkset_filter: str
-    :param count:
-    :type count: int
-    :param offset:
-    :type offset: int
-    :return:
-    """
-    overlaps_sparql = """\
+OVERLAPS_SPARQL = """\
 PREFIX geo: <http://www.opengis.net/ont/geosparql#>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
 PREFIX ipo: <http://purl.org/dc/terms/isPartOf> 
@@ -642,6 +1258,7 @@ PREFIX epsg: <http://www.opengis.net/def/crs/EPSG/0/>
 PREFIX dt: <http://linked.data.gov.au/def/datatype/>
 SELECT <SELECTS>
 WHERE {
+    <VALUES>
     {
         { 
            ?s1 rdf:subject <URI> ;
@@ -660,10 +1277,12 @@ WHERE {
     UNION
     { <URI> geo:sfOverlaps ?o }
     <EXTRAS>
+    <CURSOR_FILTER>
 }
-GROUP BY ?o
+GROUP BY <GROUPS>?o
+<ORDER_BY>
 """
-    contains_sparql = """\
+CONTAINS_SPARQL = """\
     PREFIX geo: <http://www.opengis.net/ont/geosparql#>
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX ipo: <http://purl.org/dc/terms/isPartOf> 
@@ -673,6 +1292,7 @@ GROUP BY ?o
     PREFIX dt: <http://linked.data.gov.au/def/datatype/>
     SELECT ?c <SELECTS>
     WHERE {
+        <VALUES>
         {  
             ?s2 rdf:subject <URI> ;
             <LINKSET_FILTER>
@@ -685,10 +1305,12 @@ GROUP BY ?o
             BIND(true as ?c) .
         }
         <EXTRAS>
+        <CURSOR_FILTER>
     }
-    GROUP BY ?c ?o
+    GROUP BY <GROUPS>?c ?o
+    <ORDER_BY>
     """
-    within_sparql = """\
+WITHIN_SPARQL = """\
     PREFIX geo: <http://www.opengis.net/ont/geosparql#>
     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
     PREFIX geox: <http://linked.data.gov.au/def/geox#>
@@ -698,6 +1320,7 @@ GROUP BY ?o
     PREFIX dt: <http://linked.data.gov.au/def/datatype/>
     SELECT ?w <SELECTS>
     WHERE {
+        <VALUES>
         {  
             ?s2 rdf:subject <URI> ;
             <LINKSET_FILTER>
@@ -710,17 +1333,14 @@ GROUP BY ?o
             BIND(true as ?w) .
         }
         <EXTRAS>
+        <CURSOR_FILTER>
     }
-    GROUP BY ?w ?o
+    GROUP BY <GROUPS>?w ?o
+    <ORDER_BY>
     """
-    use_areas_sparql = include_proportion or include_areas
-    use_proportion_sparql = include_proportion
-
-    selects = "?o "
-    area_selects = "(MAX(?a1) as ?uarea) (MAX(?a2) as ?oarea) "
-    iarea_selects = "(MAX(?a3) as ?iarea) "
-
-    areas_sparql = """\
+AREA_SELECTS = "(MAX(?a1) as ?uarea) (MAX(?a2) as ?oarea) "
+IAREA_SELECTS = "(MAX(?a3) as ?iarea) "
+AREAS_SPARQL = """\
     OPTIONAL {
         <URI> geox:hasAreaM2 ?ha1 .
         ?ha1 geox:inCRS epsg:3577 .
@@ -732,7 +1352,7 @@ GROUP BY ?o
         ?ha2 dt:value ?a2 .
     }
     """
-    iarea_sparql = """\
+IAREA_SPARQL = """\
     OPTIONAL {
         { <URI> geo:sfContains ?i }
         UNION 
@@ -758,138 +1378,405 @@ GROUP BY ?o
         }
     }
     """
+
+
+def build_overlaps_queries(target, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, values_uris=None, after=None):
+    """
+    Build the overlaps, and optionally contains and within, SPARQL queries for a target.
+    :param target: the SPARQL term for the target feature, e.g. "<http://...>", or a variable bound by values_uris
+    :type target: str
+    :param values_uris: if given, target is a variable bound to each of these uris in a VALUES block and
+     results are grouped by target as well
+    :type values_uris: list
+    :param after: keyset page the queries, ordered by overlapping uri, starting after this uri ("" for the first page)
+    :type after: str
+    :return: list of (name, sparql) tuples
+    :rtype: list
+    """
+    use_areas_sparql = include_proportion or include_areas
+    use_proportion_sparql = include_proportion
+    if values_uris is not None:
+        values = "VALUES {} {{ {} }}".format(target, " ".join("<{}>".format(str(u)) for u in values_uris))
+        selects = "{} ?o ".format(target)
+        groups = "{} ".format(target)
+    else:
+        values = ""
+        selects = "?o "
+        groups = ""
+    if not linksets_filter is None:
+        linkset_filter = "ipo: <{}> ;".format(str(linksets_filter))
+    else:
+        linkset_filter = ""
+
+    def _fill(template, use_selects, extras):
+        sparql = template.replace("<SELECTS>", use_selects)
+        sparql = sparql.replace("<EXTRAS>", extras)
+        sparql = sparql.replace("<VALUES>", values)
+        sparql = sparql.replace("<GROUPS>", groups)
+        sparql = sparql.replace("<URI>", target)
+        sparql = sparql.replace("<LINKSET_FILTER>", linkset_filter)
+        return fill_cursor(sparql, "o", after)
+
     extras = ""
     use_selects = selects
     if use_areas_sparql:
-        extras += areas_sparql
-        use_selects += area_selects
+        extras += AREAS_SPARQL
+        use_selects += AREA_SELECTS
     if use_proportion_sparql:
-        extras += iarea_sparql
-        use_selects += iarea_selects
-    sparql = overlaps_sparql.replace("<SELECTS>", use_selects)
-    sparql = sparql.replace("<EXTRAS>", extras)
-    sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
-    if not linksets_filter is None:
-        sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
-    else:
-        sparql = sparql.replace("<LINKSET_FILTER>", "")
-    overlaps = []
-    bindings = []
-    if not linksets_filter is None:
-        sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
-    else:
-        sparql = sparql.replace("<LINKSET_FILTER>", "")
-    await query_build_response_bindings(sparql, count, offset, bindings)
+        extras += IAREA_SPARQL
+        use_selects += IAREA_SELECTS
+    queries = [("overlaps", _fill(OVERLAPS_SPARQL, use_selects, extras))]
     extras = ""
-    #print(sparql)
+    use_selects = selects
+    if use_areas_sparql:
+        extras = AREAS_SPARQL
+        use_selects += AREA_SELECTS
     if include_contains:
-        use_selects = selects
-        if use_areas_sparql:
-            extras = areas_sparql
-            use_selects += area_selects
-        sparql = contains_sparql.replace("<SELECTS>", use_selects)
-        sparql = sparql.replace("<EXTRAS>", extras)
-        sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
-        if not linksets_filter is None:
-            sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
-        else:
-            sparql = sparql.replace("<LINKSET_FILTER>", "")
-        await query_build_response_bindings(sparql, count, offset, bindings)
-        extras = ""
+        queries.append(("contains", _fill(CONTAINS_SPARQL, use_selects, extras)))
     if include_within:
-        use_selects = selects
-        if use_areas_sparql:
-            extras = areas_sparql
-            use_selects += area_selects
-        sparql = within_sparql.replace("<SELECTS>", use_selects)
-        sparql = sparql.replace("<EXTRAS>", extras)
-        sparql = sparql.replace("<URI>", "<{}>".format(str(target_uri)))
-        if not linksets_filter is None:
-            sparql = sparql.replace("<LINKSET_FILTER>", "ipo: <{}> ;".format(str(linksets_filter)))
-        else:
-            sparql = sparql.replace("<LINKSET_FILTER>", "")
-        await query_build_response_bindings(sparql, count, offset, bindings)
-    #print(sparql)
-    if len(bindings) < 1:
-        return {'count': 0, 'offset': offset}, overlaps
+        queries.append(("within", _fill(WITHIN_SPARQL, use_selects, extras)))
+    return queries
+
+
+def get_source_area(binding):
+    """
+    :return: the area of the target feature, from any binding of an overlaps query that selected areas
+    :rtype: Decimal
+    """
+    try:
+        uarea = binding['uarea']
+    except (LookupError, AttributeError):
+        raise ReportableAPIError("Source feature does not have a known geometry area."
+                                 "Cannot return areas or calculate proportions.")
+    return round(Decimal(uarea['value']), 8)
+
+
+def build_overlap(b, my_area, include_areas, include_proportion, include_within, include_contains):
+    """
+    Turn one binding of the overlaps queries into an overlap,
+    calculating areas and proportions if they are asked for.
+    The values are calculated and written as build_overlaps_columnar does, so both give the same overlaps.
+    :return: the overlapping uri, or a dict describing the overlap if areas or proportions were asked for
+    """
     if not include_proportion and not include_areas:
-        my_area = False
-        for b in bindings:
-            overlaps.append(b['o']['value'])
+        return b['o']['value']
+    o_dict = {"uri": b['o']['value']}
+    is_w = include_within and 'w' in b
+    has_c = include_contains and 'c' in b
+    if include_within:
+        o_dict["isWithin"] = is_w
+    if include_contains:
+        o_dict["contains"] = has_c
+    try:
+        o_area = float(b['oarea']['value'])
+    except (LookupError, AttributeError):
+        return o_dict
+    if include_areas:
+        o_dict['featureArea'] = DECIMAL_FORMAT % o_area
+    if not include_proportion:
+        return o_dict
+    area = float(my_area)
+    if is_w:
+        i_area = area
+    elif has_c:
+        i_area = o_area
     else:
-        d100 = Decimal("100.0")
         try:
-            uarea = bindings[0]['uarea']
+            i_area = float(b['iarea']['value'])
         except (LookupError, AttributeError):
-            raise ReportableAPIError("Source feature does not have a known geometry area."
-                                     "Cannot return areas or calculate proportions.")
-        my_area = round(Decimal(uarea['value']), 8)
-        for b in bindings:
-            o_dict = {"uri": b['o']['value']}
-            if include_within:
-                try:
-                    is_w = b['w']
-                except (LookupError, AttributeError):
-                    is_w = False
-                o_dict["isWithin"] = bool(is_w)
-            if include_contains:
-                try:
-                    has_c = b['c']
-                except (LookupError, AttributeError):
-                    has_c = False
-                o_dict["contains"] = bool(has_c)
+            return o_dict
+    if area == 0 or o_area == 0:
+        # a percentage of a feature without area is undefined
+        return o_dict
+    if include_areas:
+        o_dict['intersectionArea'] = DECIMAL_FORMAT % i_area
+    o_dict['forwardPercentage'] = DECIMAL_FORMAT % (100.0 if is_w else i_area / area * 100)
+    o_dict['reversePercentage'] = DECIMAL_FORMAT % (100.0 if has_c and not is_w else i_area / o_area * 100)
+    return o_dict
 
-            overlaps.append(o_dict)
-            try:
-                oarea = b['oarea']
-            except (LookupError, AttributeError):
-                continue
-            o_area = round(Decimal(oarea['value']), 8)
+
+def build_overlaps(bindings, include_areas, include_proportion, include_within, include_contains):
+    """
+    Turn the merged bindings of the overlaps queries for one target into its overlaps
+    :return: the target's area (or False if areas weren't asked for), and the overlaps
+    :rtype: tuple
+    """
+    if not include_proportion and not include_areas:
+        return False, [b['o']['value'] for b in bindings]
+    my_area = get_source_area(bindings[0])
+    if np is not None:
+        return my_area, build_overlaps_columnar(bindings, my_area, include_areas, include_proportion, include_within, include_contains)
+    return my_area, [build_overlap(b, my_area, include_areas, include_proportion, include_within, include_contains)
+                     for b in bindings]
+
+
+def format_decimals(column):
+    """
+    :return: each value of a float64 array written with DECIMAL_FORMAT
+    :rtype: list
+    """
+    return [DECIMAL_FORMAT % value for value in column.tolist()]
+
+
+def build_overlaps_columnar(bindings, my_area, include_areas, include_proportion, include_within, include_contains):
+    """
+    build_overlap for every binding at once, the areas and proportions are calculated over float64 columns
+    and each column is formatted in one go
+    :return: the overlaps
+    :rtype: list
+    """
+    uris = []
+    is_w = []
+    has_c = []
+    o_areas = []
+    i_areas = []
+    for b in bindings:
+        uris.append(b['o']['value'])
+        is_w.append(include_within and 'w' in b)
+        has_c.append(include_contains and 'c' in b)
+        oarea = b.get('oarea')
+        o_areas.append("nan" if oarea is None else oarea['value'])
+        iarea = b.get('iarea')
+        i_areas.append("nan" if iarea is None else iarea['value'])
+    has_oarea = [o_area != "nan" for o_area in o_areas]
+    o_area = np.array(o_areas, dtype=np.float64)
+    # columns which aren't asked for are left empty
+    no_column = [None] * len(uris)
+    feature_areas = format_decimals(o_area) if include_areas else no_column
+    intersection_areas = forward_percentages = reverse_percentages = no_column
+    has_proportion = no_column
+    if include_proportion:
+        i_area = np.array(i_areas, dtype=np.float64)
+        area = float(my_area)
+        within = np.array(is_w, dtype=bool)
+        contains = np.array(has_c, dtype=bool) & ~within
+        i_area = np.where(within, area, np.where(contains, o_area, i_area))
+        has_iarea = np.array([i_area_value != "nan" for i_area_value in i_areas], dtype=bool)
+        # a percentage of a feature without area is undefined
+        has_proportion = (np.array(has_oarea, dtype=bool) & (within | contains | has_iarea) & (o_area != 0) & (area != 0)).tolist()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            forward = np.where(within, 100.0, i_area / area * 100)
+            reverse = np.where(contains, 100.0, i_area / o_area * 100)
+        forward_percentages = format_decimals(forward)
+        reverse_percentages = format_decimals(reverse)
+        if include_areas:
+            intersection_areas = format_decimals(i_area)
+    overlaps = []
+    for uri, w, c, oarea_given, proportion_given, feature_area, intersection_area, forward_percentage, reverse_percentage in zip(
+            uris, is_w, has_c, has_oarea, has_proportion, feature_areas, intersection_areas, forward_percentages, reverse_percentages):
+        o_dict = {"uri": uri}
+        if include_within:
+            o_dict["isWithin"] = w
+        if include_contains:
+            o_dict["contains"] = c
+        if oarea_given:
             if include_areas:
-                o_dict['featureArea'] = str(o_area)
-            if include_proportion:
-                if include_within and is_w:
-                    my_proportion = d100
-                    other_proportion = (my_area / o_area) * d100
-                    i_area = my_area
-                elif include_contains and has_c:
-                    my_proportion = (o_area / my_area) * d100
-                    other_proportion = d100
-                    i_area = o_area
-                else:
-                    try:
-                        i_area = Decimal(b['iarea']['value'])
-                    except (LookupError, AttributeError):
-                        continue
-                    my_proportion = (i_area / my_area) * d100
-                    other_proportion = (i_area / o_area) * d100
+                o_dict['featureArea'] = feature_area
+            if proportion_given:
                 if include_areas:
-                    o_dict['intersectionArea'] = str(round(i_area, 8))
-                my_proportion = round(my_proportion, 8)
-                other_proportion = round(other_proportion, 8)
-                o_dict['forwardPercentage'] = str(my_proportion)
-                o_dict['reversePercentage'] = str(other_proportion)
+                    o_dict['intersectionArea'] = intersection_area
+                o_dict['forwardPercentage'] = forward_percentage
+                o_dict['reversePercentage'] = reverse_percentage
+        overlaps.append(o_dict)
+    return overlaps
+
 
+async def filter_overlaps_by_type(overlaps, output_featuretype_uri):
+    """
+    :return: only the overlaps which are of type output_featuretype_uri
+    :rtype: list
+    """
+    uris_to_check = [an_overlap if isinstance(an_overlap, str) else an_overlap['uri'] for an_overlap in overlaps]
+    type_matches = await check_types(uris_to_check, output_featuretype_uri)
+    final_overlaps = []
+    for an_overlap, uri_to_check in zip(overlaps, uris_to_check):
+        if type_matches[uri_to_check]:
+            final_overlaps.append(an_overlap)
+    return final_overlaps
+
+
+async def get_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, count=1000, offset=0, debug=False, cursor=None):
+    """
+    :param target_uri:
+    :type target_uri: str
+    :type include_areas: bool
+    :type include_proportion: bool
+    :type include_within: bool
+    :type include_contains: bool
+    :type linkset_filter: str
+    :param count:
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param debug: include the time in seconds taken by each SPARQL query in meta['timings']
+    :type debug: bool
+    :param cursor: keyset page from this cursor instead of using offset, CURSOR_START for the first page.
+     Keyset pages are ordered by overlapping uri rather than grouped by query.
+    :type cursor: str
+    :return:
+    """
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        offset = 0
+    # answered from the linkset snapshot if it is loaded and has the target
+    start = time.perf_counter()
+    pages = linkset_store.overlaps_pages(target_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count, offset, after)
+    if pages is not None:
+        timings = OrderedDict([("linkset_store", time.perf_counter() - start)])
+        explain.record_query("linkset_store", "overlaps", None, OrderedDict([('uri', target_uri), ('linkset', linksets_filter), ('count', count), ('offset', offset)]),
+                             sum(len(page) for page in pages), None, timings["linkset_store"], "local")
+    else:
+        # the overlaps, contains and within queries are independent so they are issued concurrently,
+        # their bindings are then merged in that order
+        queries = build_overlaps_queries("<{}>".format(str(target_uri)), include_areas, include_proportion, include_within, include_contains, linksets_filter, after=after)
+        # seconds taken by each query, reported in the order the queries were issued
+        timings = OrderedDict((name, None) for name, query_sparql in queries)
+        async def _timed_query(name, query_sparql):
+            query_bindings = []
+            start = time.perf_counter()
+            await query_build_response_bindings(query_sparql, count, offset, query_bindings, "overlaps")
+            timings[name] = time.perf_counter() - start
+            return query_bindings
+        pages = await asyncio.gather(*[_timed_query(name, query_sparql) for name, query_sparql in queries])
+    processing_start = time.perf_counter()
+    next_cursor = None
+    if after is None:
+        bindings = []
+        for query_bindings in pages:
+            bindings.extend(query_bindings)
+    else:
+        bindings, last_uri = merge_keyset_pages(pages, count, key=lambda b: b['o']['value'])
+        if last_uri is not None:
+            next_cursor = encode_cursor(last_uri)
+    if len(bindings) < 1:
+        meta = {'count': 0, 'offset': offset}
+        if cursor is not None:
+            meta['next_cursor'] = next_cursor
+        if debug:
+            meta['timings'] = timings
+        return meta, []
+    my_area, overlaps = build_overlaps(bindings, include_areas, include_proportion, include_within, include_contains)
+    metrics.processing_seconds.observe(time.perf_counter() - processing_start, "overlaps")
     meta = {
         'count': len(overlaps),
         'offset': offset,
     }
+    if cursor is not None:
+        meta['next_cursor'] = next_cursor
     if my_area and include_areas:
         meta['featureArea'] = str(my_area)
+    if debug:
+        meta['timings'] = timings
     final_overlaps = overlaps
     if output_featuretype_uri is not None:
-        final_overlaps = []
-        for an_overlap in overlaps:
-                if isinstance(an_overlap, str):
-                    uri_to_check = an_overlap
-                else:
-                    uri_to_check = an_overlap['uri']
-                type_match = await check_type(uri_to_check, output_featuretype_uri)
-                if type_match:
-                   final_overlaps.append(an_overlap)
+        final_overlaps = await filter_overlaps_by_type(overlaps, output_featuretype_uri)
     return meta, final_overlaps
 
 
+async def iter_page(page):
+    for b in page:
+        yield b
+
+
+async def iter_location_overlaps(target_uri, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, count=1000, offset=0):
+    """
+    Yield the overlaps of target_uri one at a time, in the same order and form as get_location_overlaps returns them.
+    All the queries are sent straight away, but each is read a row at a time and only after the previous one
+    is finished with, so memory use doesn't grow with the size of the results.
+    Output type filtering is done a chunk of overlaps at a time.
+    :return: async iterator of overlaps
+    """
+    pages = linkset_store.overlaps_pages(target_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter, count, offset)
+    if pages is not None:
+        query_iterators = [iter_page(page) for page in pages]
+    else:
+        queries = build_overlaps_queries("<{}>".format(str(target_uri)), include_areas, include_proportion, include_within, include_contains, linksets_filter)
+        query_iterators = [PrefetchedIterator(iter_response_bindings(query_sparql, count, offset, "overlaps")) for name, query_sparql in queries]
+    my_area = None
+    pending = []
+    try:
+        for query_iterator in query_iterators:
+            async for b in query_iterator:
+                if my_area is None and (include_areas or include_proportion):
+                    my_area = get_source_area(b)
+                an_overlap = build_overlap(b, my_area, include_areas, include_proportion, include_within, include_contains)
+                if output_featuretype_uri is None:
+                    yield an_overlap
+                    continue
+                pending.append(an_overlap)
+                if len(pending) >= TYPE_CHECK_CHUNK_SIZE:
+                    for an_overlap in await filter_overlaps_by_type(pending, output_featuretype_uri):
+                        yield an_overlap
+                    pending = []
+    finally:
+        for query_iterator in query_iterators:
+            await query_iterator.aclose()
+    if pending:
+        for an_overlap in await filter_overlaps_by_type(pending, output_featuretype_uri):
+            yield an_overlap
+
+
+async def get_location_overlaps_batch(target_uris, output_featuretype_uri, include_areas, include_proportion, include_within, include_contains, linksets_filter=None, chunk_size=OVERLAPS_BATCH_CHUNK_SIZE):
+    """
+    Get the overlaps of many target uris.
+    The targets are sent a chunk at a time in a VALUES block, so each chunk costs one round trip per
+    overlaps/contains/within query rather than one per target.
+    :param target_uris:
+    :type target_uris: list
+    :param chunk_size:
+    :type chunk_size: int
+    :return: meta, and a list of {"uri", "meta", "overlaps"} per distinct target uri in the order given
+    :rtype: tuple
+    """
+    target_uris = list(dict.fromkeys(str(u) for u in target_uris))
+    semaphore = asyncio.Semaphore(CROSSWALK_CONCURRENCY)
+    chunks = [target_uris[i:i + chunk_size] for i in range(0, len(target_uris), chunk_size)]
+    chunk_queries = [build_overlaps_queries("?src", include_areas, include_proportion, include_within, include_contains, linksets_filter, values_uris=chunk)
+                     for chunk in chunks]
+    # paging doesn't apply to a batch, every result for every target is returned
+    async def _query(query_sparql):
+        return [b async for b in iter_graphdb_bindings(query_sparql, limit=BATCH_QUERY_LIMIT, template="overlaps") if 'src' in b and 'o' in b]
+    query_results = await gather_bounded(semaphore, [_query(query_sparql) for queries in chunk_queries for name, query_sparql in queries])
+    bindings_by_uri = OrderedDict((u, []) for u in target_uris)
+    # results are in chunk order, then overlaps/contains/within order within a chunk, as for a single target
+    while query_results:
+        for b in query_results.pop(0):
+            bindings_by_uri[b['src']['value']].append(b)
+    results = []
+    for target_uri, bindings in bindings_by_uri.items():
+        result = {"uri": target_uri}
+        if len(bindings) < 1:
+            result["meta"], result["overlaps"] = {'count': 0, 'offset': 0}, []
+            results.append(result)
+            continue
+        try:
+            my_area, overlaps = build_overlaps(bindings, include_areas, include_proportion, include_within, include_contains)
+        except ReportableAPIError as e:
+            result["meta"], result["overlaps"] = {'count': 0, 'offset': 0, 'errorMessage': str(e)}, []
+            results.append(result)
+            continue
+        result["meta"] = {
+            'count': len(overlaps),
+            'offset': 0,
+        }
+        if my_area and include_areas:
+            result["meta"]['featureArea'] = str(my_area)
+        result["overlaps"] = overlaps
+        results.append(result)
+    if output_featuretype_uri is not None:
+        all_uris = [an_overlap if isinstance(an_overlap, str) else an_overlap['uri'] for result in results for an_overlap in result["overlaps"]]
+        type_matches = await check_types(all_uris, output_featuretype_uri)
+        for result in results:
+            result["overlaps"] = [an_overlap for an_overlap in result["overlaps"]
+                                  if type_matches[an_overlap if isinstance(an_overlap, str) else an_overlap['uri']]]
+    meta = {
+        'count': len(results),
+        'offset': 0,
+    }
+    return meta, results
+
+
 async def get_at_location(lat, lon, loci_type="any", count=1000, offset=0):
     """
     :param lat:
@@ -901,22 +1788,25 @@ async def get_at_location(lat, lon, loci_type="any", count=1000, offset=0):
     :param offset:
     :type offset: int
     :return:
+    :raises ReportableAPIError: if the geometry data service can't be reached or can't answer
     """
-    loop = asyncio.get_event_loop()
-    try:
-        gds_session = get_at_location.session_cache[loop]
-    except KeyError:
-        gds_session = ClientSession(loop=loop)
-        get_at_location.session_cache[loop] = gds_session
+    start = time.perf_counter()
+    local_resp = spatial_index.find_at_location(lat, lon, loci_type)
+    if local_resp is not None:
+        explain.record_query("spatial_index", "at_location", None, OrderedDict([('lat', lat), ('lon', lon), ('loci_type', loci_type)]),
+                             local_resp['count'], None, time.perf_counter() - start, "local")
+        meta = {
+            'count': local_resp['count'],
+            'offset': offset,
+        }
+        return meta, local_resp
+    gds_session = upstream.get_session(upstream.GEOM_DATA_SVC)
     row = {}
     results = {}
     counter = 0
     params = {
        "_format" : "application/json"
     }
-    formatted_resp = {
-        'ok': False
-    }
     http_ok = [200]
     if loci_type == 'any':
        search_by_latlng_url = GEOM_DATA_SVC_ENDPOINT + "/search/latlng/{},{}".format(lon,lat)
@@ -924,89 +1814,192 @@ async def get_at_location(lat, lon, loci_type="any", count=1000, offset=0):
        search_by_latlng_url = GEOM_DATA_SVC_ENDPOINT + "/search/latlng/{},{}/dataset/{}".format(lon, lat, loci_type)
 
     try:
-        resp = await gds_session.request('GET', search_by_latlng_url, params=params)
-        resp_content = await resp.text()
+        start = time.perf_counter()
+        async with gds_session.request('GET', search_by_latlng_url, params=params) as resp:
+            resp_content = await resp.read()
         if resp.status not in http_ok:
-            formatted_resp['errorMessage'] = "Could not connect to the geometry data service at {}. Error code {}".format(GEOM_DATA_SVC_ENDPOINT, resp.status)
-            return formatted_resp
+            raise ReportableAPIError("Could not connect to the geometry data service at {}. Error code {}".format(GEOM_DATA_SVC_ENDPOINT, resp.status))
+        decode_start = time.perf_counter()
         formatted_resp = loads(resp_content)
+        metrics.observe_upstream(upstream.GEOM_DATA_SVC, "at_location", decode_start - start, len(resp_content), time.perf_counter() - decode_start)
+        explain.record_query(upstream.GEOM_DATA_SVC, "at_location", search_by_latlng_url, params, formatted_resp.get('count'),
+                             len(resp_content), time.perf_counter() - start, "miss")
         formatted_resp['ok'] = True
     except ClientConnectorError:
-        formatted_resp['errorMessage'] = "Could not connect to the geometry data service at {}. Connection error thrown.".format(GEOM_DATA_SVC_ENDPOINT)
-        return formatted_resp
+        raise ReportableAPIError("Could not connect to the geometry data service at {}. Connection error thrown.".format(GEOM_DATA_SVC_ENDPOINT))
+    except asyncio.TimeoutError:
+        raise ReportableAPIError("The geometry data service at {} did not respond in time.".format(GEOM_DATA_SVC_ENDPOINT))
     meta = {
         'count': formatted_resp['count'],
         'offset': offset,
     }
     return meta, formatted_resp
-get_at_location.session_cache = {}
 
-async def query_es_endpoint(query, limit=10, offset=0):
+async def get_at_locations(lats, lons, loci_type="any"):
     """
-    Pass the ES query to the endpoint. The endpoint is specified in the config file.
-
-    :param query: the query text
-    :type query: str
-    :param limit:
-    :type limit: int
-    :param offset:
-    :type offset: int
+    Find the locations at each of a batch of points.
+    Points are answered together from the local spatial index if it has the datasets loaded, otherwise
+    the requests to the geometry data service are pipelined, GEOM_DATA_SVC_CONCURRENCY at a time.
+    :param lats:
+    :type lats: list
+    :param lons:
+    :type lons: list
     :return:
-    :rtype: dict
+    :rtype: tuple
     """
-    loop = asyncio.get_event_loop()
-    http_ok = [200]
-    try:
-        session = query_es_endpoint.session_cache[loop]
-    except KeyError:
-        session = ClientSession(loop=loop)
-        query_es_endpoint.session_cache[loop] = session
-    args = {
-        'q': query
-#        'limit': int(limit),
-#        'offset': int(offset),
-    }
+    async def get_at_location_or_error(lat, lon):
+        # a point the geometry data service couldn't answer gets an error response of its own
+        try:
+            meta, resp = await get_at_location(lat, lon, loci_type)
+        except ReportableAPIError as e:
+            return {'ok': False, 'errorMessage': str(e)}
+        return resp
 
-    formatted_resp = {
-        'ok': False
+    results = spatial_index.find_at_locations(lats, lons, loci_type)
+    if results is None:
+        semaphore = asyncio.Semaphore(GEOM_DATA_SVC_CONCURRENCY)
+        results = []
+        # points are scheduled a chunk at a time so a huge batch doesn't create a coroutine per point up front
+        chunk_size = GEOM_DATA_SVC_CONCURRENCY * 100
+        for i in range(0, len(lats), chunk_size):
+            chunk = zip(lats[i:i + chunk_size], lons[i:i + chunk_size])
+            results.extend(await gather_bounded(semaphore, [get_at_location_or_error(lat, lon) for lat, lon in chunk]))
+    meta = {
+        'count': len(results),
+        'offset': 0,
     }
+    return meta, results
+
+async def query_es_endpoint(body, template="label_search"):
+    """
+    Send a query DSL body to the label search endpoint. The endpoint is specified in the config file.
+
+    :param body: the _search request body
+    :type body: dict
+    :param template: name of the query, the query is timed under it in metrics
+    :type template: str
+    :return: the decoded _search response
+    :rtype: dict
+    """
+    session = upstream.get_session(upstream.ES)
+    start = time.perf_counter()
     try:
-        resp = await session.request('GET', ES_ENDPOINT, params=args)
-        resp_content = await resp.text()
-        if resp.status not in http_ok:
-            formatted_resp['errorMessage'] = "Could not connect to the label search engine. Error code {}".format(resp.status)
-            return formatted_resp
-        formatted_resp = loads(resp_content)
-        formatted_resp['ok'] = True
-        return formatted_resp
+        async with session.request('POST', ES_LABEL_SEARCH_ENDPOINT, json=body) as resp:
+            resp_content = await resp.read()
     except ClientConnectorError:
-        formatted_resp['errorMessage'] = "Could not connect to the label search engine. Connection error thrown."
-        return formatted_resp
-    return formatted_resp
-query_es_endpoint.session_cache = {}
+        raise ReportableAPIError("Could not connect to the label search engine. Connection error thrown.")
+    except asyncio.TimeoutError:
+        raise ReportableAPIError("The label search engine did not respond in time.")
+    if resp.status != 200:
+        raise ReportableAPIError("The label search engine could not answer the query. Error code {}".format(resp.status))
+    decode_start = time.perf_counter()
+    result = loads(resp_content)
+    metrics.observe_upstream(upstream.ES, template, decode_start - start, len(resp_content), time.perf_counter() - decode_start)
+    explain.record_query(upstream.ES, template, ES_LABEL_SEARCH_ENDPOINT, body, len(result.get('hits', {}).get('hits', [])),
+                         len(resp_content), time.perf_counter() - start, "miss")
+    return result
+query_es_endpoint.in_flight = {}
 
 
-async def search_location_by_label(query):
+async def search_location_by_label(query, count=10, offset=0, cursor=None, dataset=None):
     """
-    Query ElasticSearch endpoint and search by label of LOCI locations.
-    The query to ES is in the format of http://localhost:9200/_search?q=NSW
-
-    Returns response back from ES as-is.
+    Query the ElasticSearch endpoint and search by label of LOCI locations.
+    Results are cached in process, and identical searches in flight at once share one query.
 
     :param query: query string for text matching on label of LOCI locations
     :type query: str
-    :return:
-    :rtype: dict
+    :param count: number of locations to return, at most LABEL_SEARCH_MAX_COUNT
+    :type count: int
+    :param offset:
+    :type offset: int
+    :param cursor: page from this cursor instead of using offset, CURSOR_START for the first page
+    :type cursor: str
+    :param dataset: only return locations of the dataset with this uri
+    :type dataset: str
+    :return: meta and the locations found, each with its uri, label and score
+    :rtype: tuple
     """
-    resp = await query_es_endpoint(query)
+    query = label_search.normalise_query(query)
+    if len(query) > LABEL_SEARCH_MAX_QUERY_LENGTH:
+        raise InvalidSearchError("Query must be at most {} characters".format(LABEL_SEARCH_MAX_QUERY_LENGTH))
+    count = max(0, min(int(count), LABEL_SEARCH_MAX_COUNT))
+    offset = max(0, int(offset))
+    after = None
+    if cursor is not None:
+        offset = 0
+        after_value = decode_cursor(cursor)
+        if after_value:
+            try:
+                after = loads(after_value)
+            except ValueError:
+                raise InvalidCursorError("Invalid cursor \"{}\"".format(cursor))
+            if not isinstance(after, list):
+                raise InvalidCursorError("Invalid cursor \"{}\"".format(cursor))
+    elif offset + count > label_search.MAX_RESULT_WINDOW:
+        raise InvalidSearchError("offset + count must be at most {}, page with a cursor to go further".format(label_search.MAX_RESULT_WINDOW))
+    meta = {
+        'count': 0,
+        'offset': offset,
+        'total': 0,
+    }
+    if not query or count < 1:
+        if cursor is not None:
+            meta['next_cursor'] = None
+        return meta, []
 
-    if ('ok' in resp and resp['ok'] == False):
-        return resp
+    key = (query, count, offset, None if after is None else dumps(after), dataset or None)
+    cached = label_search_cache.get(key)
+    if cached is not None:
+        explain.record_cache("label_search_cache", hits=1)
+        total, locations, last_sort = cached
+    else:
+        explain.record_cache("label_search_cache", misses=1)
+        body = label_search.build_query(query, count, offset, after, dataset)
+        shared = key in query_es_endpoint.in_flight
+        start = time.perf_counter()
+        result = await coalesce(query_es_endpoint.in_flight, key, lambda: query_es_endpoint(body))
+        total, locations, last_sort = label_search.parse_hits(result)
+        if shared:
+            explain.record_query(upstream.ES, "label_search", ES_LABEL_SEARCH_ENDPOINT, body, len(locations),
+                                 None, time.perf_counter() - start, "shared")
+        elif not result.get('timed_out', False):
+            label_search_cache.set(key, (total, locations, last_sort))
+    meta['count'] = len(locations)
+    meta['total'] = total
+    if cursor is not None:
+        meta['next_cursor'] = encode_cursor(dumps(last_sort)) if len(locations) >= count and last_sort else None
+    return meta, locations
 
-    resp_object = {}
-    if 'hits' not in resp:
-        return resp_object
 
-    resp_object = resp
-    return resp_object
+async def suggest_location_by_label(query, count=10):
+    """
+    Suggest LOCI locations whose label, or one of its first words, starts with query.
+    Answered from the label index if one is loaded, otherwise by the label search.
 
+    :param query: the start of a label
+    :type query: str
+    :param count: number of locations to return, at most LABEL_SEARCH_MAX_COUNT
+    :type count: int
+    :return: meta and the locations suggested, each with its uri and label
+    :rtype: tuple
+    """
+    if len(query) > LABEL_SEARCH_MAX_QUERY_LENGTH:
+        raise InvalidSearchError("Query must be at most {} characters".format(LABEL_SEARCH_MAX_QUERY_LENGTH))
+    count = max(0, min(int(count), LABEL_SEARCH_MAX_COUNT))
+    start = time.perf_counter()
+    locations = label_index.suggest(query, count)
+    if locations is not None:
+        seconds = time.perf_counter() - start
+        metrics.processing_seconds.observe(seconds, "suggest")
+        explain.record_query("label_index", "suggest", None, OrderedDict([('query', query), ('count', count)]),
+                             len(locations), None, seconds, "local")
+        source = "label_index"
+    else:
+        search_meta, found = await search_location_by_label(query, count)
+        locations = [{'uri': location['uri'], 'label': location['label']} for location in found]
+        source = "label_search"
+    meta = {
+        'count': len(locations),
+        'source': source,
+    }
+    return meta, locations
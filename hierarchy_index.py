@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Precomputed closure index of the ASGS and Geofabric spatial hierarchies, for /location/within and
+/location/contains.
+
+The sfWithin and sfContains edges between the features of the indexed datasets are read from the triplestore
+once per release and saved to a file, which is loaded when the API starts. The index keeps the closure of each
+feature, the features it is within and the features it contains, sorted by uri. Feature ids are assigned in
+uri order, so a page of either is a slice of the closure found by offset, or by bisection for a cursor.
+Building it walks the (few) parents of each feature for within, and an Euler tour of the sfContains forest for
+contains: the features a feature contains are the slice of the preorder between its own position and the end
+of its subtree.
+
+A feature is left to the triplestore when the index can't answer for it exactly: if it is not in the index,
+if one of the edges its answer depends on leads outside of the indexed datasets, or (for contains) if a
+feature below it has more than one container so is not in its subtree slice.
+
+Run this module to build the index file:
+
+    python3 hierarchy_index.py --out hierarchy.idx
+"""
+import argparse
+import asyncio
+import logging
+import pickle
+from array import array
+from bisect import bisect_left, bisect_right
+
+INDEX_FORMAT = 2
+HIERARCHY_DATASETS = [
+    "http://linked.data.gov.au/dataset/asgs2016/",
+    "http://linked.data.gov.au/dataset/geofabric/",
+]
+NO_POSITION = -1
+
+
+def _csr(pairs, size):
+    """
+    :param pairs: (from id, to id) edges
+    :return: offsets and targets arrays, the targets of id i are targets[offsets[i]:offsets[i + 1]]
+    :rtype: tuple
+    """
+    counts = [0] * (size + 1)
+    for from_id, to_id in pairs:
+        counts[from_id + 1] += 1
+    for i in range(size):
+        counts[i + 1] += counts[i]
+    offsets = array('i', counts)
+    targets = array('i', bytes(4 * len(pairs)))
+    fill = list(counts[:size])
+    for from_id, to_id in pairs:
+        targets[fill[from_id]] = to_id
+        fill[from_id] += 1
+    return offsets, targets
+
+
+def _closure_csr(closure, fallback, size):
+    """
+    :param closure: function of an id returning the set of ids in its closure
+    :param fallback: ids left to the triplestore, their closures are not kept
+    :return: offsets and targets arrays, the closure of id i is targets[offsets[i]:offsets[i + 1]] in ascending order
+    :rtype: tuple
+    """
+    offsets = array('i', [0])
+    targets = array('i')
+    for node in range(size):
+        if node not in fallback:
+            targets.extend(sorted(closure(node)))
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+class HierarchyIndex(object):
+    """
+    Within and contains closure of the features of the indexed datasets
+    """
+    def __init__(self, uris, within_offsets, within_targets, contains_offsets, contains_targets,
+                 within_fallback, contains_fallback, linkset_version=None):
+        # sorted, so a uri's id is found by bisection and ids sort in the same order as uris
+        self.uris = uris
+        # closures, the ids of the features id i is within are within_targets[within_offsets[i]:within_offsets[i + 1]]
+        # in ascending order
+        self.within_offsets = within_offsets
+        self.within_targets = within_targets
+        self.contains_offsets = contains_offsets
+        self.contains_targets = contains_targets
+        self.within_fallback = set(within_fallback)
+        self.contains_fallback = set(contains_fallback)
+        self.linkset_version = linkset_version
+
+    def __len__(self):
+        return len(self.uris)
+
+    def id_of(self, uri):
+        """
+        :return: the id of uri, or None if it is not in the index
+        :rtype: int
+        """
+        i = bisect_left(self.uris, uri)
+        if i < len(self.uris) and self.uris[i] == uri:
+            return i
+        return None
+
+    def within_page(self, uri, count, offset=0, after=None):
+        """
+        :param after: uri the page starts after, instead of skipping offset uris
+        :return: a page of the uris uri is within in uri order, or None if the index can't answer for uri
+        :rtype: list
+        """
+        node = self.id_of(uri)
+        if node is None or node in self.within_fallback:
+            return None
+        return self._page(self.within_offsets, self.within_targets, node, count, offset, after)
+
+    def contains_page(self, uri, count, offset=0, after=None):
+        """
+        :param after: uri the page starts after, instead of skipping offset uris
+        :return: a page of the uris uri contains in uri order, or None if the index can't answer for uri
+        :rtype: list
+        """
+        node = self.id_of(uri)
+        if node is None or node in self.contains_fallback:
+            return None
+        return self._page(self.contains_offsets, self.contains_targets, node, count, offset, after)
+
+    def _page(self, offsets, targets, node, count, offset, after):
+        lo = offsets[node]
+        hi = offsets[node + 1]
+        if after is None:
+            start = lo + offset
+        else:
+            start = bisect_left(targets, bisect_right(self.uris, after), lo, hi)
+        return [self.uris[target] for target in targets[start:min(start + count, hi)]]
+
+    @classmethod
+    def build(cls, within_edges, contains_edges, reified_within_edges, reified_contains_edges, datasets,
+              linkset_version=None):
+        """
+        Build the index from the (subject uri, object uri) edges of each kind.
+        Only edges whose subject is in one of the datasets should be given.
+        :param datasets: uri prefixes of the indexed datasets
+        :type datasets: list
+        :rtype: HierarchyIndex
+        """
+        def in_datasets(uri):
+            return any(uri.startswith(prefix) for prefix in datasets)
+        edge_lists = (within_edges, contains_edges, reified_within_edges, reified_contains_edges)
+        uris = set()
+        for edges in edge_lists:
+            for s, o in edges:
+                uris.add(s)
+                if in_datasets(o):
+                    uris.add(o)
+        uris = sorted(uris)
+        ids = {uri: i for i, uri in enumerate(uris)}
+        size = len(uris)
+
+        # subjects with an edge leading outside of the index
+        outside = [set(), set(), set(), set()]
+        id_edges = []
+        for edges, leaves in zip(edge_lists, outside):
+            pairs = []
+            for s, o in edges:
+                if o in ids:
+                    pairs.append((ids[s], ids[o]))
+                else:
+                    leaves.add(ids[s])
+            id_edges.append(sorted(set(pairs)))
+        within_pairs, contains_pairs, reified_within_pairs, reified_contains_pairs = id_edges
+        within_offsets, within_targets = _csr(within_pairs, size)
+        reified_within_offsets, reified_within_targets = _csr(reified_within_pairs, size)
+        reified_contains_offsets, reified_contains_targets = _csr(reified_contains_pairs, size)
+        children_offsets, children_targets = _csr(contains_pairs, size)
+        containers_offsets, containers_targets = _csr([(c, p) for p, c in contains_pairs], size)
+        within_children_offsets, within_children_targets = _csr([(p, c) for c, p in within_pairs], size)
+
+        def closure(starts, offsets, targets):
+            found = set(starts)
+            pending = list(starts)
+            while pending:
+                node = pending.pop()
+                for i in range(offsets[node], offsets[node + 1]):
+                    if targets[i] not in found:
+                        found.add(targets[i])
+                        pending.append(targets[i])
+            return found
+
+        # within: a feature's answer depends on the within edges of every feature above it
+        within_fallback = closure(outside[0], within_children_offsets, within_children_targets) | outside[2]
+
+        # contains: each feature's first container is its parent in the Euler tour forest
+        tree_parent = [NO_POSITION] * size
+        extra_containers = set()
+        for node in range(size):
+            first = containers_offsets[node]
+            if containers_offsets[node + 1] > first:
+                tree_parent[node] = containers_targets[first]
+                extra_containers.update(containers_targets[first + 1:containers_offsets[node + 1]])
+        contains_preorder = array('i')
+        contains_position = array('i', [NO_POSITION]) * size
+        contains_end = array('i', [NO_POSITION]) * size
+        for root in range(size):
+            if tree_parent[root] != NO_POSITION:
+                continue
+            stack = [(root, False)]
+            while stack:
+                node, finished = stack.pop()
+                if finished:
+                    contains_end[node] = len(contains_preorder)
+                    continue
+                contains_position[node] = len(contains_preorder)
+                contains_preorder.append(node)
+                stack.append((node, True))
+                for i in range(children_offsets[node + 1] - 1, children_offsets[node] - 1, -1):
+                    child = children_targets[i]
+                    if tree_parent[child] == node and contains_position[child] == NO_POSITION:
+                        stack.append((child, False))
+        # a feature below more than one container is missing from the subtree slices of all but the first,
+        # and an edge leading outside of the index is missing from every slice above it
+        contains_fallback = closure(extra_containers | outside[1], containers_offsets, containers_targets)
+        contains_fallback |= outside[3]
+        contains_fallback.update(node for node in range(size) if contains_position[node] == NO_POSITION)
+
+        def within_closure(node):
+            found = set(reified_within_targets[reified_within_offsets[node]:reified_within_offsets[node + 1]])
+            found |= closure(within_targets[within_offsets[node]:within_offsets[node + 1]], within_offsets, within_targets)
+            return found
+
+        def contains_closure(node):
+            found = set(reified_contains_targets[reified_contains_offsets[node]:reified_contains_offsets[node + 1]])
+            found.update(contains_preorder[contains_position[node] + 1:contains_end[node]])
+            return found
+
+        within_closure_offsets, within_closure_targets = _closure_csr(within_closure, within_fallback, size)
+        contains_closure_offsets, contains_closure_targets = _closure_csr(contains_closure, contains_fallback, size)
+        return cls(uris, within_closure_offsets, within_closure_targets, contains_closure_offsets,
+                   contains_closure_targets, within_fallback, contains_fallback, linkset_version=linkset_version)
+
+    def save(self, path):
+        with open(path, 'wb') as index_file:
+            pickle.dump({
+                'format': INDEX_FORMAT,
+                'linkset_version': self.linkset_version,
+                'uris': self.uris,
+                'within_offsets': self.within_offsets,
+                'within_targets': self.within_targets,
+                'contains_offsets': self.contains_offsets,
+                'contains_targets': self.contains_targets,
+                'within_fallback': sorted(self.within_fallback),
+                'contains_fallback': sorted(self.contains_fallback),
+            }, index_file, protocol=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as index_file:
+            data = pickle.load(index_file)
+        if data.pop('format') != INDEX_FORMAT:
+            raise ValueError("{} is not a hierarchy index of format {}".format(path, INDEX_FORMAT))
+        return cls(**data)
+
+
+hierarchy_index = None
+
+
+def load_hierarchy_index(path, linkset_version):
+    """
+    Load the hierarchy index file, if one is configured and it was built from the loaded linkset version
+    :rtype: HierarchyIndex
+    """
+    global hierarchy_index
+    if not path:
+        return None
+    index = HierarchyIndex.load(path)
+    if index.linkset_version != str(linkset_version):
+        logging.warning("Hierarchy index {} was built for linkset version {}, not {}. Not using it."
+                        .format(path, index.linkset_version, linkset_version))
+        return None
+    hierarchy_index = index
+    logging.info("Loaded the hierarchy index of {} features from {}".format(len(index), path))
+    return index
+
+
+def within_page(uri, count, offset=0, after=None):
+    """
+    :return: a page of the uris uri is within in uri order, or None if it has to be answered by the triplestore
+    :rtype: list
+    """
+    if hierarchy_index is None:
+        return None
+    return hierarchy_index.within_page(uri, count, offset, after)
+
+
+def contains_page(uri, count, offset=0, after=None):
+    """
+    :return: a page of the uris uri contains in uri order, or None if it has to be answered by the triplestore
+    :rtype: list
+    """
+    if hierarchy_index is None:
+        return None
+    return hierarchy_index.contains_page(uri, count, offset, after)
+
+
+EDGES_SPARQL = """\
+PREFIX geo: <http://www.opengis.net/ont/geosparql#>
+SELECT ?s ?o WHERE {
+    ?s <PREDICATE> ?o .
+    FILTER(<DATASETS_FILTER>)
+}
+"""
+REIFIED_EDGES_SPARQL = """\
+PREFIX geo: <http://www.opengis.net/ont/geosparql#>
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+SELECT ?s ?o WHERE {
+    ?st rdf:subject ?s ;
+        rdf:predicate <PREDICATE> ;
+        rdf:object ?o .
+    FILTER(<DATASETS_FILTER>)
+}
+"""
+
+
+async def get_edges(template, predicate, datasets):
+    """
+    :return: the (subject uri, object uri) edges of predicate whose subject is in one of the datasets
+    :rtype: list
+    """
+    from functions import iter_graphdb_bindings, BATCH_QUERY_LIMIT
+    datasets_filter = " || ".join("STRSTARTS(STR(?s), \"{}\")".format(prefix) for prefix in datasets)
+    sparql = template.replace("<PREDICATE>", predicate).replace("<DATASETS_FILTER>", datasets_filter)
+    edges = []
+    async for b in iter_graphdb_bindings(sparql, limit=BATCH_QUERY_LIMIT):
+        if 's' in b and 'o' in b and b['o']['type'] == 'uri':
+            edges.append((b['s']['value'], b['o']['value']))
+    return edges
+
+
+async def build_from_triplestore(datasets, linkset_version):
+    within_edges, contains_edges, reified_within_edges, reified_contains_edges = await asyncio.gather(
+        get_edges(EDGES_SPARQL, "geo:sfWithin", datasets),
+        get_edges(EDGES_SPARQL, "geo:sfContains", datasets),
+        get_edges(REIFIED_EDGES_SPARQL, "geo:sfWithin", datasets),
+        get_edges(REIFIED_EDGES_SPARQL, "geo:sfContains", datasets),
+    )
+    print("{} within, {} contains, {} reified within and {} reified contains edges".format(
+        len(within_edges), len(contains_edges), len(reified_within_edges), len(reified_contains_edges)))
+    return HierarchyIndex.build(within_edges, contains_edges, reified_within_edges, reified_contains_edges,
+                                datasets, linkset_version=linkset_version)
+
+
+def main():
+    from config import HIERARCHY_INDEX_PATH, LINKSET_VERSION
+    parser = argparse.ArgumentParser(description="Build the within/contains closure index of the spatial hierarchies")
+    parser.add_argument("--out", default=HIERARCHY_INDEX_PATH,
+                        help="Path to write the index to (default HIERARCHY_INDEX_PATH)")
+    parser.add_argument("--dataset", action="append", dest="datasets",
+                        help="Uri prefix of a dataset to index, may be repeated (default ASGS 2016 and Geofabric)")
+    args = parser.parse_args()
+    if not args.out:
+        parser.error("No index path given, set HIERARCHY_INDEX_PATH or pass --out")
+    loop = asyncio.get_event_loop()
+    index = loop.run_until_complete(build_from_triplestore(args.datasets or HIERARCHY_DATASETS, LINKSET_VERSION))
+    index.save(args.out)
+    print("{} features, within answered for {} and contains for {}".format(
+        len(index), len(index) - len(index.within_fallback), len(index) - len(index.contains_fallback)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Local prefix index of the location labels, for /location/suggest.
+
+Built from the same location_labels.jsonl search/process.sh loads into Elasticsearch (one
+{"location_uri": ..., "label": ...} object per line) into a directory of .npy column files:
+
+    uris.npy, uri_offsets.npy       uri of each location, as one UTF-8 byte string and the offset of each uri
+    labels.npy, label_offsets.npy   label of each location, in the same way
+    keys.npy, key_offsets.npy       normalised label of each location (whitespace collapsed, lower case)
+    suffix_starts.npy               offset in keys.npy of each word start of each normalised label, sorted by the
+                                    text from there to the end of its label
+    suffix_locations.npy            location of each suffix
+    top_prefixes.npy, top_prefix_offsets.npy
+                                    every prefix of the suffixes which more than SCAN_LIMIT suffixes start with,
+                                    in sorted order
+    top_locations.npy, top_offsets.npy
+                                    the TOP_COUNT best ranked locations of each of those prefixes
+
+Every label which has a word starting with a prefix is found by two binary searches of the sorted suffixes.
+Labels which start with the prefix are ranked first, then shorter labels. When few enough suffixes match they
+are ranked as the query is answered, the best locations of prefixes matching more, which are the short
+prefixes a suggest is first asked for, are ranked when the index is built.
+The columns are memory-mapped, so a worker starts without reading the index, and every worker shares the same
+pages of the OS page cache. NumPy is required to use the index.
+
+Run this module to build the index:
+
+    python3 label_index.py --labels location_labels.jsonl --out labels
+"""
+import argparse
+import json
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from label_search import normalise_query
+
+INDEX_FORMAT = 2
+COLUMNS = ('uris', 'uri_offsets', 'labels', 'label_offsets', 'keys', 'key_offsets', 'suffix_starts', 'suffix_locations',
+           'top_prefixes', 'top_prefix_offsets', 'top_locations', 'top_offsets')
+# Only the first words of a label can be matched by prefix, which bounds the size of the index
+MAX_WORD_STARTS = 8
+# Most suffixes matching a prefix which are ranked as a query is answered, prefixes with more are ranked at build time
+SCAN_LIMIT = 2000
+# Number of locations kept for each prefix ranked at build time, the most a suggest for such a prefix returns
+TOP_COUNT = 100
+# Labels longer than this, in bytes, are ranked as if they were this long
+MAX_RANKED_LENGTH = 0xffff
+
+
+def _concat(values):
+    """
+    :return: the UTF-8 encoding of values as one byte array, and the offset of each value in it
+    :rtype: tuple
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def word_starts(key):
+    """
+    :return: offset in key, in bytes, of each of its first MAX_WORD_STARTS words
+    :rtype: list
+    """
+    encoded = key.encode('utf-8')
+    starts = [0] if encoded else []
+    position = encoded.find(b" ")
+    while position >= 0 and len(starts) < MAX_WORD_STARTS:
+        starts.append(position + 1)
+        position = encoded.find(b" ", position + 1)
+    return starts
+
+
+def rank_suffixes(suffix_starts, suffix_locations, key_offsets, label_offsets):
+    """
+    :return: a rank of each suffix, lower is better: a suffix at the start of its label first, then the shorter
+     label, then the first location, with the location in the low 32 bits
+    :rtype: numpy.ndarray
+    """
+    locations = suffix_locations.astype(np.int64)
+    not_label_start = suffix_starts != key_offsets[locations]
+    lengths = np.minimum(label_offsets[locations + 1] - label_offsets[locations], MAX_RANKED_LENGTH)
+    # one int64 sort of (not a label start, label length, location) is much quicker than a lexsort
+    return (not_label_start * (MAX_RANKED_LENGTH + 1) + lengths) << 32 | locations
+
+
+def best_locations(ranks, count):
+    """
+    :param ranks: ranks of suffixes from rank_suffixes, in any order
+    :return: the best ranked count distinct locations
+    :rtype: list
+    """
+    # a location has at most MAX_WORD_STARTS suffixes, so the best distinct locations are among these
+    keep = count * MAX_WORD_STARTS
+    if len(ranks) > keep:
+        ranks = np.partition(ranks, keep - 1)[:keep]
+    locations = []
+    seen = set()
+    for rank in np.sort(ranks).tolist():
+        location = rank & 0xffffffff
+        if location in seen:
+            continue
+        seen.add(location)
+        locations.append(location)
+        if len(locations) >= count:
+            break
+    return locations
+
+
+class LabelIndex(object):
+    """
+    Memory-mapped sorted word-start suffixes of the location labels
+    """
+    def __init__(self, path, linkset_version, uris, uri_offsets, labels, label_offsets, keys, key_offsets,
+                 suffix_starts, suffix_locations, top_prefixes, top_prefix_offsets, top_locations, top_offsets):
+        self.path = path
+        self.linkset_version = linkset_version
+        # plain ndarray views of the memory-mapped columns, which index without the overhead of np.memmap
+        self.uris = np.asarray(uris)
+        self.uri_offsets = np.asarray(uri_offsets)
+        self.labels = np.asarray(labels)
+        self.label_offsets = np.asarray(label_offsets)
+        self.keys = np.asarray(keys)
+        self.key_offsets = np.asarray(key_offsets)
+        self.suffix_starts = np.asarray(suffix_starts)
+        self.suffix_locations = np.asarray(suffix_locations)
+        self.top_prefixes = np.asarray(top_prefixes)
+        self.top_prefix_offsets = np.asarray(top_prefix_offsets)
+        self.top_locations = np.asarray(top_locations)
+        self.top_offsets = np.asarray(top_offsets)
+        # and memoryviews of those read a value at a time, which are quicker still to index
+        self._uris = memoryview(self.uris)
+        self._uri_offsets = memoryview(self.uri_offsets)
+        self._labels = memoryview(self.labels)
+        self._label_offsets = memoryview(self.label_offsets)
+        self._keys = memoryview(self.keys)
+        self._key_offsets = memoryview(self.key_offsets)
+        self._suffix_starts = memoryview(self.suffix_starts)
+        self._suffix_locations = memoryview(self.suffix_locations)
+        self._top_prefixes = memoryview(self.top_prefixes)
+        self._top_prefix_offsets = memoryview(self.top_prefix_offsets)
+
+    def __len__(self):
+        return len(self.uri_offsets) - 1
+
+    def uri(self, location):
+        return str(self._uris[self._uri_offsets[location]:self._uri_offsets[location + 1]], 'utf-8')
+
+    def label(self, location):
+        return str(self._labels[self._label_offsets[location]:self._label_offsets[location + 1]], 'utf-8')
+
+    def _suffix_prefix(self, i, length):
+        """
+        :return: at most the first length bytes of suffix i
+        :rtype: bytes
+        """
+        start = self._suffix_starts[i]
+        end = self._key_offsets[self._suffix_locations[i] + 1]
+        return self._keys[start:min(start + length, end)].tobytes()
+
+    def _bisect(self, prefix, right=False):
+        lo, hi = 0, len(self._suffix_starts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._suffix_prefix(mid, len(prefix))
+            if found < prefix or (right and found == prefix):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _top_prefix(self, i):
+        return self._top_prefixes[self._top_prefix_offsets[i]:self._top_prefix_offsets[i + 1]].tobytes()
+
+    def _top_locations(self, prefix):
+        """
+        :return: the locations ranked at build time for prefix
+        :rtype: numpy.ndarray
+        """
+        lo, hi = 0, len(self._top_prefix_offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._top_prefix(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo >= len(self._top_prefix_offsets) - 1 or self._top_prefix(lo) != prefix:
+            raise KeyError(prefix)
+        return self.top_locations[self.top_offsets[lo]:self.top_offsets[lo + 1]]
+
+    def suggest(self, query, count=10):
+        """
+        :param query: the start of a label, or of any of its first words
+        :param count: number of locations, at most TOP_COUNT are returned for a prefix matching more than
+         SCAN_LIMIT suffixes
+        :return: uri and label of at most count locations, those whose label starts with query first, then
+         shorter labels first
+        :rtype: list
+        """
+        prefix = normalise_query(query).encode('utf-8')
+        if not prefix or count < 1:
+            return []
+        lo = self._bisect(prefix)
+        hi = self._bisect(prefix, right=True)
+        if lo >= hi:
+            return []
+        if hi - lo > SCAN_LIMIT:
+            locations = self._top_locations(prefix)[:count].tolist()
+        else:
+            ranks = rank_suffixes(self.suffix_starts[lo:hi], self.suffix_locations[lo:hi], self.key_offsets, self.label_offsets)
+            locations = best_locations(ranks, count)
+        return [{'uri': self.uri(location), 'label': self.label(location)} for location in locations]
+
+    @staticmethod
+    def _rank_prefixes(keys, key_offsets, label_offsets, suffix_starts, suffix_locations):
+        """
+        Rank the locations of every prefix more than SCAN_LIMIT suffixes start with, by splitting the sorted
+        suffixes into runs sharing one more byte at a time, for as long as a run is longer than SCAN_LIMIT
+        :return: the columns top_prefixes, top_prefix_offsets, top_locations and top_offsets
+        :rtype: dict
+        """
+        ranks = rank_suffixes(suffix_starts, suffix_locations, key_offsets, label_offsets)
+        ends = key_offsets[suffix_locations.astype(np.int64) + 1]
+        last_key_byte = max(len(keys) - 1, 0)
+
+        def long_runs(lo, hi, position):
+            """
+            :return: (start, end) of each run of more than SCAN_LIMIT suffixes in [lo, hi) with the same byte at
+             position, suffixes which end before it don't start with any longer prefix
+            """
+            positions = suffix_starts[lo:hi] + position
+            next_bytes = np.where(positions < ends[lo:hi], keys[np.minimum(positions, last_key_byte)], -1)
+            boundaries = np.flatnonzero(next_bytes[1:] != next_bytes[:-1]) + 1
+            starts = [0] + boundaries.tolist()
+            run_ends = boundaries.tolist() + [hi - lo]
+            return [(lo + start, lo + end) for start, end in zip(starts, run_ends)
+                    if end - start > SCAN_LIMIT and next_bytes[start] >= 0]
+
+        prefixes, top_locations = [], []
+        # a preorder walk of the prefixes, children pushed in reverse so prefixes are recorded in sorted order
+        stack = [(lo, hi, 1) for lo, hi in reversed(long_runs(0, len(suffix_starts), 0))]
+        while stack:
+            lo, hi, length = stack.pop()
+            start = int(suffix_starts[lo])
+            prefixes.append(keys[start:start + length].tobytes())
+            top_locations.append(best_locations(ranks[lo:hi], TOP_COUNT))
+            stack.extend((run_lo, run_hi, length + 1) for run_lo, run_hi in reversed(long_runs(lo, hi, length)))
+        columns = {}
+        columns['top_prefixes'] = np.frombuffer(b"".join(prefixes), dtype=np.uint8)
+        columns['top_prefix_offsets'] = np.zeros(len(prefixes) + 1, dtype=np.int64)
+        np.cumsum([len(prefix) for prefix in prefixes], out=columns['top_prefix_offsets'][1:])
+        columns['top_locations'] = np.array([location for locations in top_locations for location in locations], dtype=np.int32)
+        columns['top_offsets'] = np.zeros(len(top_locations) + 1, dtype=np.int64)
+        np.cumsum([len(locations) for locations in top_locations], out=columns['top_offsets'][1:])
+        return columns
+
+    @classmethod
+    def build(cls, path, locations, linkset_version=None):
+        """
+        Write an index
+        :param locations: (uri, label) of each location
+        :return: the index
+        :rtype: LabelIndex
+        """
+        uris, labels = [], []
+        for uri, label in locations:
+            if uri and label:
+                uris.append(uri)
+                labels.append(label)
+        keys = [normalise_query(label) for label in labels]
+        columns = {}
+        columns['uris'], columns['uri_offsets'] = _concat(uris)
+        columns['labels'], columns['label_offsets'] = _concat(labels)
+        columns['keys'], columns['key_offsets'] = _concat(keys)
+        key_bytes = columns['keys'].tobytes()
+        key_offsets = columns['key_offsets']
+        suffixes = [(int(key_offsets[location]) + start, location)
+                    for location, key in enumerate(keys) for start in word_starts(key)]
+        suffixes.sort(key=lambda suffix: (key_bytes[suffix[0]:key_offsets[suffix[1] + 1]], suffix[1]))
+        columns['suffix_starts'] = np.array([start for start, location in suffixes], dtype=np.int64)
+        columns['suffix_locations'] = np.array([location for start, location in suffixes], dtype=np.int32)
+        columns.update(cls._rank_prefixes(columns['keys'], key_offsets, columns['label_offsets'],
+                                          columns['suffix_starts'], columns['suffix_locations']))
+
+        os.makedirs(path, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(path, name + ".npy"), columns[name])
+        # meta.json is written last, so an index which wasn't finished can't be loaded
+        with open(os.path.join(path, "meta.json"), 'w') as meta_file:
+            json.dump({'format': INDEX_FORMAT, 'linkset_version': linkset_version}, meta_file)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        if meta['format'] != INDEX_FORMAT:
+            raise ValueError("{} is not a label index of format {}".format(path, INDEX_FORMAT))
+        columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in COLUMNS}
+        return cls(path, meta['linkset_version'], **columns)
+
+
+label_index = None
+
+
+def load_label_index(path, linkset_version):
+    """
+    Load the label index, if one is configured and it was built for the loaded linkset version
+    :rtype: LabelIndex
+    """
+    global label_index
+    if not path:
+        return None
+    if np is None:
+        logging.warning("numpy is not installed, not using the label index {}".format(path))
+        return None
+    index = LabelIndex.load(path)
+    if index.linkset_version != str(linkset_version):
+        logging.warning("Label index {} was built for linkset version {}, not {}. Not using it."
+                        .format(path, index.linkset_version, linkset_version))
+        return None
+    label_index = index
+    logging.info("Loaded the label index of {} locations from {}".format(len(index), path))
+    return index
+
+
+def suggest(query, count=10):
+    """
+    :return: the suggestions for query, or None if there is no label index loaded
+    :rtype: list
+    """
+    if label_index is None:
+        return None
+    return label_index.suggest(query, count)
+
+
+def read_location_labels(path):
+    """
+    :return: (uri, label) of each line of a location_labels.jsonl file
+    """
+    with open(path, encoding='utf-8') as labels_file:
+        for line in labels_file:
+            if line.strip():
+                location = json.loads(line)
+                yield location.get('location_uri'), location.get('label')
+
+
+def main():
+    from config import LABEL_INDEX_PATH, LINKSET_VERSION
+    parser = argparse.ArgumentParser(description="Build the label index used by /location/suggest")
+    parser.add_argument("--labels", default="location_labels.jsonl",
+                        help="location_labels.jsonl to read the labels from (default location_labels.jsonl)")
+    parser.add_argument("--out", default=LABEL_INDEX_PATH,
+                        help="Directory to write the index to (default LABEL_INDEX_PATH)")
+    args = parser.parse_args()
+    if not args.out:
+        parser.error("No index path given, set LABEL_INDEX_PATH or pass --out")
+    if np is None:
+        parser.error("numpy is required to build a label index")
+    index = LabelIndex.build(args.out, read_location_labels(args.labels), linkset_version=str(LINKSET_VERSION))
+    print("{} labels, {} word starts, written to {}".format(len(index), len(index.suffix_starts), args.out))
+
+
+if __name__ == "__main__":
+    main()
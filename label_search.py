@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Elasticsearch query DSL for the label search of find-by-label.
+
+The query text is matched against the label field of the location documents search/process.sh indexes, as
+whole words, or as a phrase whose last word may be a prefix, so a label can be found while it is being typed.
+Results can be filtered to the locations of one dataset by uri prefix. Only uri and label are returned, and
+results are sorted by score then uri so a page can start from an offset or after the last result of the page
+before it (search_after).
+"""
+
+# Elasticsearch's default index.max_result_window, from + size must not be beyond it
+MAX_RESULT_WINDOW = 10000
+# Number of terms the last word of a query is expanded to as a prefix
+PREFIX_MAX_EXPANSIONS = 50
+LABEL_FIELD = "label"
+# keyword sub-fields Elasticsearch maps string fields with by default, for exact sorting and filtering
+URI_KEYWORD_FIELD = "uri.keyword"
+SOURCE_FIELDS = ["uri", "label"]
+
+
+def normalise_query(query):
+    """
+    :return: the query with whitespace collapsed and in lower case, which the standard analyzer matches
+     the same as the query it came from
+    :rtype: str
+    """
+    return " ".join(str(query).split()).lower()
+
+
+def build_query(query, count, offset=0, after=None, dataset=None):
+    """
+    :param query: normalised query text
+    :type query: str
+    :param after: sort values of the last result of the page before, to page with search_after instead of offset
+    :type after: list
+    :param dataset: only match locations whose uri starts with this dataset uri
+    :type dataset: str
+    :return: the body of a _search request
+    :rtype: dict
+    """
+    body = {
+        'size': int(count),
+        '_source': SOURCE_FIELDS,
+        'query': {
+            'bool': {
+                'should': [
+                    {'match': {LABEL_FIELD: {'query': query, 'operator': "and"}}},
+                    {'match_phrase_prefix': {LABEL_FIELD: {'query': query, 'max_expansions': PREFIX_MAX_EXPANSIONS}}},
+                ],
+                'minimum_should_match': 1,
+            },
+        },
+        'sort': ["_score", {URI_KEYWORD_FIELD: "asc"}],
+    }
+    if dataset:
+        body['query']['bool']['filter'] = [{'prefix': {URI_KEYWORD_FIELD: dataset.rstrip("/") + "/"}}]
+    if after:
+        body['search_after'] = list(after)
+    else:
+        body['from'] = int(offset)
+    return body
+
+
+def parse_hits(response):
+    """
+    :param response: the decoded _search response
+    :type response: dict
+    :return: the total number of matches, the locations of the page, and the sort values of its last result
+    :rtype: tuple
+    """
+    hits = response.get('hits', {})
+    total = hits.get('total')
+    if isinstance(total, dict):
+        # Elasticsearch 7 and later
+        total = total.get('value')
+    locations = []
+    last_sort = None
+    for hit in hits.get('hits', []):
+        source = hit.get('_source', {})
+        locations.append({
+            'uri': source.get('uri'),
+            'label': source.get('label'),
+            'score': hit.get('_score'),
+        })
+        last_sort = hit.get('sort')
+    return total, locations, last_sort
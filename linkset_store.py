@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Local snapshot of the linksets, for answering get_location_overlaps without the triplestore.
+
+The linkset statements (the reified sfOverlaps, transitiveSfOverlap, sfContains and sfWithin statements of
+mb16cc, addrcatch, addr1605mb16 etc., with the linkset each is part of), the direct triples of those
+predicates and the geox:hasAreaM2 areas (EPSG:3577) of the features are exported once per release into a
+directory of .npy column files:
+
+    uris.npy, uri_offsets.npy   every uri in sorted order, as one UTF-8 byte string and the offset of each uri
+    areas.npy                   area of each uri, NaN if it has none
+    edge_keys.npy               subject id * EDGE_CODES + edge code of each statement or triple, sorted
+    edge_objects.npy            object id of each statement or triple
+    edge_linksets.npy           index in meta.json's linksets of the linkset of each statement, -1 for triples
+
+The columns are memory-mapped, so every worker shares the same pages of the OS page cache, and the
+statements of a feature are found by a binary search of edge_keys. The overlaps, contains and within
+queries of get_location_overlaps are answered from these arrays, giving the same bindings the triplestore
+would, with the overlapping features in uri order.
+
+Features which aren't in the snapshot, and linkset filters for linksets it doesn't have, are still sent to
+the triplestore. NumPy is required to use a snapshot.
+
+Run this module to export a snapshot from the triplestore, or from N-Triples dumps of the linksets and areas:
+
+    python3 linkset_store.py --out linksets
+    python3 linkset_store.py --out linksets --ntriples mb16cc.nt addrcatch.nt areas.nt
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STORE_FORMAT = 1
+COLUMNS = ('uris', 'uri_offsets', 'areas', 'edge_keys', 'edge_objects', 'edge_linksets')
+PREDICATES = (
+    "http://www.opengis.net/ont/geosparql#sfOverlaps",
+    "http://linked.data.gov.au/def/geox#transitiveSfOverlap",
+    "http://www.opengis.net/ont/geosparql#sfContains",
+    "http://www.opengis.net/ont/geosparql#sfWithin",
+)
+SF_OVERLAPS, TRANSITIVE_SF_OVERLAP, SF_CONTAINS, SF_WITHIN = range(len(PREDICATES))
+# a predicate's edge code is its index for direct triples, or its index + len(PREDICATES) for linkset statements
+EDGE_CODES = 2 * len(PREDICATES)
+NO_LINKSET = -1
+
+RDF_SUBJECT = "http://www.w3.org/1999/02/22-rdf-syntax-ns#subject"
+RDF_PREDICATE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#predicate"
+RDF_OBJECT = "http://www.w3.org/1999/02/22-rdf-syntax-ns#object"
+IS_PART_OF = "http://purl.org/dc/terms/isPartOf"
+HAS_AREA_M2 = "http://linked.data.gov.au/def/geox#hasAreaM2"
+IN_CRS = "http://linked.data.gov.au/def/geox#inCRS"
+DT_VALUE = "http://linked.data.gov.au/def/datatype/value"
+EPSG_3577 = "http://www.opengis.net/def/crs/EPSG/0/3577"
+XSD_BOOLEAN = "http://www.w3.org/2001/XMLSchema#boolean"
+XSD_DOUBLE = "http://www.w3.org/2001/XMLSchema#double"
+
+
+def edge_code(predicate, reified):
+    return predicate + len(PREDICATES) if reified else predicate
+
+
+class LinksetStore(object):
+    """
+    Memory-mapped columns of the linkset statements, hierarchy triples and areas of a release
+    """
+    def __init__(self, path, linkset_version, linksets, uris, uri_offsets, areas, edge_keys, edge_objects,
+                 edge_linksets):
+        self.path = path
+        self.linkset_version = linkset_version
+        self.linksets = list(linksets)
+        self.uris = uris
+        self.uri_offsets = uri_offsets
+        self.areas = areas
+        self.edge_keys = edge_keys
+        self.edge_objects = edge_objects
+        self.edge_linksets = edge_linksets
+
+    def __len__(self):
+        return len(self.uri_offsets) - 1
+
+    def _uri_bytes(self, uri_id):
+        return self.uris[self.uri_offsets[uri_id]:self.uri_offsets[uri_id + 1]].tobytes()
+
+    def uri(self, uri_id):
+        return self._uri_bytes(uri_id).decode('utf-8')
+
+    def _bisect(self, uri, right=False):
+        target = uri.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found = self._uri_bytes(mid)
+            if found < target or (right and found == target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def id_of(self, uri):
+        """
+        :return: the id of uri, or None if it is not in the store
+        :rtype: int
+        """
+        i = self._bisect(uri)
+        if i < len(self) and self._uri_bytes(i) == uri.encode('utf-8'):
+            return i
+        return None
+
+    def targets(self, nodes, code, linkset=None):
+        """
+        :param nodes: array of subject ids
+        :param linkset: only statements of the linkset with this index, any if None
+        :return: for each edge of the given code from the nodes, the index in nodes of its subject and its object id
+        :rtype: tuple
+        """
+        keys = nodes.astype(np.int64) * EDGE_CODES + code
+        lo = np.searchsorted(self.edge_keys, keys, side='left')
+        hi = np.searchsorted(self.edge_keys, keys, side='right')
+        counts = hi - lo
+        edges = np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        sources = np.repeat(np.arange(len(nodes)), counts)
+        if linkset is not None:
+            in_linkset = self.edge_linksets[edges] == linkset
+            edges = edges[in_linkset]
+            sources = sources[in_linkset]
+        return sources, self.edge_objects[edges].astype(np.int64)
+
+    def objects(self, node, predicate, reified, linkset=None):
+        """
+        :return: the sorted ids of the objects of one predicate from node
+        """
+        sources, objects = self.targets(np.array([node]), edge_code(predicate, reified), linkset)
+        return np.unique(objects)
+
+    def closure(self, node, predicate):
+        """
+        :return: the sorted ids reached from node by one or more direct triples of predicate, i.e. predicate+
+        """
+        found = np.empty(0, dtype=np.int64)
+        frontier = np.array([node], dtype=np.int64)
+        while len(frontier):
+            sources, objects = self.targets(frontier, edge_code(predicate, False))
+            frontier = np.setdiff1d(objects, found)
+            found = np.union1d(found, frontier)
+        return found
+
+    def overlap_ids(self, node, linkset):
+        return np.unique(np.concatenate([
+            self.objects(node, SF_OVERLAPS, True, linkset),
+            self.objects(node, TRANSITIVE_SF_OVERLAP, True, linkset),
+            self.objects(node, SF_OVERLAPS, False),
+            self.objects(node, TRANSITIVE_SF_OVERLAP, False),
+        ]))
+
+    def contains_ids(self, node, linkset):
+        return np.union1d(self.objects(node, SF_CONTAINS, True, linkset), self.closure(node, SF_CONTAINS))
+
+    def within_ids(self, node, linkset):
+        return np.union1d(self.objects(node, SF_WITHIN, True, linkset), self.closure(node, SF_WITHIN))
+
+    def intersection_areas(self, node, others, linkset):
+        """
+        :return: for each of others, the largest area of a feature both it and node contain (by a direct sfContains
+         triple or a linkset statement), NaN if there is none
+        """
+        mine = np.union1d(self.objects(node, SF_CONTAINS, False), self.objects(node, SF_CONTAINS, True, linkset))
+        direct_sources, direct_objects = self.targets(others, edge_code(SF_CONTAINS, False))
+        reified_sources, reified_objects = self.targets(others, edge_code(SF_CONTAINS, True), linkset)
+        sources = np.concatenate([direct_sources, reified_sources])
+        objects = np.concatenate([direct_objects, reified_objects])
+        shared = np.isin(objects, mine)
+        iareas = np.full(len(others), np.nan)
+        np.fmax.at(iareas, sources[shared], self.areas[objects[shared]])
+        return iareas
+
+    def linkset_code(self, linksets_filter):
+        """
+        :return: the index of the linkset, None for any linkset, or NO_LINKSET if the store doesn't have it
+        """
+        if linksets_filter is None:
+            return None
+        try:
+            return self.linksets.index(str(linksets_filter))
+        except ValueError:
+            return NO_LINKSET
+
+    def area_binding(self, area):
+        return {'type': 'literal', 'datatype': XSD_DOUBLE, 'value': repr(float(area))}
+
+    def overlaps_pages(self, target_uri, include_areas, include_proportion, include_within, include_contains,
+                       linksets_filter=None, count=1000, offset=0, after=None):
+        """
+        Answer the overlaps queries built by build_overlaps_queries for a target
+        :param after: keyset page after this uri ("" for the first page) instead of using offset
+        :return: a page of bindings for each query, in the order of build_overlaps_queries, or None if the store
+         can't answer for target_uri
+        :rtype: list
+        """
+        node = self.id_of(str(target_uri))
+        linkset = self.linkset_code(linksets_filter)
+        if node is None or linkset == NO_LINKSET:
+            return None
+        queries = [(None, self.overlap_ids(node, linkset))]
+        if include_contains:
+            queries.append(('c', self.contains_ids(node, linkset)))
+        if include_within:
+            queries.append(('w', self.within_ids(node, linkset)))
+        if after is not None:
+            first = self._bisect(after, right=True)
+            offset = 0
+        my_area = self.areas[node]
+        pages = []
+        for flag, ids in queries:
+            if after is not None:
+                ids = ids[ids >= first]
+            ids = ids[offset:offset + count]
+            iareas = None
+            if include_proportion and flag is None:
+                iareas = self.intersection_areas(node, ids, linkset)
+            page = []
+            for i, o in enumerate(ids.tolist()):
+                b = {'o': {'type': 'uri', 'value': self.uri(o)}}
+                if flag is not None:
+                    b[flag] = {'type': 'literal', 'datatype': XSD_BOOLEAN, 'value': 'true'}
+                if include_areas or include_proportion:
+                    if not np.isnan(my_area):
+                        b['uarea'] = self.area_binding(my_area)
+                    if not np.isnan(self.areas[o]):
+                        b['oarea'] = self.area_binding(self.areas[o])
+                if iareas is not None and not np.isnan(iareas[i]):
+                    b['iarea'] = self.area_binding(iareas[i])
+                page.append(b)
+            pages.append(page)
+        return pages
+
+    @classmethod
+    def build(cls, path, statements, direct_edges, areas, linkset_version=None):
+        """
+        Write a snapshot
+        :param statements: (subject uri, predicate uri, object uri, linkset uri) of each linkset statement, the
+         linkset is "" for statements which aren't part of one
+        :param direct_edges: (subject uri, predicate uri, object uri) of each direct triple
+        :param areas: dict of feature uri to its area in square metres
+        :return: the snapshot
+        :rtype: LinksetStore
+        """
+        predicate_index = {predicate: i for i, predicate in enumerate(PREDICATES)}
+        rows = [(s, edge_code(predicate_index[p], True), o, ls) for s, p, o, ls in statements
+                if p in predicate_index and o is not None]
+        rows.extend((s, edge_code(predicate_index[p], False), o, None) for s, p, o in direct_edges if p in predicate_index)
+        uris = set(areas)
+        for s, code, o, ls in rows:
+            uris.add(s)
+            uris.add(o)
+        uris = sorted(uris)
+        ids = {uri: i for i, uri in enumerate(uris)}
+        linksets = sorted(set(ls for s, code, o, ls in rows if ls is not None))
+        linkset_ids = {ls: i for i, ls in enumerate(linksets)}
+
+        encoded = [uri.encode('utf-8') for uri in uris]
+        uri_offsets = np.zeros(len(uris) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=uri_offsets[1:])
+        columns = {
+            'uris': np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            'uri_offsets': uri_offsets,
+            'areas': np.full(len(uris), np.nan),
+        }
+        for uri, area in areas.items():
+            columns['areas'][ids[uri]] = area
+        edge_keys = np.array([ids[s] * EDGE_CODES + code for s, code, o, ls in rows], dtype=np.int64)
+        edge_objects = np.array([ids[o] for s, code, o, ls in rows], dtype=np.int32)
+        edge_linksets = np.array([NO_LINKSET if ls is None else linkset_ids[ls] for s, code, o, ls in rows], dtype=np.int16)
+        order = np.lexsort((edge_objects, edge_keys))
+        columns['edge_keys'] = edge_keys[order]
+        columns['edge_objects'] = edge_objects[order]
+        columns['edge_linksets'] = edge_linksets[order]
+
+        os.makedirs(path, exist_ok=True)
+        for name in COLUMNS:
+            np.save(os.path.join(path, name + ".npy"), columns[name])
+        # meta.json is written last, so a snapshot which wasn't finished can't be loaded
+        with open(os.path.join(path, "meta.json"), 'w') as meta_file:
+            json.dump({'format': STORE_FORMAT, 'linkset_version': linkset_version, 'linksets': linksets}, meta_file)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        if meta['format'] != STORE_FORMAT:
+            raise ValueError("{} is not a linkset snapshot of format {}".format(path, STORE_FORMAT))
+        columns = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode='r') for name in COLUMNS}
+        return cls(path, meta['linkset_version'], meta['linksets'], **columns)
+
+
+linkset_store = None
+
+
+def load_linkset_store(path, linkset_version):
+    """
+    Load the linkset snapshot, if one is configured and it was exported from the loaded linkset version
+    :rtype: LinksetStore
+    """
+    global linkset_store
+    if not path:
+        return None
+    if np is None:
+        logging.warning("numpy is not installed, not using the linkset snapshot {}".format(path))
+        return None
+    store = LinksetStore.load(path)
+    if store.linkset_version != str(linkset_version):
+        logging.warning("Linkset snapshot {} was exported for linkset version {}, not {}. Not using it."
+                        .format(path, store.linkset_version, linkset_version))
+        return None
+    linkset_store = store
+    logging.info("Loaded the linkset snapshot of {} features from {}".format(len(store), path))
+    return store
+
+
+def overlaps_pages(target_uri, include_areas, include_proportion, include_within, include_contains,
+                   linksets_filter=None, count=1000, offset=0, after=None):
+    """
+    :return: a page of bindings for each of the overlaps queries of target_uri, or None if they have to be
+     answered by the triplestore
+    """
+    if linkset_store is None:
+        return None
+    return linkset_store.overlaps_pages(target_uri, include_areas, include_proportion, include_within,
+                                        include_contains, linksets_filter, count, offset, after)
+
+
+STATEMENTS_SPARQL = """\
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+PREFIX ipo: <http://purl.org/dc/terms/isPartOf>
+SELECT ?s ?p ?o ?ls WHERE {
+    VALUES ?p { <PREDICATES> }
+    ?st rdf:subject ?s ;
+        rdf:predicate ?p ;
+        rdf:object ?o .
+    OPTIONAL { ?st ipo: ?ls }
+}
+"""
+DIRECT_EDGES_SPARQL = """\
+SELECT ?s ?p ?o WHERE {
+    VALUES ?p { <PREDICATES> }
+    ?s ?p ?o .
+    FILTER(isIRI(?o))
+}
+"""
+AREAS_SPARQL = """\
+PREFIX geox: <http://linked.data.gov.au/def/geox#>
+PREFIX epsg: <http://www.opengis.net/def/crs/EPSG/0/>
+PREFIX dt: <http://linked.data.gov.au/def/datatype/>
+SELECT ?f (MAX(?a) as ?area) WHERE {
+    ?f geox:hasAreaM2 ?ha .
+    ?ha geox:inCRS epsg:3577 ;
+        dt:value ?a .
+}
+GROUP BY ?f
+"""
+
+
+async def get_rows(sparql, variables):
+    """
+    :return: a tuple of the values of variables for each result of sparql, "" for unbound values
+    :rtype: list
+    """
+    from functions import iter_graphdb_bindings, BATCH_QUERY_LIMIT
+    predicates = " ".join("<{}>".format(predicate) for predicate in PREDICATES)
+    rows = []
+    async for b in iter_graphdb_bindings(sparql.replace("<PREDICATES>", predicates), limit=BATCH_QUERY_LIMIT):
+        rows.append(tuple(b[var]['value'] if var in b else "" for var in variables))
+    return rows
+
+
+async def export_from_triplestore():
+    """
+    :return: the statements, direct triples and areas of the linksets in the triplestore
+    :rtype: tuple
+    """
+    statements, direct_edges, area_rows = await asyncio.gather(
+        get_rows(STATEMENTS_SPARQL, ('s', 'p', 'o', 'ls')),
+        get_rows(DIRECT_EDGES_SPARQL, ('s', 'p', 'o')),
+        get_rows(AREAS_SPARQL, ('f', 'area')),
+    )
+    return statements, direct_edges, {f: float(area) for f, area in area_rows}
+
+
+NTRIPLE = re.compile(r'^\s*(<[^>]*>|_:\S+)\s+<([^>]*)>\s+(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:\^\^<[^>]*>|@[\w-]+)?)\s*\.\s*$')
+
+
+def read_ntriples(paths):
+    """
+    Read the linkset statements, direct triples and areas from N-Triples files
+    :return: the statements, direct triples and areas
+    :rtype: tuple
+    """
+    predicates = set(PREDICATES)
+    parts = {RDF_SUBJECT: {}, RDF_PREDICATE: {}, RDF_OBJECT: {}}
+    # a statement can be part of more than one linkset
+    linksets = {}
+    area_nodes = {}
+    crs = {}
+    values = {}
+    direct_edges = []
+    for file_number, path in enumerate(paths):
+        with open(path, encoding='utf-8') as ntriples_file:
+            for line in ntriples_file:
+                match = NTRIPLE.match(line)
+                if match is None:
+                    continue
+                s, p, o = match.groups()
+                # blank node labels are only unique within their file
+                s = "{}{}".format(file_number, s) if s.startswith("_:") else s[1:-1]
+                if o.startswith("_:"):
+                    o = "{}{}".format(file_number, o)
+                elif o.startswith("<"):
+                    o = o[1:-1]
+                else:
+                    o = o[1:o.rindex('"')]
+                if p in parts:
+                    parts[p][s] = o
+                elif p == IS_PART_OF:
+                    linksets.setdefault(s, []).append(o)
+                elif p in predicates:
+                    direct_edges.append((s, p, o))
+                elif p == HAS_AREA_M2:
+                    # a feature can have an area in more than one CRS
+                    area_nodes.setdefault(s, []).append(o)
+                elif p == IN_CRS:
+                    crs[s] = o
+                elif p == DT_VALUE:
+                    values[s] = o
+    statements = [(s, parts[RDF_PREDICATE].get(st), parts[RDF_OBJECT].get(st), ls)
+                  for st, s in parts[RDF_SUBJECT].items() for ls in linksets.get(st, [""])]
+    areas = {}
+    for feature, feature_area_nodes in area_nodes.items():
+        feature_areas = [float(values[area_node]) for area_node in feature_area_nodes
+                         if crs.get(area_node) == EPSG_3577 and area_node in values]
+        if feature_areas:
+            areas[feature] = max(feature_areas)
+    return statements, direct_edges, areas
+
+
+def main():
+    from config import LINKSET_STORE_PATH, LINKSET_VERSION
+    parser = argparse.ArgumentParser(description="Export the linksets and feature areas to a local snapshot")
+    parser.add_argument("--out", default=LINKSET_STORE_PATH,
+                        help="Directory to write the snapshot to (default LINKSET_STORE_PATH)")
+    parser.add_argument("--ntriples", nargs="+",
+                        help="Read the linksets and areas from these N-Triples files instead of the triplestore")
+    args = parser.parse_args()
+    if not args.out:
+        parser.error("No snapshot path given, set LINKSET_STORE_PATH or pass --out")
+    if np is None:
+        parser.error("numpy is required to export a linkset snapshot")
+    if args.ntriples:
+        statements, direct_edges, areas = read_ntriples(args.ntriples)
+    else:
+        loop = asyncio.get_event_loop()
+        statements, direct_edges, areas = loop.run_until_complete(export_from_triplestore())
+    print("{} linkset statements, {} direct triples and {} areas".format(len(statements), len(direct_edges), len(areas)))
+    store = LinksetStore.build(args.out, statements, direct_edges, areas, linkset_version=str(LINKSET_VERSION))
+    print("{} features in {} linksets written to {}".format(len(store), len(store.linksets), args.out))
+
+
+if __name__ == "__main__":
+    main()
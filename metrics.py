@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Timings of the API's requests and of the upstream queries made for them, exported in the Prometheus text
+format on /metrics.
+
+Each request is timed by endpoint (route template), method and status. Each upstream request is timed by
+upstream and query template (overlaps, contains, within, check_type, get_resource ...), with the size of the
+response and the time taken to decode it kept separately. The time spent in Python building the overlaps and
+crosswalk results from the query results is kept by stage.
+
+With more than one worker, each worker writes its metrics to a file of its own in a directory shared by the
+workers (see share_between_workers), every few seconds and whenever it answers a scrape. The worker answering
+a scrape sums the histograms of every worker, so they count the requests of all of them. The /stats gauges
+can't be summed, they are exported for each worker with a worker label.
+"""
+import asyncio
+import glob
+import json
+import logging
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INF = float('inf')
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, INF)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600, 1073741824, INF)
+#Query template of upstream requests which weren't given one
+OTHER_TEMPLATE = "other"
+#Seconds between the writes of a worker's metrics to the shared directory
+FLUSH_INTERVAL = 5.0
+#Gauges of workers which haven't written their metrics for this many seconds (e.g. have stopped) aren't exported
+STALE_SECONDS = 4 * FLUSH_INTERVAL
+
+#Directory the workers share their metrics in, None when each worker only exports its own
+shared_dir = None
+#Functions returning the gauges (see stats_samples) exported along with the histograms
+stats_collectors = []
+
+
+def format_value(value):
+    if value == INF:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    """
+    :param labels: (name, value) pairs
+    :return: the labels of a sample, e.g. {upstream="graphdb",template="overlaps"}
+    :rtype: str
+    """
+    labels = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+              for name, value in labels]
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+class Histogram(object):
+    """
+    A histogram of observed values with one series for each distinct set of label values
+    """
+    def __init__(self, name, documentation, labelnames, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values to [count in each bucket, sum, count]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        try:
+            series = self._series[labelvalues]
+        except KeyError:
+            series = self._series[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def state(self):
+        """
+        :return: the series of this histogram as JSON serialisable [label values, bucket counts, sum, count] lists
+        :rtype: list
+        """
+        return [[list(labelvalues), list(counts), total, count] for labelvalues, (counts, total, count) in self._series.items()]
+
+    def merge_states(self, states):
+        """
+        :param states: the states of this histogram in several workers
+        :return: their series summed, label values to [count in each bucket, sum, count]
+        :rtype: dict
+        """
+        merged = {}
+        for state in states:
+            for labelvalues, counts, total, count in state:
+                labelvalues = tuple(labelvalues)
+                if len(counts) != len(self.buckets) or len(labelvalues) != len(self.labelnames):
+                    # written by a worker running different code
+                    continue
+                try:
+                    series = merged[labelvalues]
+                except KeyError:
+                    series = merged[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+                series[2] += count
+        return merged
+
+    def render(self, series=None):
+        """
+        :param series: series to render instead of those of this worker, e.g. from merge_states
+        :return: the lines of this histogram in the Prometheus text format
+        :rtype: list
+        """
+        if series is None:
+            series = self._series
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        for labelvalues, (counts, total, count) in sorted(series.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(self.name, format_labels(labels + [('le', format_value(bound))]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(labels), format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, format_labels(labels), count))
+        return lines
+
+
+request_seconds = Histogram(
+    "loci_request_seconds", "Time taken to answer API requests, to the start of the response for streamed responses.",
+    ("endpoint", "method", "status"))
+upstream_seconds = Histogram(
+    "loci_upstream_seconds", "Time spent waiting on upstream responses, not counting decoding them.",
+    ("upstream", "template"))
+upstream_response_bytes = Histogram(
+    "loci_upstream_response_bytes", "Size of upstream response bodies.",
+    ("upstream", "template"), buckets=BYTES_BUCKETS)
+upstream_decode_seconds = Histogram(
+    "loci_upstream_decode_seconds", "Time taken to decode upstream responses (JSON or SPARQL TSV).",
+    ("upstream", "template"))
+processing_seconds = Histogram(
+    "loci_processing_seconds", "Time spent in Python building results from query results.",
+    ("stage",))
+histograms = [request_seconds, upstream_seconds, upstream_response_bytes, upstream_decode_seconds, processing_seconds]
+
+
+def observe_upstream(upstream, template, seconds, response_bytes, decode_seconds):
+    """
+    Record one upstream request
+    """
+    upstream_seconds.observe(seconds, upstream, template)
+    upstream_response_bytes.observe(response_bytes, upstream, template)
+    upstream_decode_seconds.observe(decode_seconds, upstream, template)
+
+
+def stats_samples(prefix, documentation, labelled_stats):
+    """
+    Gauges of the numeric values in stats dicts, such as those reported on /stats
+    :param prefix: metric name prefix, each gauge is named prefix_key
+    :param labelled_stats: list of (labels, stats dict) pairs, labels as (name, value) pairs
+    :return: (name, documentation, labels, value) of each gauge
+    :rtype: list
+    """
+    samples = []
+    for labels, stats in labelled_stats:
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = "{}_{}".format(prefix, key)
+            samples.append((name, "{} {}.".format(documentation, key.replace('_', ' ')), list(labels), value))
+    return samples
+
+
+def worker_samples():
+    """
+    :return: the gauges of this worker, from every stats collector, labelled with the worker
+    :rtype: list
+    """
+    worker = [('worker', str(os.getpid()))]
+    samples = []
+    for collector in stats_collectors:
+        samples.extend((name, documentation, worker + list(labels), value)
+                       for name, documentation, labels, value in collector())
+    return samples
+
+
+def render_samples(samples):
+    """
+    :param samples: gauges from stats_samples, in any order
+    :return: lines in the Prometheus text format, with the samples of each gauge together
+    :rtype: list
+    """
+    gauges = OrderedDict()
+    for name, documentation, labels, value in samples:
+        gauges.setdefault(name, (documentation, []))[1].append((labels, value))
+    lines = []
+    for name, (documentation, gauge_samples) in gauges.items():
+        lines.append("# HELP {} {}".format(name, documentation))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in gauge_samples:
+            lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+    return lines
+
+
+def share_between_workers(path=None):
+    """
+    Have every worker write its metrics to path, so each scrape exports those of all of them.
+    Call this in the main process before the workers are started, metrics left in path by an earlier run are removed.
+    :param path: directory to share the metrics in, a new temporary directory if not given
+    :return: the directory
+    :rtype: str
+    """
+    global shared_dir
+    if not path:
+        path = tempfile.mkdtemp(prefix="loci-metrics-")
+    os.makedirs(path, exist_ok=True)
+    for worker_path in glob.glob(os.path.join(path, "worker-*.json")):
+        os.remove(worker_path)
+    shared_dir = path
+    return path
+
+
+def write_worker_metrics():
+    """
+    Write the metrics of this worker to its file in the shared directory
+    """
+    worker_path = os.path.join(shared_dir, "worker-{}.json".format(os.getpid()))
+    state = {
+        'time': time.time(),
+        'histograms': {histogram.name: histogram.state() for histogram in histograms},
+        'gauges': worker_samples(),
+    }
+    temp_path = "{}.tmp".format(worker_path)
+    with open(temp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(temp_path, worker_path)
+
+
+def read_worker_metrics():
+    """
+    :return: the metrics last written by every worker
+    :rtype: list
+    """
+    states = []
+    for worker_path in glob.glob(os.path.join(shared_dir, "worker-*.json")):
+        try:
+            with open(worker_path) as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            logging.warning("Couldn't read the metrics in %s", worker_path)
+    return states
+
+
+async def write_worker_metrics_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            write_worker_metrics()
+        except OSError:
+            logging.exception("Couldn't write the metrics of this worker to %s", shared_dir)
+
+
+def render():
+    """
+    :return: every metric, of every worker if they share their metrics, in the Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    if shared_dir is None:
+        for histogram in histograms:
+            lines.extend(histogram.render())
+        lines.extend(render_samples(worker_samples()))
+        return "\n".join(lines) + "\n"
+    write_worker_metrics()
+    states = read_worker_metrics()
+    for histogram in histograms:
+        lines.extend(histogram.render(histogram.merge_states(state['histograms'].get(histogram.name, []) for state in states)))
+    now = time.time()
+    samples = []
+    for state in states:
+        if now - state['time'] <= STALE_SECONDS:
+            samples.extend((name, documentation, [tuple(label) for label in labels], value)
+                           for name, documentation, labels, value in state['gauges'])
+    lines.extend(render_samples(samples))
+    return "\n".join(lines) + "\n"
+
+
+def request_endpoint(request, response):
+    """
+    :return: the endpoint label of a request, its route template so the number of series stays bounded
+    :rtype: str
+    """
+    endpoint = getattr(request, 'uri_template', None)
+    if endpoint:
+        return endpoint
+    # answered by middleware (e.g. from the response cache) before the route template was recorded
+    if response.status != 404:
+        return request.path
+    return "unmatched"
+
+
+def install_metrics(app):
+    """
+    Add the middleware which times every request, and the listeners which write the worker's metrics to the
+    shared directory if there is one.
+    Install this before any other middleware, so its request middleware runs first and its response
+    middleware runs last.
+    """
+    @app.listener('before_server_start')
+    def start_writing_worker_metrics(app, loop):
+        if shared_dir is not None:
+            app.metrics_writer = loop.create_task(write_worker_metrics_periodically())
+
+    @app.listener('after_server_stop')
+    def stop_writing_worker_metrics(app, loop):
+        writer = getattr(app, 'metrics_writer', None)
+        if writer is not None:
+            writer.cancel()
+            # keep the counts of this worker in the histograms of the workers still running
+            write_worker_metrics()
+
+    @app.middleware('request')
+    async def start_request_timer(request):
+        request.ctx.metrics_start = time.perf_counter()
+
+    @app.middleware('response')
+    async def observe_request(request, response):
+        start = getattr(request.ctx, 'metrics_start', None)
+        if start is None or response is None:
+            return None
+        request_seconds.observe(time.perf_counter() - start, request_endpoint(request, response),
+                                request.method, str(response.status))
+        return None
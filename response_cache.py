@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Response cache for the read-only GET endpoints of the API.
+
+Every API response is a function of its path and query string over a static triplestore release, so
+successful GET responses are kept (in memory, or in a SQLite file if RESPONSE_CACHE_PATH is set) keyed on
+the linkset version, path, query string and Accept header. Cached and freshly computed responses get a
+strong ETag, a Last-Modified date and the Cache-Control header configured for their route, and conditional
+requests (If-None-Match, If-Modified-Since) are answered with 304 Not Modified.
+
+Streamed responses are never cached.
+"""
+import os
+import sqlite3
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+from json import dumps, loads
+from urllib.parse import parse_qsl, urlencode
+from sanic.response import HTTPResponse
+from config import LINKSET_VERSION, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BODY, \
+    RESPONSE_CACHE_CONTROL
+from functions import LRUCache
+
+CACHED_PATH_PREFIX = "/api/"
+
+
+class MemoryResponseCache(LRUCache):
+    """
+    In-process LRU of cached responses
+    """
+    pass
+
+
+class DiskResponseCache(object):
+    """
+    SQLite backed store of cached responses, shared by every worker process
+    """
+    def __init__(self, path, linkset_version, maxsize):
+        self.path = path
+        self.linkset_version = str(linkset_version)
+        self.maxsize = int(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._sets = 0
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        """
+        The connection of this process, a connection must not be shared with the worker processes forked from it
+        """
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, created REAL, entry TEXT, body BLOB)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS response_created ON response (created)")
+            row = self._conn.execute("SELECT value FROM store_meta WHERE key = 'linkset_version'").fetchone()
+            if row is None or row[0] != self.linkset_version:
+                self._conn.execute("DELETE FROM response")
+                self._conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('linkset_version', ?)",
+                                   (self.linkset_version,))
+        return self._conn
+
+    def get(self, key, default=None):
+        row = self.conn.execute("SELECT entry, body FROM response WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        entry = loads(row[0])
+        entry['body'] = bytes(row[1])
+        return entry
+
+    def set(self, key, entry):
+        stored = {k: v for k, v in entry.items() if k != 'body'}
+        self.conn.execute("INSERT OR REPLACE INTO response (key, created, entry, body) VALUES (?, ?, ?, ?)",
+                          (key, entry['created'], dumps(stored), sqlite3.Binary(entry['body'])))
+        self._sets += 1
+        if self._sets % 1000 == 0:
+            # drop the oldest responses once the store has grown past maxsize
+            self.conn.execute("DELETE FROM response WHERE key IN (SELECT key FROM response ORDER BY created DESC "
+                              "LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+    def stats(self):
+        return {
+            'size': self.conn.execute("SELECT COUNT(*) FROM response").fetchone()[0],
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def get_response_cache():
+    """
+    :return: the response cache set up by config, or None if response caching is turned off
+    """
+    if RESPONSE_CACHE_SIZE <= 0:
+        return None
+    if RESPONSE_CACHE_PATH:
+        return DiskResponseCache(RESPONSE_CACHE_PATH, LINKSET_VERSION, RESPONSE_CACHE_SIZE)
+    return MemoryResponseCache(RESPONSE_CACHE_SIZE)
+
+
+def cache_control_for(path):
+    """
+    :return: the Cache-Control header for a route, from the longest matching prefix in RESPONSE_CACHE_CONTROL
+    :rtype: str
+    """
+    best = None
+    for prefix in RESPONSE_CACHE_CONTROL:
+        if prefix != 'default' and path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return RESPONSE_CACHE_CONTROL[best if best is not None else 'default']
+
+
+def cache_key(request):
+    """
+    :return: the cache key of a request, the query string is put in a canonical order
+    :rtype: str
+    """
+    query = urlencode(sorted(parse_qsl(request.query_string, keep_blank_values=True)))
+    return "{}|{}?{}|{}".format(LINKSET_VERSION, request.path, query, request.headers.get('Accept', ''))
+
+
+def make_etag(body):
+    return '"{}"'.format(sha1(body).hexdigest())
+
+
+def is_not_modified(request, etag, created):
+    """
+    :return: whether the client's copy of the response, by its conditional request headers, is current
+    :rtype: bool
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return int(created) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def entry_headers(entry):
+    return {
+        'ETag': entry['etag'],
+        'Last-Modified': formatdate(entry['created'], usegmt=True),
+        'Cache-Control': entry['cache_control'],
+    }
+
+
+def is_cacheable(request):
+    if request.method not in ('GET', 'HEAD') or not request.path.startswith(CACHED_PATH_PREFIX):
+        return False
+    # an explained or debug response describes the queries made for it, so it is never served again
+    return not any(name in ('explain', 'debug') and value[:1] in ('t', 'T', '1')
+                   for name, value in parse_qsl(request.query_string, keep_blank_values=True))
+
+
+def install_response_cache(app, cache=None):
+    """
+    Add the middleware which caches responses and answers conditional requests
+    :param cache: the cache backend, get_response_cache() if not given
+    :return: the cache backend, None if caching is turned off
+    """
+    if cache is None:
+        cache = get_response_cache()
+
+    @app.middleware('request')
+    async def cached_response(request):
+        if cache is None or not is_cacheable(request):
+            return None
+        entry = cache.get(cache_key(request))
+        if entry is None:
+            return None
+        request.ctx.response_cache_hit = True
+        if is_not_modified(request, entry['etag'], entry['created']):
+            return HTTPResponse(status=304, headers=entry_headers(entry))
+        return HTTPResponse(body_bytes=entry['body'], status=200, headers=entry_headers(entry),
+                            content_type=entry['content_type'])
+
+    @app.middleware('response')
+    async def cache_response(request, response):
+        if not is_cacheable(request) or getattr(request.ctx, 'response_cache_hit', False):
+            return None
+        # streamed responses have no body to keep
+        if response is None or response.status != 200 or not isinstance(getattr(response, 'body', None), bytes):
+            return None
+        entry = {
+            'body': response.body,
+            'content_type': response.content_type,
+            'etag': make_etag(response.body),
+            'created': time.time(),
+            'cache_control': cache_control_for(request.path),
+        }
+        if cache is not None and len(response.body) <= RESPONSE_CACHE_MAX_BODY:
+            cache.set(cache_key(request), entry)
+        if is_not_modified(request, entry['etag'], entry['created']):
+            return HTTPResponse(status=304, headers=entry_headers(entry))
+        response.headers.update(entry_headers(entry))
+        return None
+
+    return cache
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Single-flight coalescing of identical upstream requests.
+
+When identical requests are made at the same time (e.g. a dashboard linking dozens of clients to the same
+region), only the first goes upstream and the others share its result. Only requests that are still in
+flight are shared, so no result is ever served stale.
+
+coalesce() shares the awaited result of a coroutine. SharedStream shares an async iterator of rows: every
+reader gets every row, starting from the first, so a stream only accepts new readers until its first row
+has been read by all of its readers and dropped from the buffer. Shared rows are the same objects for every
+reader, so readers must not modify them.
+"""
+import asyncio
+
+# Most rows a SharedStream buffers ahead of its slowest reader before it stops reading from upstream
+SHARED_STREAM_BUFFER_ROWS = 10000
+
+
+async def coalesce(flights, key, coro_fn):
+    """
+    Await coro_fn(), or the result of an identical call already in flight
+    :param flights: dict of the in-flight futures, keyed on key
+    :type flights: dict
+    :param key: hashable identity of the call
+    :param coro_fn: function which returns the coroutine to await
+    :return: the result of the coroutine
+    """
+    future = flights.get(key)
+    if future is None:
+        future = flights[key] = asyncio.ensure_future(coro_fn())
+        future.add_done_callback(lambda f: flights.pop(key, None) if flights.get(key) is f else None)
+    # one caller being cancelled must not cancel the call for the others
+    return await asyncio.shield(future)
+
+
+class SharedStream(object):
+    """
+    An upstream async iterator read once and replayed to every reader that joins before its first row is dropped
+    """
+    def __init__(self, flights, key, source, buffer_rows=SHARED_STREAM_BUFFER_ROWS):
+        """
+        :param flights: dict of the streams accepting readers, keyed on key
+        :type flights: dict
+        :param source: the upstream async iterator
+        """
+        self.flights = flights
+        self.key = key
+        self.source = source
+        self.buffer_rows = buffer_rows
+        self.rows = []
+        # index of self.rows[0] in the whole stream
+        self.start = 0
+        self.positions = {}
+        self.done = False
+        self.error = None
+        self.pump = None
+        self.arrived = None
+        self.drained = None
+        flights[key] = self
+
+    @classmethod
+    def reader_for(cls, flights, key, source_fn):
+        """
+        :param source_fn: function which returns the upstream async iterator, only called if no stream
+         for key can be joined
+        :return: an async iterator of every row of the stream for key
+        """
+        stream = flights.get(key)
+        if stream is None or not stream.joinable:
+            stream = cls(flights, key, source_fn())
+        return stream.reader()
+
+    @property
+    def joinable(self):
+        return self.start == 0 and not self.done
+
+    def reader(self):
+        token = object()
+        # a reader's position is taken now rather than when it is first iterated,
+        # so the rows it hasn't read yet are kept for it
+        self.positions[token] = self.start
+        return self._read(token)
+
+    def _stop_joining(self):
+        if self.flights.get(self.key) is self:
+            del self.flights[self.key]
+
+    def _trim(self):
+        if not self.positions:
+            return
+        slowest = min(self.positions.values())
+        if slowest > self.start:
+            del self.rows[:slowest - self.start]
+            self.start = slowest
+            self._stop_joining()
+            if self.drained is not None:
+                self.drained.set()
+                self.drained = None
+
+    async def _pump(self):
+        try:
+            async for row in self.source:
+                self.rows.append(row)
+                if self.arrived is not None:
+                    self.arrived.set()
+                    self.arrived = None
+                while len(self.rows) >= self.buffer_rows:
+                    self.drained = self.drained or asyncio.Event()
+                    await self.drained.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._stop_joining()
+            if self.arrived is not None:
+                self.arrived.set()
+                self.arrived = None
+
+    async def _close(self):
+        self._stop_joining()
+        if self.pump is not None and not self.pump.done():
+            self.pump.cancel()
+            try:
+                await self.pump
+            except asyncio.CancelledError:
+                pass
+        aclose = getattr(self.source, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+    async def _read(self, token):
+        try:
+            if self.pump is None:
+                self.pump = asyncio.ensure_future(self._pump())
+            while True:
+                index = self.positions[token] - self.start
+                if index < len(self.rows):
+                    self.positions[token] += 1
+                    row = self.rows[index]
+                    self._trim()
+                    yield row
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    self.arrived = self.arrived or asyncio.Event()
+                    await self.arrived.wait()
+        finally:
+            del self.positions[token]
+            if self.positions:
+                self._trim()
+            else:
+                await self._close()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Row by row reader for SPARQL 1.1 tab-separated-values results.
+
+Each row is turned into a binding dict in the same form as a binding from application/sparql-results+json,
+e.g. {"o": {"type": "uri", "value": "http://..."}}, so callers can consume either format.
+Unbound variables are left out of the binding.
+"""
+import re
+
+TSV_MEDIA_TYPE = "text/tab-separated-values"
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+_ESCAPE_RE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+_INTEGER_RE = re.compile(r'^[+-]?[0-9]+$')
+_DECIMAL_RE = re.compile(r'^[+-]?[0-9]*\.[0-9]+$')
+_DOUBLE_RE = re.compile(r'^[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)[eE][+-]?[0-9]+$')
+
+
+def _unescape(value):
+    if '\\' not in value:
+        return value
+
+    def _replace(match):
+        escape = match.group(1)
+        if escape[0] in 'uU' and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        return _ESCAPES.get(escape, escape)
+    return _ESCAPE_RE.sub(_replace, value)
+
+
+def parse_tsv_term(term):
+    """
+    Parse one RDF term as written in a TSV results row.
+    :param term:
+    :type term: str
+    :return: the term in sparql-results+json form, or None if the variable is unbound
+    :rtype: dict
+    """
+    if term == "":
+        return None
+    if term[0] == '<' and term[-1] == '>':
+        return {'type': 'uri', 'value': _unescape(term[1:-1])}
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    if term[0] == '"':
+        end = term.rindex('"')
+        literal = {'type': 'literal', 'value': _unescape(term[1:end])}
+        suffix = term[end + 1:]
+        if suffix.startswith('^^<') and suffix.endswith('>'):
+            literal['datatype'] = suffix[3:-1]
+        elif suffix.startswith('@'):
+            literal['xml:lang'] = suffix[1:]
+        return literal
+    # turtle abbreviated numbers and booleans
+    if term in ('true', 'false'):
+        return {'type': 'literal', 'value': term, 'datatype': XSD + 'boolean'}
+    if _INTEGER_RE.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': XSD + 'integer'}
+    if _DECIMAL_RE.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': XSD + 'decimal'}
+    if _DOUBLE_RE.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': XSD + 'double'}
+    return {'type': 'literal', 'value': term}
+
+
+def parse_tsv_header(line):
+    """
+    :return: the variable names of a TSV results header line, without their leading "?"
+    :rtype: list
+    """
+    return [var.lstrip('?$') for var in line.rstrip('\r\n').split('\t')]
+
+
+def parse_tsv_row(variables, line):
+    """
+    :return: the binding dict for one TSV results row
+    :rtype: dict
+    """
+    binding = {}
+    for var, term in zip(variables, line.rstrip('\r\n').split('\t')):
+        value = parse_tsv_term(term)
+        if value is not None:
+            binding[var] = value
+    return binding
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Local point-in-polygon lookup for find_at_location.
+
+Meshblock and contracted catchment geometries are loaded from local files into an STRtree so points can be
+resolved in-process instead of via the geometry data service. Each file is newline-delimited GeoJSON (or a
+GeoJSON FeatureCollection) in EPSG:4326, where every feature has the LOCI feature uri in its "uri" property.
+
+Shapely 2.0 or later is an optional dependency (see optional-requirements.txt), without it (or without any
+geometry files configured) every lookup falls back to the geometry data service.
+"""
+import logging
+from json import loads
+
+try:
+    import shapely
+    from shapely.geometry import Point, shape
+    from shapely.strtree import STRtree
+except ImportError:
+    shapely = Point = shape = STRtree = None
+
+# loci_type values accepted by find_at_location, in the order results are returned for 'any'
+LOCI_TYPES = ('mb', 'cc')
+#Oldest Shapely with shapely.points and predicate queries of an STRtree
+SHAPELY_MIN_MAJOR_VERSION = 2
+
+
+class SpatialIndex(object):
+    """
+    STRtree of the feature geometries of one dataset
+    """
+    def __init__(self, dataset, uris, geometries):
+        self.dataset = dataset
+        self.uris = list(uris)
+        self.geometries = list(geometries)
+        self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def from_file(cls, dataset, path):
+        uris = []
+        geometries = []
+        with open(path, 'r', encoding='utf-8') as geometry_file:
+            if path.endswith('.geojson') or path.endswith('.json'):
+                features = loads(geometry_file.read())['features']
+            else:
+                features = (loads(line) for line in geometry_file if line.strip())
+            for feature in features:
+                uris.append(feature['properties']['uri'])
+                geometries.append(shape(feature['geometry']))
+        return cls(dataset, uris, geometries)
+
+    def __len__(self):
+        return len(self.uris)
+
+    def find(self, lat, lon):
+        """
+        :return: uris of the features this point falls in
+        :rtype: list
+        """
+        indexes = self.tree.query(Point(lon, lat), predicate='intersects')
+        return [self.uris[i] for i in sorted(indexes)]
+
+    def find_many(self, lats, lons):
+        """
+        Vectorised lookup of many points in one pass over the tree.
+        :return: for each point, the uris of the features it falls in
+        :rtype: list
+        """
+        points = shapely.points(lons, lats)
+        point_indexes, feature_indexes = self.tree.query(points, predicate='intersects')
+        found = [[] for _ in range(len(points))]
+        for point_index, feature_index in sorted(zip(point_indexes.tolist(), feature_indexes.tolist())):
+            found[point_index].append(self.uris[feature_index])
+        return found
+
+
+spatial_indexes = {}
+
+
+def load_spatial_indexes(geometry_paths):
+    """
+    Build a spatial index for each configured dataset geometry file.
+    :param geometry_paths: dict of loci_type to geometry file path, empty paths are skipped
+    :type geometry_paths: dict
+    """
+    geometry_paths = {loci_type: path for loci_type, path in geometry_paths.items() if path}
+    if not geometry_paths:
+        return spatial_indexes
+    if STRtree is None:
+        logging.warning("Shapely is not installed, find_at_location will use the geometry data service")
+        return spatial_indexes
+    if int(shapely.__version__.split('.')[0]) < SHAPELY_MIN_MAJOR_VERSION:
+        logging.warning("Shapely {} is installed but {}.0 or later is needed, find_at_location will use the "
+                        "geometry data service".format(shapely.__version__, SHAPELY_MIN_MAJOR_VERSION))
+        return spatial_indexes
+    for loci_type, path in geometry_paths.items():
+        spatial_indexes[loci_type] = SpatialIndex.from_file(loci_type, path)
+        logging.info("Loaded {} {} geometries from {}".format(len(spatial_indexes[loci_type]), loci_type, path))
+    return spatial_indexes
+
+
+def find_at_location(lat, lon, loci_type="any"):
+    """
+    Find the features a point falls in using the local spatial indexes.
+    :return: a response shaped like the geometry data service's, or None if a dataset needed to
+     answer loci_type has not been loaded
+    :rtype: dict
+    """
+    loci_types = LOCI_TYPES if loci_type == 'any' else (loci_type,)
+    if not all(a_type in spatial_indexes for a_type in loci_types):
+        return None
+    res = []
+    for a_type in loci_types:
+        for uri in spatial_indexes[a_type].find(lat, lon):
+            res.append({"dataset": a_type, "feature": uri})
+    return {
+        'ok': True,
+        'count': len(res),
+        'res': res,
+    }
+
+
+def find_at_locations(lats, lons, loci_type="any"):
+    """
+    Find the features each of many points falls in using the local spatial indexes.
+    :return: a list with a geometry data service shaped response per point, or None if a dataset needed
+     to answer loci_type has not been loaded
+    :rtype: list
+    """
+    loci_types = LOCI_TYPES if loci_type == 'any' else (loci_type,)
+    if not all(a_type in spatial_indexes for a_type in loci_types):
+        return None
+    results = [[] for _ in range(len(lats))]
+    for a_type in loci_types:
+        for res, uris in zip(results, spatial_indexes[a_type].find_many(lats, lons)):
+            res.extend({"dataset": a_type, "feature": uri} for uri in uris)
+    return [{'ok': True, 'count': len(res), 'res': res} for res in results]
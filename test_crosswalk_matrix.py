@@ -0,0 +1,173 @@
+import math
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from crosswalk_matrix import aggregate_crosswalk
+from functions import get_location_overlaps_crosswalk_base_uri
+from uri_table import UriTable, OverlapRecord, CrosswalkParent, NAN
+
+RESOURCE_TYPE_PREFIX = "geofabric"
+
+
+def random_walk(rng):
+    """
+    :return: the arguments of aggregate_crosswalk for a random walk from meshblocks to contracted catchments
+    """
+    uri_table = UriTable()
+    from_base_ids = [uri_table.intern("http://example.com/asgs2016/meshblock/{}".format(i)) for i in range(30)]
+    to_base_ids = [uri_table.intern("http://example.com/geofabric/contractedcatchment/{}".format(i)) for i in range(60)]
+    parent_ids = [uri_table.intern("http://example.com/geofabric/riverregion/{}".format(i)) for i in range(10)]
+    # parents in the other hierarchy, which the walk leaves out
+    parent_ids.extend(uri_table.intern("http://example.com/asgs2016/sa1/{}".format(i)) for i in range(4))
+    feature_areas = {uri_id: rng.uniform(1, 1e6) for uri_id in to_base_ids + parent_ids}
+    detailed = {uri_id: rng.random() > 0.1 for uri_id in parent_ids}
+
+    to_base_units = {}
+    for from_base_id in from_base_ids:
+        units = []
+        for to_base_id in rng.sample(to_base_ids, rng.randint(0, 6)):
+            forward_percentage = NAN if rng.random() < 0.02 else rng.uniform(0, 100)
+            units.append((OverlapRecord(to_base_id, feature_areas[to_base_id], forward_percentage=forward_percentage),
+                          RESOURCE_TYPE_PREFIX))
+        to_base_units[from_base_id] = units
+    found_parents = {}
+    for to_base_id in to_base_ids:
+        parents = [OverlapRecord(parent_id, feature_areas[parent_id], detailed=detailed[parent_id])
+                   for parent_id in rng.sample(parent_ids, rng.randint(0, 3))]
+        found_parents[to_base_id] = (feature_areas[to_base_id], parents)
+    type_matches = {to_base_id: rng.random() < 0.2 for to_base_id in to_base_ids}
+
+    # features recorded as they are, some of which the walk reaches too
+    recorded_ids = rng.sample(to_base_ids, 5) + rng.sample(parent_ids, 5)
+    recorded_ids.extend(uri_table.intern("http://example.com/asgs2016/sa2/{}".format(i)) for i in range(5))
+    steps = []
+    for i in range(80):
+        if rng.random() < 0.15:
+            recorded_id = rng.choice(recorded_ids)
+            steps.append(CrosswalkParent(recorded_id, rng.uniform(0, 1e4), 1e6, rng.uniform(0, 100),
+                                         rng.uniform(0, 100), from_overlap=True))
+        else:
+            steps.append((rng.choice(from_base_ids), rng.uniform(0, 1e5)))
+    return uri_table, steps, to_base_units, found_parents, type_matches
+
+
+def sequential_crosswalk(uri_table, steps, to_base_units, found_parents, type_matches):
+    parent_amount = {}
+    for step in steps:
+        if isinstance(step, CrosswalkParent):
+            parent_amount[step.uri_id] = step
+            continue
+        from_base_id, area_incoming = step
+        get_location_overlaps_crosswalk_base_uri(uri_table, found_parents, parent_amount, area_incoming,
+                                                 to_base_units[from_base_id], type_matches)
+    return parent_amount
+
+
+def hand_walk():
+    """
+    Two meshblocks overlapping two contracted catchments, with a river region parent of both, a parent in the
+    other hierarchy and a parent known only by its uri
+    """
+    uri_table = UriTable()
+    mb1, mb2, cc1, cc2, rr1, sa1, rr2, sa2 = [uri_table.intern("http://example.com/" + path) for path in (
+        "asgs2016/meshblock/1", "asgs2016/meshblock/2", "geofabric/contractedcatchment/1",
+        "geofabric/contractedcatchment/2", "geofabric/riverregion/1", "asgs2016/sa1/1", "geofabric/riverregion/2",
+        "asgs2016/sa2/1")]
+    to_base_units = {
+        mb1: [(OverlapRecord(cc1, 1000.0, forward_percentage=50.0), RESOURCE_TYPE_PREFIX),
+              (OverlapRecord(cc2, 2000.0, forward_percentage=100.0), RESOURCE_TYPE_PREFIX)],
+        mb2: [(OverlapRecord(cc1, 1000.0, forward_percentage=25.0), RESOURCE_TYPE_PREFIX)],
+    }
+    found_parents = {
+        cc1: (1000.0, [OverlapRecord(rr1, 1e6), OverlapRecord(sa1, 5e5)]),
+        cc2: (2000.0, [OverlapRecord(rr1, 1e6), OverlapRecord(rr2, detailed=False)]),
+    }
+    recorded = CrosswalkParent(sa2, 70.0, 1e4, 1.0, 2.0, from_overlap=True)
+    steps = [(mb1, 400.0), recorded, (mb2, 800.0), (mb1, 100.0)]
+    return uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2)
+
+
+def record_step(uri_id, intersection_area):
+    return CrosswalkParent(uri_id, intersection_area, 1e6, 1.0, 2.0, from_overlap=True)
+
+
+@pytest.mark.parametrize("crosswalk", [sequential_crosswalk, aggregate_crosswalk])
+def test_crosswalk_sums_each_feature_through_its_base_units(crosswalk):
+    uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2) = hand_walk()
+    results = crosswalk(uri_table, steps, to_base_units, found_parents, {cc1: False, cc2: False})
+    assert list(results) == [cc1, rr1, cc2, rr2, sa2]
+    assert results[cc1].intersection_area == pytest.approx(450.0)
+    assert results[cc2].intersection_area == pytest.approx(500.0)
+    assert results[rr1].intersection_area == pytest.approx(950.0)
+    assert results[rr1].feature_area == 1e6
+    assert math.isnan(results[rr2].intersection_area) and math.isnan(results[rr2].feature_area)
+    assert results[sa2].intersection_area == 70.0 and results[sa2].from_overlap
+
+
+@pytest.mark.parametrize("crosswalk", [sequential_crosswalk, aggregate_crosswalk])
+def test_crosswalk_stops_at_base_units_of_the_output_type(crosswalk):
+    uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2) = hand_walk()
+    results = crosswalk(uri_table, steps, to_base_units, found_parents, {cc1: False, cc2: True})
+    assert list(results) == [cc1, rr1, cc2, sa2]
+    assert results[rr1].intersection_area == pytest.approx(450.0)
+    assert results[cc2].intersection_area == pytest.approx(500.0)
+
+
+@pytest.mark.parametrize("crosswalk", [sequential_crosswalk, aggregate_crosswalk])
+def test_crosswalk_adds_what_it_reaches_after_a_record_to_it(crosswalk):
+    uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2) = hand_walk()
+    # the 600 reached before the record is replaced by it, the 200 and 150 reached after are added to it
+    steps[1] = record_step(rr1, 10.0)
+    results = crosswalk(uri_table, steps, to_base_units, found_parents, {cc1: False, cc2: False})
+    assert list(results) == [cc1, rr1, cc2, rr2]
+    assert results[rr1].intersection_area == pytest.approx(360.0)
+    assert results[rr1].feature_area == 1e6 and results[rr1].from_overlap
+    assert results[cc1].intersection_area == pytest.approx(450.0)
+
+
+@pytest.mark.parametrize("crosswalk", [sequential_crosswalk, aggregate_crosswalk])
+def test_crosswalk_keeps_the_last_record_of_a_feature(crosswalk):
+    uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2) = hand_walk()
+    steps[1] = record_step(rr1, 10.0)
+    # the second meshblock again, through the first contracted catchment only
+    steps.extend([record_step(rr1, 20.0), record_step(rr2, 30.0), steps[2]])
+    results = crosswalk(uri_table, steps, to_base_units, found_parents, {cc1: False, cc2: False})
+    assert results[rr1].intersection_area == pytest.approx(220.0)
+    # recorded after the walk found it with only its uri known
+    assert results[rr2].intersection_area == 30.0
+
+
+@pytest.mark.parametrize("crosswalk", [sequential_crosswalk, aggregate_crosswalk])
+def test_crosswalk_finding_a_record_with_only_its_uri_known_makes_it_unknown(crosswalk):
+    uri_table, steps, to_base_units, found_parents, (cc1, cc2, rr1, rr2, sa2) = hand_walk()
+    steps[1] = record_step(rr2, 30.0)
+    results = crosswalk(uri_table, steps, to_base_units, found_parents, {cc1: False, cc2: False})
+    assert math.isnan(results[rr2].intersection_area) and not results[rr2].from_overlap
+
+
+def assert_same_value(expected, actual, rel_tol):
+    if expected is None or actual is None:
+        assert expected is actual
+    elif math.isnan(expected):
+        assert math.isnan(actual)
+    else:
+        assert math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=1e-9)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_aggregate_crosswalk_matches_sequential_walk(seed):
+    # the sequential walk adds to the records it is given, so each walk has records of its own
+    expected = sequential_crosswalk(*random_walk(random.Random(seed)))
+    actual = aggregate_crosswalk(*random_walk(random.Random(seed)))
+    assert list(actual) == list(expected)
+    for uri_id, expected_parent in expected.items():
+        actual_parent = actual[uri_id]
+        assert actual_parent.from_overlap == expected_parent.from_overlap
+        # sums are added in a different order
+        assert_same_value(expected_parent.intersection_area, actual_parent.intersection_area, 1e-9)
+        assert_same_value(expected_parent.feature_area, actual_parent.feature_area, 0)
+        assert_same_value(expected_parent.forward_percentage, actual_parent.forward_percentage, 0)
+        assert_same_value(expected_parent.reverse_percentage, actual_parent.reverse_percentage, 0)
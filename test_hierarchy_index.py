@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+
+rdflib = pytest.importorskip("rdflib")
+
+import functions
+import hierarchy_index
+from functions import CURSOR_START, encode_cursor, iter_location_is_within, iter_location_contains
+from hierarchy_index import build_from_triplestore
+
+ASGS = "http://example.com/asgs2016/"
+GEOFABRIC = "http://example.com/geofabric/"
+OTHER = "http://example.com/other/"
+DATASETS = [ASGS, GEOFABRIC]
+GEO = rdflib.Namespace("http://www.opengis.net/ont/geosparql#")
+UNKNOWN = ASGS + "meshblock/99"
+
+
+def contains(graph, container, feature, within=True):
+    graph.add((rdflib.URIRef(container), GEO.sfContains, rdflib.URIRef(feature)))
+    if within:
+        graph.add((rdflib.URIRef(feature), GEO.sfWithin, rdflib.URIRef(container)))
+
+
+def reified(graph, s, predicate, o):
+    statement = rdflib.BNode()
+    graph.add((statement, rdflib.RDF.subject, rdflib.URIRef(s)))
+    graph.add((statement, rdflib.RDF.predicate, predicate))
+    graph.add((statement, rdflib.RDF.object, rdflib.URIRef(o)))
+
+
+def hierarchy_graph():
+    """
+    A hierarchy the index answers for, and one for each case it leaves to the triplestore: a feature with
+    more than one container, edges leading outside of the indexed datasets, a cycle and reified edges
+    """
+    graph = rdflib.Graph()
+    for container, feature in (("state/1", "sa2/1"), ("state/1", "sa2/2"), ("sa2/1", "meshblock/1"),
+                               ("sa2/1", "meshblock/2"), ("sa2/2", "meshblock/3")):
+        contains(graph, ASGS + container, ASGS + feature)
+    # meshblock 4 is in two SA2s
+    for container, feature in (("state/2", "sa2/3"), ("state/2", "sa2/4"), ("sa2/3", "meshblock/4"),
+                               ("sa2/4", "meshblock/4"), ("sa2/4", "meshblock/5")):
+        contains(graph, ASGS + container, ASGS + feature)
+    contains(graph, GEOFABRIC + "riverregion/1", GEOFABRIC + "contractedcatchment/1")
+    contains(graph, GEOFABRIC + "riverregion/1", GEOFABRIC + "contractedcatchment/2")
+    contains(graph, GEOFABRIC + "contractedcatchment/1", OTHER + "feature/1", within=False)
+    graph.add((rdflib.URIRef(GEOFABRIC + "contractedcatchment/2"), GEO.sfWithin, rdflib.URIRef(OTHER + "region/1")))
+    contains(graph, GEOFABRIC + "contractedcatchment/3", GEOFABRIC + "contractedcatchment/4")
+    contains(graph, GEOFABRIC + "contractedcatchment/4", GEOFABRIC + "contractedcatchment/3")
+    reified(graph, ASGS + "meshblock/1", GEO.sfWithin, GEOFABRIC + "contractedcatchment/5")
+    reified(graph, GEOFABRIC + "contractedcatchment/5", GEO.sfContains, ASGS + "meshblock/1")
+    reified(graph, ASGS + "meshblock/2", GEO.sfWithin, OTHER + "region/2")
+    contains(graph, GEOFABRIC + "riverregion/2", GEOFABRIC + "contractedcatchment/6")
+    reified(graph, GEOFABRIC + "riverregion/2", GEO.sfContains, OTHER + "feature/2")
+    return graph
+
+
+def graph_bindings(graph):
+    """
+    :return: iter_graphdb_bindings answering from graph
+    """
+    async def iter_graphdb_bindings(sparql, infer=True, same_as=True, limit=1000, offset=0, template=None):
+        result = graph.query(sparql)
+        variables = [str(var) for var in result.vars]
+        for row in list(result)[offset:offset + limit]:
+            yield {var: {'type': 'uri' if isinstance(term, rdflib.URIRef) else 'literal', 'value': str(term)}
+                   for var, term in zip(variables, row) if term is not None}
+    return iter_graphdb_bindings
+
+
+@pytest.fixture(scope="module")
+def hierarchy():
+    graph = hierarchy_graph()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(functions, "iter_graphdb_bindings", graph_bindings(graph))
+        index = asyncio.run(build_from_triplestore(DATASETS, "1"))
+    return index, graph
+
+
+@pytest.fixture
+def triplestore(hierarchy, monkeypatch):
+    """
+    Answer within and contains from the triplestore queries only
+    """
+    index, graph = hierarchy
+    monkeypatch.setattr(functions, "iter_graphdb_bindings", graph_bindings(graph))
+    monkeypatch.setattr(hierarchy_index, "hierarchy_index", None)
+    return index
+
+
+def sparql_locations(iter_locations, uri, count=1000, offset=0, cursor=None):
+    async def collect():
+        return [l async for l in iter_locations(uri, count, offset, cursor)]
+    return asyncio.run(collect())
+
+
+PAGES = [(iter_location_is_within, "within_page"), (iter_location_contains, "contains_page")]
+
+
+def test_features_the_index_cant_answer_for_are_left_to_the_triplestore(hierarchy):
+    index, graph = hierarchy
+    assert index.within_page(UNKNOWN, 10) is None and index.contains_page(UNKNOWN, 10) is None
+    # below more than one container
+    assert index.contains_page(ASGS + "state/2", 10) is None
+    # edges leading outside of the datasets, plain and reified
+    assert index.contains_page(GEOFABRIC + "contractedcatchment/1", 10) is None
+    assert index.contains_page(GEOFABRIC + "riverregion/1", 10) is None
+    assert index.within_page(GEOFABRIC + "contractedcatchment/2", 10) is None
+    assert index.within_page(ASGS + "meshblock/2", 10) is None
+    assert index.contains_page(GEOFABRIC + "riverregion/2", 10) is None
+    # a cycle has no root to start the Euler tour from
+    assert index.contains_page(GEOFABRIC + "contractedcatchment/3", 10) is None
+    assert index.within_page(ASGS + "meshblock/1", 10) == [
+        ASGS + "sa2/1", ASGS + "state/1", GEOFABRIC + "contractedcatchment/5"]
+    assert index.contains_page(ASGS + "state/1", 10) == [
+        ASGS + "meshblock/1", ASGS + "meshblock/2", ASGS + "meshblock/3", ASGS + "sa2/1", ASGS + "sa2/2"]
+
+
+@pytest.mark.parametrize("iter_locations, page", PAGES)
+def test_offset_pages_match_sparql(triplestore, iter_locations, page):
+    index = triplestore
+    answered = 0
+    for uri in index.uris:
+        if getattr(index, page)(uri, 1000) is None:
+            continue
+        answered += 1
+        # the query isn't ordered unless it is keyset paged, the index gives uri order
+        expected = sorted(sparql_locations(iter_locations, uri))
+        for offset in range(len(expected) + 1):
+            assert getattr(index, page)(uri, 2, offset) == expected[offset:offset + 2], (uri, offset)
+    assert answered > len(index.uris) // 2
+
+
+@pytest.mark.parametrize("iter_locations, page", PAGES)
+def test_cursor_pages_match_sparql(triplestore, iter_locations, page):
+    index = triplestore
+    for uri in index.uris:
+        if getattr(index, page)(uri, 1000) is None:
+            continue
+        for after in [""] + sorted(sparql_locations(iter_locations, uri)):
+            cursor = encode_cursor(after) if after else CURSOR_START
+            assert getattr(index, page)(uri, 2, after=after) == sparql_locations(iter_locations, uri, 2, cursor=cursor), (uri, after)
@@ -0,0 +1,49 @@
+import random
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import label_index
+from label_index import LabelIndex, normalise_query, MAX_WORD_STARTS, MAX_RANKED_LENGTH
+
+WORDS = ["saint", "south", "st", "street", "sydney", "smith", "north", "new", "ab", "abc", "Ünï"]
+
+
+def random_labels(rng, n):
+    labels = []
+    for i in range(n):
+        words = [rng.choice(WORDS) + (str(rng.randint(0, 30)) if rng.random() < 0.5 else "") for _ in range(rng.randint(1, 4))]
+        labels.append(("http://example.com/{}".format(i), " ".join(words)))
+    return labels
+
+
+def expected_suggestions(labels, query):
+    """
+    :return: the uris of every label matching query, ranked as suggest ranks them
+    """
+    prefix = normalise_query(query)
+    ranked = []
+    for location, (uri, label) in enumerate(labels):
+        words = normalise_query(label).split(" ")
+        suffixes = [" ".join(words[i:]) for i in range(min(len(words), MAX_WORD_STARTS))]
+        matches = [i for i, suffix in enumerate(suffixes) if suffix.startswith(prefix)]
+        if matches:
+            ranked.append((0 if 0 in matches else 1, min(len(label.encode('utf-8')), MAX_RANKED_LENGTH), location))
+    ranked.sort()
+    return [labels[location][0] for _, _, location in ranked]
+
+
+@pytest.mark.parametrize("scan_limit", [2000, 50, 5])
+def test_suggest_matches_ranking_of_every_label(tmp_path, monkeypatch, scan_limit):
+    # small scan limits rank most prefixes when the index is built instead of when it is queried
+    monkeypatch.setattr(label_index, "SCAN_LIMIT", scan_limit)
+    rng = random.Random(scan_limit)
+    labels = random_labels(rng, 3000) + [("http://example.com/short", "st 6")]
+    index = LabelIndex.build(str(tmp_path), labels, linkset_version="1")
+    queries = ["s", "st", "st 6", "Saint1", "north s", "ü", "x"]
+    queries.extend(word[:length] for word in WORDS for length in range(1, len(word) + 1))
+    queries.extend(label[:length] for _, label in rng.sample(labels, 20) for length in (3, 6, 10))
+    for query in queries:
+        expected = expected_suggestions(labels, query)
+        for count in (1, 10, 100):
+            assert [s['uri'] for s in index.suggest(query, count)] == expected[:count], query
@@ -0,0 +1,152 @@
+import itertools
+
+import pytest
+
+np = pytest.importorskip("numpy")
+rdflib = pytest.importorskip("rdflib")
+
+from functions import build_overlaps_queries
+from linkset_store import LinksetStore, read_ntriples
+from linkset_store import PREDICATES, SF_OVERLAPS, TRANSITIVE_SF_OVERLAP, SF_CONTAINS, SF_WITHIN
+from linkset_store import RDF_SUBJECT, RDF_PREDICATE, RDF_OBJECT, IS_PART_OF, HAS_AREA_M2, IN_CRS, DT_VALUE, EPSG_3577
+
+MB = "http://example.com/asgs2016/meshblock/"
+CC = "http://example.com/geofabric/contractedcatchment/"
+SA1 = "http://example.com/asgs2016/statisticalarealevel1/1"
+I = "http://example.com/intersection/"
+MB16CC = "http://example.com/linkset/mb16cc"
+OTHER_LINKSET = "http://example.com/linkset/other"
+XSD_DOUBLE = "http://www.w3.org/2001/XMLSchema#double"
+EPSG_4283 = "http://www.opengis.net/def/crs/EPSG/0/4283"
+
+
+class Triples(object):
+    def __init__(self):
+        self.lines = []
+        self.nodes = 0
+
+    def add(self, s, p, o):
+        self.lines.append("{} <{}> {} .".format(s if s.startswith("_:") else "<{}>".format(s), p,
+                                                o if o.startswith(("_:", '"')) else "<{}>".format(o)))
+
+    def statement(self, s, predicate, o, linkset):
+        self.nodes += 1
+        node = "_:s{}".format(self.nodes)
+        self.add(node, RDF_SUBJECT, s)
+        self.add(node, RDF_PREDICATE, PREDICATES[predicate])
+        self.add(node, RDF_OBJECT, o)
+        self.add(node, IS_PART_OF, linkset)
+
+    def area(self, feature, area, crs=EPSG_3577):
+        self.nodes += 1
+        node = "_:a{}".format(self.nodes)
+        self.add(feature, HAS_AREA_M2, node)
+        self.add(node, IN_CRS, crs)
+        self.add(node, DT_VALUE, '"{!r}"^^<{}>'.format(float(area), XSD_DOUBLE))
+
+
+def linkset_triples():
+    """
+    Three meshblocks in an SA1 and two contracted catchments, overlapping through the statements of two linksets
+    and a direct triple, with the intersection features of the mb16cc overlaps
+    """
+    t = Triples()
+    for mb in ("1", "2"):
+        t.add(MB + mb, PREDICATES[SF_WITHIN], SA1)
+        t.add(SA1, PREDICATES[SF_CONTAINS], MB + mb)
+    for mb, cc, intersections in (("1", "1", [("1", 150.0)]), ("1", "2", [("2", 20.0), ("3", 40.0)])):
+        t.statement(MB + mb, SF_OVERLAPS, CC + cc, MB16CC)
+        t.statement(CC + cc, SF_OVERLAPS, MB + mb, MB16CC)
+        for i, area in intersections:
+            t.statement(MB + mb, SF_CONTAINS, I + i, MB16CC)
+            t.statement(CC + cc, SF_CONTAINS, I + i, MB16CC)
+            t.area(I + i, area)
+    t.statement(MB + "2", SF_WITHIN, CC + "1", MB16CC)
+    t.statement(CC + "1", SF_CONTAINS, MB + "2", MB16CC)
+    t.statement(MB + "3", TRANSITIVE_SF_OVERLAP, CC + "2", OTHER_LINKSET)
+    t.add(MB + "2", PREDICATES[SF_OVERLAPS], CC + "2")
+    # meshblock 3 has no area in EPSG:3577
+    for feature, area in ((MB + "1", 1000.0), (MB + "2", 500.0), (CC + "1", 2000.0), (CC + "2", 3000.0), (SA1, 1500.0)):
+        t.area(feature, area)
+    t.area(MB + "1", 0.0001, EPSG_4283)
+    t.area(MB + "3", 0.0002, EPSG_4283)
+    return t
+
+
+def write_ntriples(directory):
+    ntriples_path = str(directory / "linksets.nt")
+    with open(ntriples_path, 'w') as ntriples_file:
+        ntriples_file.write("\n".join(linkset_triples().lines) + "\n")
+    return ntriples_path
+
+
+@pytest.fixture(scope="module")
+def linksets(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("linksets")
+    ntriples_path = write_ntriples(directory)
+    statements, direct_edges, areas = read_ntriples([ntriples_path])
+    store = LinksetStore.build(str(directory / "store"), statements, direct_edges, areas, linkset_version="1")
+    graph = rdflib.Graph()
+    graph.parse(ntriples_path, format='nt')
+    return store, graph
+
+
+def values(bindings):
+    """
+    :return: the bindings as dicts of variable to value, with areas as floats
+    """
+    return [{var: float(term['value']) if var.endswith('area') else term['value'] for var, term in b.items()}
+            for b in bindings]
+
+
+def sparql_values(graph, sparql):
+    result = graph.query(sparql)
+    variables = [str(var) for var in result.vars]
+    return values([{var: {'value': str(term)} for var, term in zip(variables, row) if term is not None} for row in result])
+
+
+def test_areas_are_read_in_epsg_3577_only(tmp_path):
+    statements, direct_edges, areas = read_ntriples([write_ntriples(tmp_path)])
+    assert areas[MB + "1"] == 1000.0
+    assert MB + "3" not in areas
+
+
+def test_intersection_area_is_the_largest_shared_feature(linksets):
+    store, graph = linksets
+    pages = store.overlaps_pages(MB + "1", True, True, False, False)
+    assert values(pages[0]) == [
+        {'o': CC + "1", 'uarea': 1000.0, 'oarea': 2000.0, 'iarea': 150.0},
+        {'o': CC + "2", 'uarea': 1000.0, 'oarea': 3000.0, 'iarea': 40.0},
+    ]
+
+
+def test_unknown_targets_and_linksets_are_left_to_the_triplestore(linksets):
+    store, graph = linksets
+    assert store.overlaps_pages(MB + "4", False, False, False, False) is None
+    assert store.overlaps_pages(MB + "1", False, False, False, False, "http://example.com/linkset/unknown") is None
+
+
+@pytest.mark.parametrize("linkset", [None, MB16CC, OTHER_LINKSET])
+def test_overlaps_pages_match_sparql(linksets, linkset):
+    store, graph = linksets
+    for target in (MB + "1", MB + "2", MB + "3", CC + "1", CC + "2", SA1):
+        # within and contains only add their queries, so they are always asked for
+        for include_areas, include_proportion in itertools.product((False, True), repeat=2):
+            options = (include_areas, include_proportion, True, True)
+            pages = store.overlaps_pages(target, *options, linksets_filter=linkset)
+            queries = build_overlaps_queries("<{}>".format(target), *options, linksets_filter=linkset)
+            assert len(pages) == len(queries)
+            for page, (name, sparql) in zip(pages, queries):
+                # the queries aren't ordered unless they are keyset paged, the store gives uri order
+                expected = sorted(sparql_values(graph, sparql), key=lambda b: b['o'])
+                assert values(page) == expected, (target, options, name)
+
+
+def test_keyset_pages_match_sparql(linksets):
+    store, graph = linksets
+    for target in (MB + "1", CC + "1", SA1):
+        for after in ("", CC + "1", MB + "1"):
+            pages = store.overlaps_pages(target, True, True, True, True, count=1, after=after)
+            queries = build_overlaps_queries("<{}>".format(target), True, True, True, True, after=after)
+            for page, (name, sparql) in zip(pages, queries):
+                assert values(page) == sparql_values(graph, sparql)[:1], (target, after, name)
@@ -0,0 +1,97 @@
+import itertools
+import random
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from functions import build_overlap, build_overlaps_columnar
+
+FLAG = {'type': 'literal', 'value': "true"}
+
+
+def random_area(rng):
+    if rng.random() < 0.05:
+        return "0"
+    return "{:.8f}".format(10 ** rng.uniform(-2, 8))
+
+
+def random_bindings(rng, n):
+    bindings = []
+    for i in range(n):
+        b = {'o': {'type': 'uri', 'value': "http://example.com/o/{}".format(i)}}
+        if rng.random() < 0.2:
+            b['w'] = FLAG
+        elif rng.random() < 0.2:
+            b['c'] = FLAG
+        if rng.random() < 0.9:
+            b['oarea'] = {'type': 'literal', 'value': random_area(rng)}
+        if rng.random() < 0.8:
+            b['iarea'] = {'type': 'literal', 'value': random_area(rng)}
+        bindings.append(b)
+    return bindings
+
+
+def literal(value):
+    return {'type': 'literal', 'value': value}
+
+
+def build_each_overlap(bindings, my_area, include_areas, include_proportion, include_within, include_contains):
+    return [build_overlap(b, my_area, include_areas, include_proportion, include_within, include_contains) for b in bindings]
+
+
+@pytest.mark.parametrize("build", [build_each_overlap, build_overlaps_columnar])
+def test_proportions_of_overlaps_within_and_containing(build):
+    bindings = [
+        {'o': {'type': 'uri', 'value': "http://example.com/o/1"}, 'oarea': literal("2000.0"), 'iarea': literal("500.0")},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/2"}, 'oarea': literal("4000.0"), 'w': FLAG},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/3"}, 'oarea': literal("250.0"), 'c': FLAG},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/4"}, 'iarea': literal("10.0")},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/5"}, 'oarea': literal("100.0")},
+    ]
+    overlaps = build(bindings, Decimal("1000.00000000"), True, True, True, True)
+    assert overlaps == [
+        {'uri': "http://example.com/o/1", 'isWithin': False, 'contains': False, 'featureArea': "2000.00000000",
+         'intersectionArea': "500.00000000", 'forwardPercentage': "50.00000000", 'reversePercentage': "25.00000000"},
+        {'uri': "http://example.com/o/2", 'isWithin': True, 'contains': False, 'featureArea': "4000.00000000",
+         'intersectionArea': "1000.00000000", 'forwardPercentage': "100.00000000", 'reversePercentage': "25.00000000"},
+        {'uri': "http://example.com/o/3", 'isWithin': False, 'contains': True, 'featureArea': "250.00000000",
+         'intersectionArea': "250.00000000", 'forwardPercentage': "25.00000000", 'reversePercentage': "100.00000000"},
+        {'uri': "http://example.com/o/4", 'isWithin': False, 'contains': False},
+        {'uri': "http://example.com/o/5", 'isWithin': False, 'contains': False, 'featureArea': "100.00000000"},
+    ]
+
+
+@pytest.mark.parametrize("build", [build_each_overlap, build_overlaps_columnar])
+def test_percentages_of_features_without_area_are_left_out(build):
+    bindings = [
+        {'o': {'type': 'uri', 'value': "http://example.com/o/1"}, 'oarea': literal("0.0"), 'iarea': literal("0.0")},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/2"}, 'oarea': literal("0"), 'w': FLAG},
+        {'o': {'type': 'uri', 'value': "http://example.com/o/3"}, 'oarea': literal("250.0"), 'iarea': literal("0")},
+    ]
+    overlaps = build(bindings, Decimal("1000.00000000"), True, True, True, True)
+    assert overlaps == [
+        {'uri': "http://example.com/o/1", 'isWithin': False, 'contains': False, 'featureArea': "0.00000000"},
+        {'uri': "http://example.com/o/2", 'isWithin': True, 'contains': False, 'featureArea': "0.00000000"},
+        {'uri': "http://example.com/o/3", 'isWithin': False, 'contains': False, 'featureArea': "250.00000000",
+         'intersectionArea': "0.00000000", 'forwardPercentage': "0.00000000", 'reversePercentage': "0.00000000"},
+    ]
+    # nor are any when the target has no area
+    overlaps = build(bindings[2:], Decimal("0E-8"), True, True, True, True)
+    assert overlaps == [
+        {'uri': "http://example.com/o/3", 'isWithin': False, 'contains': False, 'featureArea': "250.00000000"},
+    ]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_columnar_overlaps_match_build_overlap(seed):
+    rng = random.Random(seed)
+    bindings = random_bindings(rng, 500)
+    my_area = round(Decimal(random_area(rng)), 8)
+    for include_areas, include_proportion, include_within, include_contains in itertools.product((False, True), repeat=4):
+        if not include_areas and not include_proportion:
+            continue
+        expected = build_each_overlap(bindings, my_area, include_areas, include_proportion, include_within, include_contains)
+        actual = build_overlaps_columnar(bindings, my_area, include_areas, include_proportion, include_within, include_contains)
+        assert actual == expected
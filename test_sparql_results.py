@@ -0,0 +1,24 @@
+from sparql_results import parse_tsv_term, parse_tsv_header, parse_tsv_row, XSD
+
+
+def test_parse_uri_and_bnode():
+    assert parse_tsv_term("<http://example.com/a>") == {'type': 'uri', 'value': "http://example.com/a"}
+    assert parse_tsv_term("_:b0") == {'type': 'bnode', 'value': "b0"}
+
+
+def test_parse_literals():
+    assert parse_tsv_term('"a\\tb \\"c\\""') == {'type': 'literal', 'value': 'a\tb "c"'}
+    assert parse_tsv_term('"Sydney"@en') == {'type': 'literal', 'value': "Sydney", 'xml:lang': "en"}
+    assert parse_tsv_term('"20.25"^^<{}decimal>'.format(XSD)) == \
+        {'type': 'literal', 'value': "20.25", 'datatype': XSD + "decimal"}
+    assert parse_tsv_term("100.5")['datatype'] == XSD + "decimal"
+    assert parse_tsv_term("-3")['datatype'] == XSD + "integer"
+    assert parse_tsv_term("1.5E3")['datatype'] == XSD + "double"
+    assert parse_tsv_term("true")['datatype'] == XSD + "boolean"
+
+
+def test_parse_row_leaves_out_unbound():
+    variables = parse_tsv_header("?c\t?o\t?uarea\r\n")
+    assert variables == ["c", "o", "uarea"]
+    assert parse_tsv_row(variables, "\t<http://example.com/o>\t\n") == \
+        {'o': {'type': 'uri', 'value': "http://example.com/o"}}
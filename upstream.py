@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Shared HTTP client sessions for the upstream services: GraphDB, the geometry data service and Elasticsearch.
+
+Each upstream gets its own connection pool, sized and timed out according to UPSTREAM_POOLS, so a burst of
+slow SPARQL queries cannot use up the sockets needed to reach the other services. The sessions are opened
+and closed by the app's server lifecycle listeners, and are opened lazily on first use when running outside
+of the server (e.g. the crosswalk precompute job).
+
+Pool use is recorded with an aiohttp TraceConfig: requests in flight, requests waiting for a free connection
+and the time spent waiting. See pool_stats().
+"""
+import asyncio
+import time
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from config import UPSTREAM_POOLS, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_KEEPALIVE_TIMEOUT, UPSTREAM_DNS_CACHE_TTL
+
+GRAPHDB = 'graphdb'
+GEOM_DATA_SVC = 'gds'
+ES = 'es'
+
+
+class UpstreamStats(object):
+    """
+    Counters of one upstream's connection pool use
+    """
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.queue_waits = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def trace_config(self):
+        """
+        :return: a TraceConfig which records requests made through a session into these stats
+        :rtype: TraceConfig
+        """
+        trace_config = TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+            self.in_flight += 1
+
+        async def on_request_end(session, ctx, params):
+            self.in_flight -= 1
+
+        async def on_request_exception(session, ctx, params):
+            self.in_flight -= 1
+            self.errors += 1
+
+        async def on_connection_queued_start(session, ctx, params):
+            self.queued += 1
+            ctx.queued_at = time.perf_counter()
+
+        async def on_connection_queued_end(session, ctx, params):
+            self.queued -= 1
+            waited = time.perf_counter() - ctx.queued_at
+            self.queue_waits += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        return trace_config
+
+    def as_dict(self):
+        pool = UPSTREAM_POOLS[self.name]
+        return {
+            'limit': pool['limit'],
+            'limit_per_host': pool['limit_per_host'],
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'queue_waits': self.queue_waits,
+            'queue_wait_seconds_total': self.queue_wait_total,
+            'queue_wait_seconds_max': self.queue_wait_max,
+        }
+
+
+upstream_stats = {name: UpstreamStats(name) for name in UPSTREAM_POOLS}
+# open sessions, keyed on (event loop, upstream name)
+sessions = {}
+
+
+def _new_session(name, loop):
+    pool = UPSTREAM_POOLS[name]
+    connector = TCPConnector(limit=pool['limit'], limit_per_host=pool['limit_per_host'],
+                             keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT, ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+                             loop=loop)
+    # no total timeout, a long result can stream for as long as rows keep arriving
+    timeout = ClientTimeout(total=None, connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=pool['read_timeout'])
+    return ClientSession(connector=connector, timeout=timeout, trace_configs=[upstream_stats[name].trace_config()],
+                         loop=loop)
+
+
+def get_session(name):
+    """
+    :param name: GRAPHDB, GEOM_DATA_SVC or ES
+    :type name: str
+    :return: the shared session for the upstream on the running event loop
+    :rtype: ClientSession
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        return sessions[(loop, name)]
+    except KeyError:
+        session = sessions[(loop, name)] = _new_session(name, loop)
+        return session
+
+
+def open_sessions(loop):
+    """
+    Open a session for every upstream on the given event loop
+    """
+    for name in UPSTREAM_POOLS:
+        if (loop, name) not in sessions:
+            sessions[(loop, name)] = _new_session(name, loop)
+
+
+async def close_sessions(loop):
+    """
+    Close every upstream session on the given event loop, letting their connections close cleanly
+    """
+    for key in [key for key in sessions if key[0] is loop]:
+        session = sessions.pop(key)
+        await session.close()
+    # give the connectors a moment to finish closing their transports
+    await asyncio.sleep(0.25)
+
+
+def pool_stats():
+    """
+    :return: the connection pool stats of every upstream
+    :rtype: dict
+    """
+    return {name: stats.as_dict() for name, stats in upstream_stats.items()}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Compact in-memory forms of large result sets.
+
+A UriTable interns uris as small integer ids, storing each distinct namespace prefix
+(e.g. http://linked.data.gov.au/dataset/asgs2016/meshblock/) once and only the local part of each uri.
+OverlapRecord and CrosswalkParent are __slots__ records holding an overlap or a crosswalk result as a uri id
+and floats, so the crosswalk doesn't hold a dict and a handful of strings per overlap. Uris and output
+strings are only made again when results are serialised.
+"""
+import math
+from array import array
+
+NAN = float('nan')
+
+
+def format_decimal(value):
+    """
+    :return: a float written as an 8 decimal place value, the form the overlaps queries' areas and
+     percentages are returned in, or "nan"
+    :rtype: str
+    """
+    if math.isnan(value):
+        return "nan"
+    return "%.8f" % value
+
+
+class UriTable(object):
+    """
+    Interns uris as integer ids, split into a shared prefix and a local part
+    """
+    def __init__(self):
+        self.prefixes = []
+        self._prefix_ids = {}
+        # for each uri id, the id of its prefix and its local part
+        self.uri_prefixes = array('i')
+        self.locals = []
+        # for each prefix id, local part to uri id
+        self._ids = []
+        self._prefix_contains = {}
+
+    def __len__(self):
+        return len(self.locals)
+
+    @staticmethod
+    def split(uri):
+        split_at = max(uri.rfind('/'), uri.rfind('#')) + 1
+        return uri[:split_at], uri[split_at:]
+
+    def intern(self, uri):
+        """
+        :return: the id of uri, adding it to the table if it is new
+        :rtype: int
+        """
+        prefix, local = self.split(uri)
+        try:
+            prefix_id = self._prefix_ids[prefix]
+        except KeyError:
+            prefix_id = self._prefix_ids[prefix] = len(self.prefixes)
+            self.prefixes.append(prefix)
+            self._ids.append({})
+        ids = self._ids[prefix_id]
+        try:
+            return ids[local]
+        except KeyError:
+            uri_id = ids[local] = len(self.locals)
+            self.uri_prefixes.append(prefix_id)
+            self.locals.append(local)
+            return uri_id
+
+    def get(self, uri):
+        """
+        :return: the id of uri, or None if it is not in the table
+        :rtype: int
+        """
+        prefix, local = self.split(uri)
+        prefix_id = self._prefix_ids.get(prefix)
+        if prefix_id is None:
+            return None
+        return self._ids[prefix_id].get(local)
+
+    def uri(self, uri_id):
+        """
+        :return: the uri with the given id
+        :rtype: str
+        """
+        return self.prefixes[self.uri_prefixes[uri_id]] + self.locals[uri_id]
+
+    def uri_contains(self, uri_id, text):
+        """
+        :return: whether text is in the uri with the given id, i.e. text in uri(uri_id)
+        :rtype: bool
+        """
+        prefix_id = self.uri_prefixes[uri_id]
+        try:
+            in_prefix = self._prefix_contains[(prefix_id, text)]
+        except KeyError:
+            in_prefix = self._prefix_contains[(prefix_id, text)] = text in self.prefixes[prefix_id]
+        # text is nearly always a dataset or feature type path, so it is found in the prefix
+        return in_prefix or text in self.uri(uri_id)
+
+
+class OverlapRecord(object):
+    """
+    One overlap of a feature, as returned by get_location_overlaps, with areas and percentages as floats.
+    Values that weren't returned are NaN. A record made from an overlap that was only a uri has detailed False.
+    """
+    __slots__ = ('uri_id', 'feature_area', 'intersection_area', 'forward_percentage', 'reverse_percentage',
+                 'is_within', 'contains', 'detailed')
+
+    def __init__(self, uri_id, feature_area=NAN, intersection_area=NAN, forward_percentage=NAN,
+                 reverse_percentage=NAN, is_within=False, contains=False, detailed=True):
+        self.uri_id = uri_id
+        self.feature_area = feature_area
+        self.intersection_area = intersection_area
+        self.forward_percentage = forward_percentage
+        self.reverse_percentage = reverse_percentage
+        self.is_within = is_within
+        self.contains = contains
+        self.detailed = detailed
+
+    @classmethod
+    def from_overlap(cls, uri_table, an_overlap):
+        """
+        :param an_overlap: an overlap as built by build_overlap, a uri or a dict
+        :rtype: OverlapRecord
+        """
+        if isinstance(an_overlap, str):
+            return cls(uri_table.intern(an_overlap), detailed=False)
+        return cls(uri_table.intern(an_overlap['uri']),
+                   float(an_overlap.get('featureArea', NAN)),
+                   float(an_overlap.get('intersectionArea', NAN)),
+                   float(an_overlap.get('forwardPercentage', NAN)),
+                   float(an_overlap.get('reversePercentage', NAN)),
+                   an_overlap.get('isWithin', False),
+                   an_overlap.get('contains', False))
+
+
+class CrosswalkParent(object):
+    """
+    The running total of one feature in a crosswalk result.
+    A feature found directly in the from feature (rather than through base units) keeps the areas and
+    percentages of that overlap, in which case from_overlap is True.
+    """
+    __slots__ = ('uri_id', 'intersection_area', 'feature_area', 'forward_percentage', 'reverse_percentage',
+                 'from_overlap')
+
+    def __init__(self, uri_id, intersection_area, feature_area, forward_percentage=None, reverse_percentage=None,
+                 from_overlap=False):
+        self.uri_id = uri_id
+        self.intersection_area = intersection_area
+        self.feature_area = feature_area
+        # None until known
+        self.forward_percentage = forward_percentage
+        self.reverse_percentage = reverse_percentage
+        self.from_overlap = from_overlap